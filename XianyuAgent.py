@@ -1,13 +1,19 @@
 import re
-from typing import List, Dict
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple
 import os
 from openai import OpenAI
 from loguru import logger
 from product_prompt_manager import ProductPromptManager
+from context_builder import ContextBuilder
 
 
 class XianyuReplyBot:
-    def __init__(self):
+    def __init__(self, context_manager=None):
         # 初始化OpenAI客户端
         self.client = OpenAI(
             api_key=os.getenv("API_KEY"),
@@ -20,7 +26,19 @@ class XianyuReplyBot:
         self._init_agents()
         self.router = IntentRouter(self.agents['classify'])
         self.last_intent = None  # 记录最后一次意图
+        
+        # 按商品缓存的Agent，商品提示词变化时自动重建
+        self.agent_registry = AgentRegistry(self)
+        
+        # 上下文构建器：按Token预算组装对话历史，早期对话使用保存在context_manager中的摘要
+        self.context_builder = ContextBuilder(self.client, store=context_manager)
+        
+        # 单次调用模式：关键词规则未命中时，一次大模型调用同时返回意图和回复
+        self.single_shot = os.getenv("SINGLE_SHOT_MODE", "false").lower() == "true"
 
+        # 回复生成线程池，避免同步的大模型调用阻塞事件循环
+        self.max_workers = int(os.getenv("LLM_MAX_WORKERS", "4"))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="llm")
 
     def _init_agents(self):
         """初始化各领域Agent"""
@@ -74,69 +92,122 @@ class XianyuReplyBot:
         user_assistant_msgs = [msg for msg in context if msg['role'] in ['user', 'assistant']]
         return "\n".join([f"{msg['role']}: {msg['content']}" for msg in user_assistant_msgs])
 
-    def generate_reply(self, user_msg: str, item_desc: str, context: List[Dict], item_id: str = None) -> str:
+    def generate_reply(self, user_msg: str, item_desc: str, context: List[Dict], item_id: str = None,
+                       chat_id: str = None) -> str:
         """生成回复主流程 - 支持商品个性化提示词"""
+        reply, intent = self._generate(user_msg, item_desc, context, item_id, chat_id)
+        self.last_intent = intent  # 保存当前意图
+        return reply
+
+    async def generate_reply_async(self, user_msg: str, item_desc: str, context: List[Dict],
+                                   item_id: str = None, chat_id: str = None) -> Tuple[str, str]:
+        """
+        异步生成回复，在线程池中执行大模型调用，不阻塞事件循环
+
+        Returns:
+            tuple: (回复内容, 识别出的意图)。并发调用时请使用返回的意图而不是last_intent
+        """
+        loop = asyncio.get_running_loop()
+        reply, intent = await loop.run_in_executor(
+            self.executor, self._generate, user_msg, item_desc, context, item_id, chat_id
+        )
+        self.last_intent = intent
+        return reply, intent
+
+    def _generate(self, user_msg: str, item_desc: str, context: List[Dict], item_id: str = None,
+                  chat_id: str = None) -> Tuple[str, str]:
+        """生成回复并返回 (回复内容, 意图)"""
         # 记录用户消息
         # logger.debug(f'用户所发消息: {user_msg}')
         
-        formatted_context = self.format_history(context)
+        # 早期对话替换为摘要，各Agent再按自己的Token预算渲染
+        history = self.context_builder.prepare(chat_id, context)
+        formatted_context = self.context_builder.render(history, 'classify')
         # logger.debug(f'对话历史: {formatted_context}')
         
-        # 1. 路由决策 (使用个性化分类提示词)
-        classify_prompt = self.classify_prompt
-        if item_id:
-            custom_classify_prompt = self.product_prompt_manager.get_product_prompt(item_id, 'classify')
-            if custom_classify_prompt:
-                classify_prompt = custom_classify_prompt
-                logger.info(f"使用商品{item_id}的个性化分类提示词")
+        # 商品的Agent集合 (使用个性化提示词)
+        agent_set = self.agent_registry.get(item_id)
+        
+        # 1. 关键词规则路由
+        detected_intent = agent_set.router.match_rules(user_msg)
         
-        # 临时更新分类器
-        temp_classifier = ClassifyAgent(self.client, classify_prompt, self._safe_filter)
-        temp_router = IntentRouter(temp_classifier)
-        detected_intent = temp_router.detect(user_msg, item_desc, formatted_context)
+        if detected_intent is None and self.single_shot:
+            # 规则未命中：一次调用同时完成意图识别和回复
+            return self._generate_single_shot(user_msg, item_desc, context, history, agent_set)
+        
+        if detected_intent is None:
+            # 大模型兜底分类 (使用个性化分类提示词)
+            detected_intent = agent_set.router.classify(user_msg, item_desc, formatted_context)
 
-        # 2. 获取对应Agent (使用个性化提示词)
+        # 2. 获取对应Agent
         internal_intents = {'classify'}  # 定义不对外开放的Agent
 
-        if detected_intent in self.agents and detected_intent not in internal_intents:
-            # 获取个性化提示词
-            agent_prompt = getattr(self, f'{detected_intent}_prompt')
-            if item_id:
-                custom_prompt = self.product_prompt_manager.get_product_prompt(item_id, detected_intent)
-                if custom_prompt:
-                    agent_prompt = custom_prompt
-                    logger.info(f"使用商品{item_id}的个性化{detected_intent}提示词")
-            
-            # 创建临时Agent使用个性化提示词
-            agent_class = type(self.agents[detected_intent])
-            agent = agent_class(self.client, agent_prompt, self._safe_filter)
-            
-            logger.info(f'意图识别完成: {detected_intent}')
-            self.last_intent = detected_intent  # 保存当前意图
+        if detected_intent in agent_set.agents and detected_intent not in internal_intents:
+            intent = detected_intent
         else:
-            # 默认Agent也支持个性化
-            default_prompt = self.default_prompt
-            if item_id:
-                custom_prompt = self.product_prompt_manager.get_product_prompt(item_id, 'default')
-                if custom_prompt:
-                    default_prompt = custom_prompt
-                    logger.info(f"使用商品{item_id}的个性化default提示词")
-            
-            agent = DefaultAgent(self.client, default_prompt, self._safe_filter)
-            logger.info(f'意图识别完成: default')
-            self.last_intent = 'default'  # 保存当前意图
+            intent = 'default'
+        agent = agent_set.agents[intent]
+        logger.info(f'意图识别完成: {intent}')
         
         # 3. 获取议价次数
         bargain_count = self._extract_bargain_count(context)
         logger.info(f'议价次数: {bargain_count}')
 
         # 4. 生成回复
-        return agent.generate(
+        reply = agent.generate(
             user_msg=user_msg,
             item_desc=item_desc,
-            context=formatted_context,
+            context=self.context_builder.render(history, intent),
             bargain_count=bargain_count
         )
+        return reply, intent
+
+    def _generate_single_shot(self, user_msg: str, item_desc: str, context: List[Dict],
+                              history, agent_set: 'AgentSet') -> Tuple[str, str]:
+        """
+        单次调用模式：意图识别和回复合并为一次大模型调用，返回 (回复内容, 意图)
+
+        意图在调用前未知，温度按会话状态选择：买家还没有议价时使用DefaultAgent的温度
+        （规则未命中的消息多数是default意图），已经议价时使用PriceAgent按议价轮次计算的温度。
+        price和default意图直接使用本次回复；tech意图需要联网搜索，交给TechAgent重新生成
+        （多一次调用，规则路由已覆盖大部分技术类消息）
+        """
+        agent = agent_set.single_shot
+        
+        bargain_count = self._extract_bargain_count(context)
+        logger.info(f'议价次数: {bargain_count}')
+        
+        if bargain_count > 0:
+            temperature = agent_set.agents['price']._calc_temperature(bargain_count)
+        else:
+            temperature = DefaultAgent.TEMPERATURE
+        reply, intent = agent.generate_with_intent(
+            user_msg=user_msg,
+            item_desc=item_desc,
+            context=self.context_builder.render(history, 'default'),
+            bargain_count=bargain_count,
+            temperature=temperature
+        )
+        logger.info(f'意图识别完成(单次调用): {intent}')
+
+        if intent in SingleShotAgent.DEDICATED_INTENTS:
+            reply = agent_set.agents[intent].generate(
+                user_msg=user_msg,
+                item_desc=item_desc,
+                context=self.context_builder.render(history, intent),
+                bargain_count=bargain_count
+            )
+        return reply, intent
+
+    def _get_prompt(self, item_id: str, prompt_type: str) -> str:
+        """获取提示词，商品配置了个性化提示词时优先使用"""
+        prompt = getattr(self, f'{prompt_type}_prompt')
+        if item_id:
+            custom_prompt = self.product_prompt_manager.get_product_prompt(item_id, prompt_type)
+            if custom_prompt:
+                logger.info(f"使用商品{item_id}的个性化{prompt_type}提示词")
+                return custom_prompt
+        return prompt
     
     def _extract_bargain_count(self, context: List[Dict]) -> int:
         """
@@ -165,30 +236,97 @@ class XianyuReplyBot:
         logger.info("正在重新加载提示词...")
         self._init_system_prompts()
         self._init_agents()
+        self.product_prompt_manager.invalidate()
+        self.agent_registry.clear()
         logger.info("提示词重新加载完成")
 
 
+class AgentSet:
+    """单个商品的Agent集合：各领域Agent、意图路由器和单次调用Agent"""
+
+    def __init__(self, bot: XianyuReplyBot, item_id: str, version: int):
+        self.version = version
+        prompts = {
+            prompt_type: bot._get_prompt(item_id, prompt_type)
+            for prompt_type in ['classify', 'price', 'tech', 'default']
+        }
+        self.agents = {
+            'classify': ClassifyAgent(bot.client, prompts['classify'], bot._safe_filter),
+            'price': PriceAgent(bot.client, prompts['price'], bot._safe_filter),
+            'tech': TechAgent(bot.client, prompts['tech'], bot._safe_filter),
+            'default': DefaultAgent(bot.client, prompts['default'], bot._safe_filter),
+        }
+        self.router = IntentRouter(self.agents['classify'])
+        self.single_shot = SingleShotAgent(bot.client, prompts, bot._safe_filter)
+
+
+class AgentRegistry:
+    """
+    按商品缓存Agent集合
+
+    每个商品的Agent只在首次使用或商品提示词版本变化时构建一次，
+    缓存数量超过max_size时淘汰最久未使用的商品。
+    """
+
+    def __init__(self, bot: XianyuReplyBot, max_size: int = None):
+        self.bot = bot
+        self.max_size = max_size or int(os.getenv("AGENT_REGISTRY_SIZE", "256"))
+        self._entries = OrderedDict()  # item_id -> AgentSet
+        self._lock = threading.Lock()
+
+    def get(self, item_id: str = None) -> AgentSet:
+        """获取商品的Agent集合，未传入商品ID时使用通用提示词"""
+        version = self.bot.product_prompt_manager.get_prompt_version(item_id) if item_id else 0
+        with self._lock:
+            agent_set = self._entries.get(item_id)
+            if agent_set is not None and agent_set.version == version:
+                self._entries.move_to_end(item_id)
+                return agent_set
+
+            agent_set = AgentSet(self.bot, item_id, version)
+            self._entries[item_id] = agent_set
+            self._entries.move_to_end(item_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return agent_set
+
+    def clear(self):
+        """清空缓存，下次使用时按最新提示词重建"""
+        with self._lock:
+            self._entries.clear()
+
+
 class IntentRouter:
     """意图路由决策器"""
 
-    def __init__(self, classify_agent):
-        self.rules = {
-            'tech': {  # 技术类优先判定
-                'keywords': ['参数', '规格', '型号', '连接', '对比'],
-                'patterns': [
-                    r'和.+比'             
-                ]
-            },
-            'price': {
-                'keywords': ['便宜', '价', '砍价', '少点'],
-                'patterns': [r'\d+元', r'能少\d+']
-            }
+    # 路由规则为类级常量，正则只编译一次
+    rules = {
+        'tech': {  # 技术类优先判定
+            'keywords': ['参数', '规格', '型号', '连接', '对比'],
+            'patterns': [
+                re.compile(r'和.+比')
+            ]
+        },
+        'price': {
+            'keywords': ['便宜', '价', '砍价', '少点'],
+            'patterns': [re.compile(r'\d+元'), re.compile(r'能少\d+')]
         }
+    }
+    _clean_pattern = re.compile(r'[^\w\u4e00-\u9fa5]')
+
+    def __init__(self, classify_agent):
         self.classify_agent = classify_agent
 
     def detect(self, user_msg: str, item_desc, context) -> str:
         """三级路由策略（技术优先）"""
-        text_clean = re.sub(r'[^\w\u4e00-\u9fa5]', '', user_msg)
+        intent = self.match_rules(user_msg)
+        if intent is not None:
+            return intent
+        return self.classify(user_msg, item_desc, context)
+
+    def match_rules(self, user_msg: str):
+        """关键词和正则规则路由，未命中返回None"""
+        text_clean = self._clean_pattern.sub('', user_msg)
         
         # 1. 技术类关键词优先检查
         if any(kw in text_clean for kw in self.rules['tech']['keywords']):
@@ -197,7 +335,7 @@ class IntentRouter:
             
         # 2. 技术类正则优先检查
         for pattern in self.rules['tech']['patterns']:
-            if re.search(pattern, text_clean):
+            if pattern.search(text_clean):
                 # logger.debug(f"技术类正则匹配: {pattern}")
                 return 'tech'
 
@@ -208,11 +346,14 @@ class IntentRouter:
                 return intent
             
             for pattern in self.rules[intent]['patterns']:
-                if re.search(pattern, text_clean):
+                if pattern.search(text_clean):
                     # logger.debug(f"价格类正则匹配: {pattern}")
                     return intent
         
-        # 4. 大模型兜底
+        return None
+
+    def classify(self, user_msg: str, item_desc, context) -> str:
+        """大模型兜底分类"""
         # logger.debug("使用大模型进行意图分类")
         return self.classify_agent.generate(
             user_msg=user_msg,
@@ -311,10 +452,61 @@ class ClassifyAgent(BaseAgent):
         return response
 
 
+class SingleShotAgent(BaseAgent):
+    """单次调用Agent：一次请求同时返回意图和回复"""
+
+    INTENTS = ('price', 'tech', 'default')
+    # 需要专用调用参数（联网搜索）的意图，单次调用的回复只用于意图识别
+    DEDICATED_INTENTS = ('tech',)
+    _JSON_RE = re.compile(r'\{.*\}', re.S)
+
+    def __init__(self, client, intent_prompts: Dict[str, str], safety_filter):
+        """
+        Args:
+            intent_prompts: 各意图的提示词，包含classify/price/tech/default
+        """
+        sections = [f"【意图分类规则】\n{intent_prompts['classify']}"]
+        for intent in self.INTENTS:
+            sections.append(f"【{intent}意图的回复规则】\n{intent_prompts[intent]}")
+        sections.append(
+            "▲输出格式（优先于以上所有输出要求）：先按分类规则判断买家最新消息的意图，"
+            "再按该意图的回复规则生成回复，只输出一个JSON对象，不要输出其他内容：\n"
+            '{"intent": "price/tech/default之一", "reply": "回复内容"}'
+        )
+        super().__init__(client, "\n\n".join(sections), safety_filter)
+
+    def generate_with_intent(self, user_msg: str, item_desc: str, context: str,
+                             bargain_count: int = 0, temperature: float = 0.4) -> Tuple[str, str]:
+        """生成回复，返回 (回复内容, 意图)"""
+        messages = self._build_messages(user_msg, item_desc, context)
+        messages[0]['content'] += f"\n▲当前议价轮次：{bargain_count}"
+        response = self._call_llm(messages, temperature=temperature)
+        intent, reply = self._parse(response)
+        return self.safety_filter(reply), intent
+
+    def _parse(self, text: str) -> Tuple[str, str]:
+        """解析结构化输出，格式不符时整段作为default意图的回复"""
+        text = (text or '').strip()
+        match = self._JSON_RE.search(text)
+        if match:
+            try:
+                data = json.loads(match.group(0))
+                intent = str(data.get('intent', '')).strip().lower()
+                reply = str(data.get('reply', '')).strip()
+                if reply:
+                    return (intent if intent in self.INTENTS else 'default'), reply
+            except (ValueError, AttributeError):
+                pass
+        logger.warning("单次调用未返回有效的JSON，按default意图处理")
+        return 'default', text
+
+
 class DefaultAgent(BaseAgent):
     """默认处理Agent"""
 
+    TEMPERATURE = 0.7
+
     def _call_llm(self, messages: List[Dict], *args) -> str:
         """限制默认回复长度"""
-        response = super()._call_llm(messages, temperature=0.7)
+        response = super()._call_llm(messages, temperature=self.TEMPERATURE)
         return response
\ No newline at end of file
@@ -2,6 +2,7 @@ import time
 import os
 import re
 import sys
+import asyncio
 import urllib3
 import random
 
@@ -10,13 +11,94 @@ from loguru import logger
 from utils.xianyu_utils import generate_sign
 from user_agent_pool import get_ua_pool
 
+# 可选的httpx异步客户端，未安装时AsyncXianyuApis在线程中调用同步接口
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    httpx = None
+    HTTPX_AVAILABLE = False
+
 # 禁用SSL警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# 同步与异步客户端共用的接口地址和请求参数
+TOKEN_URL = 'https://h5api.m.goofish.com/h5/mtop.taobao.idlemessage.pc.login.token/1.0/'
+ITEM_URL = 'https://h5api.m.goofish.com/h5/mtop.taobao.idle.pc.detail/1.0/'
+ITEM_LIST_URL = 'https://h5api.m.goofish.com/h5/mtop.idle.web.xyh.item.list/1.0/'
+LOGIN_URL = 'https://passport.goofish.com/newlogin/hasLogin.do'
+LOGIN_PARAMS = {'appName': 'xianyu', 'fromSite': '77'}
+
+
+def build_mtop_params(api: str, token: str, data_val: str, **extra_params) -> dict:
+    """构建签名后的mtop请求参数"""
+    params = {
+        'jsv': '2.7.2',
+        'appKey': '34839810',
+        't': str(int(time.time()) * 1000),
+        'sign': '',
+        'v': '1.0',
+        'type': 'originaljson',
+        'accountSite': 'xianyu',
+        'dataType': 'json',
+        'timeout': '20000',
+        'api': api,
+        'sessionOption': 'AutoLoginOnly',
+        **extra_params,
+    }
+    params['sign'] = generate_sign(params['t'], token, data_val)
+    return params
+
+
+def token_data(device_id: str) -> str:
+    return '{"appKey":"444e9908a51d1cb236a27862abc769c9","deviceId":"' + device_id + '"}'
+
+
+def item_data(item_id: str) -> str:
+    return '{"itemId":"' + item_id + '"}'
+
+
+def item_list_data(user_id: str, page: int, page_size: int) -> str:
+    return f'{{"needGroupInfo":true,"pageNumber":{page},"userId":"{user_id}","pageSize":{page_size}}}'
+
+
+def build_login_data(cookie) -> dict:
+    """
+    构建hasLogin.do的表单
+
+    Args:
+        cookie: 按名称读取Cookie值的函数，不存在时返回空字符串
+    """
+    return {
+        'hid': cookie('unb'),
+        'ltl': 'true',
+        'appName': 'xianyu',
+        'appEntrance': 'web',
+        '_csrf_token': cookie('XSRF-TOKEN'),
+        'umidToken': '',
+        'hsiz': cookie('cookie2'),
+        'bizParams': 'taobaoBizLoginFrom=web',
+        'mainPage': 'false',
+        'isMobile': 'false',
+        'lang': 'zh_CN',
+        'returnUrl': '',
+        'fromSite': '77',
+        'isIframe': 'true',
+        'documentReferer': 'https://www.goofish.com/',
+        'defaultView': 'hasLogin',
+        'umidTag': 'SERVER',
+        'deviceId': cookie('cna')
+    }
+
 
 class XianyuApis:
-    def __init__(self):
-        self.url = 'https://h5api.m.goofish.com/h5/mtop.taobao.idlemessage.pc.login.token/1.0/'
+    def __init__(self, persist_env_cookies=True):
+        """
+        Args:
+            persist_env_cookies: Cookie更新后是否写回.env文件；多账号运行时各账号的Cookie不在.env中，应关闭
+        """
+        self.persist_env_cookies = persist_env_cookies
+        self.url = TOKEN_URL
         self.session = requests.Session()
         
         # 禁用代理和配置SSL
@@ -68,7 +150,8 @@ class XianyuApis:
         self.session.cookies = new_jar
         
         # 更新完cookies后，更新.env文件
-        self.update_env_cookies()
+        if self.persist_env_cookies:
+            self.update_env_cookies()
         
     def update_env_cookies(self):
         """更新.env文件中的COOKIES_STR"""
@@ -120,33 +203,9 @@ class XianyuApis:
             return False
             
         try:
-            url = 'https://passport.goofish.com/newlogin/hasLogin.do'
-            params = {
-                'appName': 'xianyu',
-                'fromSite': '77'
-            }
-            data = {
-                'hid': self.session.cookies.get('unb', ''),
-                'ltl': 'true',
-                'appName': 'xianyu',
-                'appEntrance': 'web',
-                '_csrf_token': self.session.cookies.get('XSRF-TOKEN', ''),
-                'umidToken': '',
-                'hsiz': self.session.cookies.get('cookie2', ''),
-                'bizParams': 'taobaoBizLoginFrom=web',
-                'mainPage': 'false',
-                'isMobile': 'false',
-                'lang': 'zh_CN',
-                'returnUrl': '',
-                'fromSite': '77',
-                'isIframe': 'true',
-                'documentReferer': 'https://www.goofish.com/',
-                'defaultView': 'hasLogin',
-                'umidTag': 'SERVER',
-                'deviceId': self.session.cookies.get('cna', '')
-            }
+            data = build_login_data(lambda name: self.session.cookies.get(name, ''))
             
-            response = self.session.post(url, params=params, data=data)
+            response = self.session.post(LOGIN_URL, params=LOGIN_PARAMS, data=data)
             res_json = response.json()
             
             if res_json.get('content', {}).get('success'):
@@ -180,33 +239,17 @@ class XianyuApis:
                 logger.error("🔴 程序即将退出，请更新.env文件中的COOKIES_STR后重新启动")
                 sys.exit(1)  # 直接退出程序
             
-        params = {
-            'jsv': '2.7.2',
-            'appKey': '34839810',
-            't': str(int(time.time()) * 1000),
-            'sign': '',
-            'v': '1.0',
-            'type': 'originaljson',
-            'accountSite': 'xianyu',
-            'dataType': 'json',
-            'timeout': '20000',
-            'api': 'mtop.taobao.idlemessage.pc.login.token',
-            'sessionOption': 'AutoLoginOnly',
-            'spm_cnt': 'a21ybx.im.0.0',
-        }
-        data_val = '{"appKey":"444e9908a51d1cb236a27862abc769c9","deviceId":"' + device_id + '"}'
+        data_val = token_data(device_id)
         data = {
             'data': data_val,
         }
         
         # 简单获取token，信任cookies已清理干净
         token = self.session.cookies.get('_m_h5_tk', '').split('_')[0]
-        
-        sign = generate_sign(params['t'], token, data_val)
-        params['sign'] = sign
+        params = build_mtop_params('mtop.taobao.idlemessage.pc.login.token', token, data_val, spm_cnt='a21ybx.im.0.0')
         
         try:
-            response = self.session.post('https://h5api.m.goofish.com/h5/mtop.taobao.idlemessage.pc.login.token/1.0/', params=params, data=data)
+            response = self.session.post(TOKEN_URL, params=params, data=data)
             res_json = response.json()
             
             if isinstance(res_json, dict):
@@ -246,35 +289,18 @@ class XianyuApis:
             logger.error("获取商品信息失败，重试次数过多")
             return {"error": "获取商品信息失败，重试次数过多"}
             
-        params = {
-            'jsv': '2.7.2',
-            'appKey': '34839810',
-            't': str(int(time.time()) * 1000),
-            'sign': '',
-            'v': '1.0',
-            'type': 'originaljson',
-            'accountSite': 'xianyu',
-            'dataType': 'json',
-            'timeout': '20000',
-            'api': 'mtop.taobao.idle.pc.detail',
-            'sessionOption': 'AutoLoginOnly',
-            'spm_cnt': 'a21ybx.im.0.0',
-        }
-        
-        data_val = '{"itemId":"' + item_id + '"}'
+        data_val = item_data(item_id)
         data = {
             'data': data_val,
         }
         
         # 简单获取token，信任cookies已清理干净
         token = self.session.cookies.get('_m_h5_tk', '').split('_')[0]
-        
-        sign = generate_sign(params['t'], token, data_val)
-        params['sign'] = sign
+        params = build_mtop_params('mtop.taobao.idle.pc.detail', token, data_val, spm_cnt='a21ybx.im.0.0')
         
         try:
             response = self.session.post(
-                'https://h5api.m.goofish.com/h5/mtop.taobao.idle.pc.detail/1.0/', 
+                ITEM_URL, 
                 params=params, 
                 data=data
             )
@@ -331,22 +357,8 @@ class XianyuApis:
             logger.error("无法获取userId，请检查Cookie配置")
             return {"error": "无法获取userId"}
 
-        params = {
-            'jsv': '2.7.2',
-            'appKey': '34839810',
-            't': str(int(time.time()) * 1000),
-            'sign': '',
-            'v': '1.0',
-            'type': 'originaljson',
-            'accountSite': 'xianyu',
-            'dataType': 'json',
-            'timeout': '20000',
-            'api': 'mtop.idle.web.xyh.item.list',
-            'sessionOption': 'AutoLoginOnly',
-        }
-
         # 构建请求数据 - 使用新API要求的参数格式
-        data_val = f'{{"needGroupInfo":true,"pageNumber":{page},"userId":"{user_id}","pageSize":{page_size}}}'
+        data_val = item_list_data(user_id, page, page_size)
         data = {
             'data': data_val,
         }
@@ -358,12 +370,11 @@ class XianyuApis:
                 token = cookie.value.split('_')[0]
                 break
 
-        sign = generate_sign(params['t'], token, data_val)
-        params['sign'] = sign
+        params = build_mtop_params('mtop.idle.web.xyh.item.list', token, data_val)
 
         try:
             response = self.session.post(
-                'https://h5api.m.goofish.com/h5/mtop.idle.web.xyh.item.list/1.0/',
+                ITEM_LIST_URL,
                 params=params,
                 data=data
             )
@@ -395,3 +406,211 @@ class XianyuApis:
             logger.error(f"用户商品列表API请求异常: {str(e)}")
             time.sleep(random.uniform(1, 2))
             return self.get_user_items(page, page_size, status, retry_count + 1)
+
+
+class AsyncXianyuApis:
+    """
+    XianyuApis的异步版本，供事件循环中的XianyuLive使用
+
+    基于httpx.AsyncClient复用keep-alive连接，重试改为循环 + asyncio.sleep退避，
+    不会阻塞心跳和其他会话。Cookie以同步实例的session为准：启动时复制过来，
+    响应更新Cookie后写回同步实例（去重并按其persist_env_cookies决定是否写回.env）。
+    未安装httpx时，各方法在线程中调用同步实例的对应方法。
+    """
+
+    # 登录后仍无法获取token时，最多重新登录的次数
+    MAX_RELOGIN = 3
+
+    def __init__(self, sync_api: XianyuApis, max_connections: int = None):
+        """
+        Args:
+            sync_api: 同步实例，提供请求头、Cookie，并作为未安装httpx时的回退
+            max_connections: 连接池大小，默认读取HTTP_MAX_CONNECTIONS
+        """
+        self.sync_api = sync_api
+        self.client = None
+        if HTTPX_AVAILABLE:
+            max_connections = max_connections or int(os.getenv("HTTP_MAX_CONNECTIONS", "10"))
+            self.client = httpx.AsyncClient(
+                headers=dict(sync_api.session.headers),
+                verify=False,
+                trust_env=False,
+                timeout=20.0,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            )
+            self._load_cookies()
+        else:
+            logger.info("httpx未安装，异步接口将在线程中调用同步接口")
+
+    def _load_cookies(self):
+        """从同步实例复制Cookie"""
+        self.client.cookies.clear()
+        for cookie in self.sync_api.session.cookies:
+            self.client.cookies.set(cookie.name, cookie.value, domain=cookie.domain, path=cookie.path)
+
+    def _save_cookies(self):
+        """把响应更新后的Cookie写回同步实例，去重后重新加载"""
+        for cookie in self.client.cookies.jar:
+            self.sync_api.session.cookies.set_cookie(cookie)
+        self.sync_api.clear_duplicate_cookies()
+        self._load_cookies()
+
+    def _cookie(self, name: str) -> str:
+        """按名称读取Cookie（存在重复时取最后一个）"""
+        value = ''
+        for cookie in self.client.cookies.jar:
+            if cookie.name == name:
+                value = cookie.value
+        return value
+
+    async def _post_mtop(self, url: str, api: str, data_val: str, **extra_params):
+        """发送签名后的mtop请求，返回 (响应JSON, 响应对象)"""
+        token = self._cookie('_m_h5_tk').split('_')[0]
+        params = build_mtop_params(api, token, data_val, **extra_params)
+
+        response = await self.client.post(url, params=params, data={'data': data_val})
+        return response.json(), response
+
+    @staticmethod
+    def _succeeded(res_json, marker: str = 'SUCCESS::调用成功') -> bool:
+        return isinstance(res_json, dict) and any(marker in ret for ret in res_json.get('ret', []))
+
+    async def has_login(self, max_retries: int = 2) -> bool:
+        """调用hasLogin.do接口进行登录状态检查"""
+        if self.client is None:
+            return await asyncio.to_thread(self.sync_api.hasLogin)
+
+        data = build_login_data(self._cookie)
+        for attempt in range(max_retries):
+            try:
+                response = await self.client.post(LOGIN_URL, params=LOGIN_PARAMS, data=data)
+                res_json = response.json()
+                if res_json.get('content', {}).get('success'):
+                    logger.debug("Login成功")
+                    self._save_cookies()
+                    return True
+                logger.warning(f"Login失败: {res_json}")
+                delay = random.uniform(2, 5) + attempt * 2
+            except Exception as e:
+                logger.error(f"Login请求异常: {str(e)}")
+                delay = random.uniform(3, 6) + attempt * 2
+            logger.debug(f"等待 {delay:.1f} 秒后重试...")
+            await asyncio.sleep(delay)
+
+        logger.error("Login检查失败，重试次数过多")
+        return False
+
+    async def get_token(self, device_id: str, max_retries: int = 2):
+        """获取WebSocket token，Cookie失效时与同步版本一样退出（抛出SystemExit）"""
+        if self.client is None:
+            return await asyncio.to_thread(self.sync_api.get_token, device_id)
+
+        data_val = token_data(device_id)
+        relogins = 0
+        attempt = 0
+        while True:
+            if attempt >= max_retries:
+                logger.warning("获取token失败，尝试重新登陆")
+                if relogins < self.MAX_RELOGIN and await self.has_login():
+                    logger.info("重新登录成功，重新尝试获取token")
+                    relogins += 1
+                    attempt = 0
+                    continue
+                logger.error("重新登录失败，Cookie已失效")
+                logger.error("🔴 程序即将退出，请更新.env文件中的COOKIES_STR后重新启动")
+                sys.exit(1)
+
+            try:
+                res_json, response = await self._post_mtop(
+                    TOKEN_URL, 'mtop.taobao.idlemessage.pc.login.token', data_val, spm_cnt='a21ybx.im.0.0'
+                )
+                if self._succeeded(res_json):
+                    logger.info("Token获取成功")
+                    return res_json
+
+                if not isinstance(res_json, dict):
+                    logger.error(f"Token API返回格式异常: {res_json}")
+                    delay = 0
+                else:
+                    ret_value = res_json.get('ret', [])
+                    if any('RGV587_ERROR::SM' in str(ret) for ret in ret_value):
+                        delay = random.uniform(5, 15) + attempt * 5  # 防护机制延时更长
+                        logger.warning(f"触发防护机制，等待 {delay:.1f} 秒后重试...")
+                    else:
+                        delay = random.uniform(2, 4) + attempt * 2
+                        logger.warning(f"Token API调用失败，错误信息: {ret_value}")
+                    if 'set-cookie' in response.headers:
+                        logger.debug("检测到Set-Cookie，更新cookie")
+                        self._save_cookies()
+            except Exception as e:
+                logger.error(f"Token API请求异常: {str(e)}")
+                delay = 0.5
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get_item_info(self, item_id: str, max_retries: int = 3):
+        """获取商品信息，自动处理token失效的情况"""
+        if self.client is None:
+            return await asyncio.to_thread(self.sync_api.get_item_info, item_id)
+
+        data_val = item_data(item_id)
+        for attempt in range(max_retries):
+            try:
+                res_json, response = await self._post_mtop(
+                    ITEM_URL, 'mtop.taobao.idle.pc.detail', data_val, spm_cnt='a21ybx.im.0.0'
+                )
+                if self._succeeded(res_json):
+                    logger.debug(f"商品信息获取成功: {item_id}")
+                    return res_json
+
+                if isinstance(res_json, dict):
+                    logger.warning(f"商品信息API调用失败，错误信息: {res_json.get('ret', [])}")
+                    if 'set-cookie' in response.headers:
+                        logger.debug("检测到Set-Cookie，更新cookie")
+                        self._save_cookies()
+                else:
+                    logger.error(f"商品信息API返回格式异常: {res_json}")
+            except Exception as e:
+                logger.error(f"商品信息API请求异常: {str(e)}")
+            await asyncio.sleep(0.5)
+
+        logger.error("获取商品信息失败，重试次数过多")
+        return {"error": "获取商品信息失败，重试次数过多"}
+
+    async def get_user_items(self, page: int = 1, page_size: int = 20, max_retries: int = 3):
+        """获取用户发布的商品列表（参数与返回值同XianyuApis.get_user_items）"""
+        if self.client is None:
+            return await asyncio.to_thread(self.sync_api.get_user_items, page, page_size)
+
+        user_id = self._cookie('unb')
+        if not user_id:
+            logger.error("无法获取userId，请检查Cookie配置")
+            return {"error": "无法获取userId"}
+
+        data_val = item_list_data(user_id, page, page_size)
+        for attempt in range(max_retries):
+            try:
+                res_json, response = await self._post_mtop(ITEM_LIST_URL, 'mtop.idle.web.xyh.item.list', data_val)
+                if self._succeeded(res_json, 'SUCCESS'):
+                    logger.debug(f"用户商品列表获取成功，页码: {page}")
+                    return res_json
+
+                if isinstance(res_json, dict):
+                    logger.warning(f"用户商品列表API调用失败，错误信息: {res_json.get('ret', [])}")
+                    if 'set-cookie' in response.headers:
+                        logger.debug("检测到Set-Cookie，更新cookie")
+                        self._save_cookies()
+                else:
+                    logger.error(f"用户商品列表API返回格式异常: {res_json}")
+            except Exception as e:
+                logger.error(f"用户商品列表API请求异常: {str(e)}")
+            await asyncio.sleep(random.uniform(1, 3))
+
+        logger.error("获取用户商品列表失败，重试次数过多")
+        return {"error": "获取用户商品列表失败，重试次数过多"}
+
+    async def aclose(self):
+        """关闭连接池"""
+        if self.client is not None:
+            await self.client.aclose()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+会话消息分发器
+同一会话内消息严格有序，不同会话之间并发处理
+"""
+
+import os
+import asyncio
+from loguru import logger
+
+
+class ChatDispatcher:
+    """
+    会话消息分发器
+
+    每个会话(chat_id)拥有独立的FIFO队列和一个工作协程，同一会话内的消息严格按到达顺序处理；
+    不同会话之间并发处理，总并发数受信号量限制。队列空闲超时后工作协程自动退出并回收队列，
+    保证大量买家时内存占用有界。
+    """
+
+    def __init__(self, max_concurrency=None, idle_timeout=None):
+        """
+        初始化分发器
+
+        Args:
+            max_concurrency: 最大并发处理的会话数，默认读取MAX_CONCURRENT_CHATS
+            idle_timeout: 会话队列空闲回收时间（秒），默认读取CHAT_QUEUE_IDLE_TIMEOUT
+        """
+        self.max_concurrency = max_concurrency or int(os.getenv("MAX_CONCURRENT_CHATS", "8"))
+        self.idle_timeout = idle_timeout or float(os.getenv("CHAT_QUEUE_IDLE_TIMEOUT", "60"))
+
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._queues = {}   # chat_id -> asyncio.Queue
+        self._workers = {}  # chat_id -> asyncio.Task
+
+    def submit(self, chat_id, handler, *args):
+        """
+        提交一个会话任务，立即返回
+
+        Args:
+            chat_id: 会话ID，决定任务所在的有序队列
+            handler: 协程函数
+            *args: 传给handler的参数
+        """
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._queues[chat_id] = queue
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id, queue))
+        queue.put_nowait((handler, args))
+
+    async def _worker(self, chat_id, queue):
+        """单个会话的工作协程，按顺序消费队列"""
+        try:
+            while True:
+                try:
+                    handler, args = await asyncio.wait_for(queue.get(), timeout=self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        break
+                    continue
+
+                try:
+                    async with self._semaphore:
+                        await handler(*args)
+                except Exception as e:
+                    logger.error(f"会话 {chat_id} 任务处理出错: {e}")
+                finally:
+                    queue.task_done()
+        finally:
+            # 回收空闲队列（只回收属于自己的队列）
+            if self._queues.get(chat_id) is queue:
+                del self._queues[chat_id]
+                self._workers.pop(chat_id, None)
+
+    def get_stats(self):
+        """获取分发器状态"""
+        return {
+            'active_chats': len(self._queues),
+            'pending_tasks': sum(queue.qsize() for queue in self._queues.values()),
+            'max_concurrency': self.max_concurrency
+        }
+
+    async def join(self):
+        """等待已提交的任务全部处理完成"""
+        await asyncio.gather(*(queue.join() for queue in list(self._queues.values())))
+
+    async def close(self):
+        """取消所有会话工作协程"""
+        workers = list(self._workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._queues.clear()
+        self._workers.clear()
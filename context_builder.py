@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+对话上下文构建器
+按Token预算组装对话历史：最近的消息保留原文，更早的消息由滚动摘要替代
+"""
+
+import os
+import re
+import hashlib
+from typing import Dict, List, Optional, Tuple
+from loguru import logger
+
+
+# 中文字符及全角标点
+_CJK_RE = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+
+# 摘要指纹覆盖的消息条数，避免"好的"之类的重复消息误判
+FINGERPRINT_SPAN = 3
+
+SUMMARY_PROMPT = (
+    "你是闲鱼卖家的对话记录员。请把【已有摘要】和【新增对话】合并成一段新的摘要，"
+    "保留买家的需求和关注点、双方报价及议价进展、已经达成的约定和尚未解决的问题。"
+    "不超过200字，只输出摘要内容。"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算Token数：中文字符按1个计，其余字符按4个计1个"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """按估算的Token数截断文本（保留开头）"""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep = max(int(len(text) * max_tokens / tokens) - 1, 0)
+    return text[:keep] + "…"
+
+
+def _fingerprint(messages: List[Dict]) -> str:
+    """计算一段消息的指纹"""
+    digest = hashlib.md5()
+    for msg in messages:
+        digest.update(f"{msg['role']}:{msg['content']}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _format_line(msg: Dict) -> str:
+    return f"{msg['role']}: {msg['content']}"
+
+
+class ContextBuilder:
+    """
+    对话上下文构建器
+
+    最近recent_turns条消息原文保留，更早的消息由滚动摘要替代。摘要与会话一起保存在
+    ChatContextManager中，记录已覆盖到的最后几条消息的指纹；只有未被摘要覆盖的旧消息
+    累计达到refresh_turns条时才调用大模型重新生成摘要，其余时间直接复用。
+    渲染时按各Agent的Token预算裁剪，优先保留最新的消息。
+    """
+
+    def __init__(self, client, store=None, recent_turns=None, refresh_turns=None):
+        """
+        初始化上下文构建器
+
+        Args:
+            client: OpenAI兼容客户端，用于生成摘要
+            store: 摘要存储（ChatContextManager），为None时不生成摘要，只按预算裁剪
+            recent_turns: 原文保留的最近消息条数，默认读取CONTEXT_RECENT_TURNS
+            refresh_turns: 未覆盖的旧消息达到多少条时刷新摘要，默认读取SUMMARY_REFRESH_TURNS
+        """
+        self.client = client
+        self.store = store
+        self.recent_turns = recent_turns or int(os.getenv("CONTEXT_RECENT_TURNS", "6"))
+        self.refresh_turns = refresh_turns or int(os.getenv("SUMMARY_REFRESH_TURNS", "6"))
+
+        # 各Agent的上下文Token预算，意图分类只需要较短的上下文
+        self.default_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+        self.budgets = {
+            'classify': int(os.getenv("CLASSIFY_CONTEXT_TOKEN_BUDGET", "500")),
+        }
+
+    def prepare(self, chat_id: Optional[str], context: List[Dict]) -> Tuple[str, List[Dict]]:
+        """
+        准备对话历史，每条消息只需调用一次，结果可用于多个Agent的渲染
+
+        Args:
+            chat_id: 会话ID
+            context: 会话的完整上下文（按时间正序）
+
+        Returns:
+            tuple: (早期对话摘要, 需要原文保留的消息列表)
+        """
+        dialog = [msg for msg in context if msg['role'] in ['user', 'assistant']]
+        if len(dialog) <= self.recent_turns:
+            return "", dialog
+
+        older = dialog[:-self.recent_turns]
+        recent = dialog[-self.recent_turns:]
+        summary, pending = self._get_summary(chat_id, older)
+        return summary, pending + recent
+
+    def render(self, history: Tuple[str, List[Dict]], agent: str = 'default') -> str:
+        """
+        按Agent的Token预算渲染对话历史
+
+        Args:
+            history: prepare()的返回值
+            agent: Agent名称，决定使用的Token预算
+
+        Returns:
+            str: 对话历史文本
+        """
+        summary, messages = history
+        budget = self.budgets.get(agent, self.default_budget)
+
+        summary_text = ""
+        if summary:
+            # 摘要最多占预算的三分之一
+            summary_text = _truncate(f"【早期对话摘要】{summary}", budget // 3)
+        remaining = budget - estimate_tokens(summary_text)
+
+        lines = []
+        for msg in reversed(messages):
+            line = _format_line(msg)
+            cost = estimate_tokens(line)
+            if cost > remaining:
+                if not lines:
+                    # 至少保留最新一条
+                    lines.append(_truncate(line, max(remaining, 0)))
+                break
+            lines.append(line)
+            remaining -= cost
+
+        lines.reverse()
+        if summary_text:
+            lines.insert(0, summary_text)
+        return "\n".join(lines)
+
+    def _get_summary(self, chat_id: Optional[str], older: List[Dict]) -> Tuple[str, List[Dict]]:
+        """获取旧消息的摘要，返回 (摘要, 未被摘要覆盖的旧消息)"""
+        if self.store is None or not chat_id:
+            return "", older
+
+        record = self.store.get_summary_by_chat(chat_id)
+        summary = record['summary'] if record else ""
+        covered = self._covered_count(record, older)
+        pending = older[covered:]
+
+        if len(pending) < self.refresh_turns:
+            return summary, pending
+
+        # 摘要已过期：把旧摘要和未覆盖的消息合并成新摘要
+        new_summary = self._summarize(summary, pending)
+        if new_summary is None:
+            return summary, pending
+
+        self.store.save_summary_by_chat(chat_id, new_summary, _fingerprint(older[-FINGERPRINT_SPAN:]))
+        logger.debug(f"会话 {chat_id} 摘要已更新，合并 {len(pending)} 条消息")
+        return new_summary, []
+
+    def _covered_count(self, record: Optional[Dict], older: List[Dict]) -> int:
+        """根据摘要指纹找出旧消息中已被摘要覆盖的条数"""
+        if not record:
+            return 0
+        # 从后往前找，摘要覆盖的位置通常在末尾附近
+        for end in range(len(older), 0, -1):
+            if _fingerprint(older[max(end - FINGERPRINT_SPAN, 0):end]) == record['fingerprint']:
+                return end
+        # 指纹已滑出历史窗口：窗口中的旧消息都比摘要新
+        return 0
+
+    def _summarize(self, previous: str, messages: List[Dict]) -> Optional[str]:
+        """调用大模型生成滚动摘要，失败返回None"""
+        dialog = "\n".join(_format_line(msg) for msg in messages)
+        try:
+            response = self.client.chat.completions.create(
+                model=os.getenv("SUMMARY_MODEL_NAME", os.getenv("MODEL_NAME", "qwen-max")),
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"【已有摘要】{previous or '无'}\n【新增对话】\n{dialog}"}
+                ],
+                temperature=0.3,
+                max_tokens=300
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.error(f"生成对话摘要失败: {e}")
+            return None
@@ -1,8 +1,10 @@
 import os
 import json
+import atexit
+import threading
 from datetime import datetime
 from loguru import logger
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 
 # 尝试导入sqlite3，如果失败则使用文件模式
 try:
@@ -12,6 +14,87 @@ except ImportError:
     SQLITE_AVAILABLE = False
     logger.warning("SQLite不可用，将使用文件模式存储数据")
 
+from utils import serializer
+from utils.sqlite_pool import get_sqlite_pool
+from utils.message_journal import AppendOnlyJournal, atomic_write_json, SNAPSHOT_SEQ_KEY
+from utils.write_buffer import MessageWriteBuffer
+
+
+def _parse_time(value):
+    """解析保存的ISO时间字符串，无法解析时返回None"""
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+class ConversationCache:
+    """
+    最近会话的LRU缓存
+    
+    按会话ID缓存最近的对话（role/content）和议价次数，写入时同步更新（write-through），
+    热点会话的读取不再访问数据库。
+    """
+    
+    def __init__(self, capacity=1000, max_history=100):
+        self.capacity = capacity
+        self.max_history = max_history
+        self._entries = OrderedDict()  # chat_id -> {'messages': deque, 'bargain_count': int}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, chat_id):
+        """获取缓存条目并记录命中情况，未命中返回None"""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(chat_id)
+        return entry
+    
+    def peek(self, chat_id):
+        """获取缓存条目，不影响命中统计和淘汰顺序"""
+        return self._entries.get(chat_id)
+    
+    def put(self, chat_id, messages, bargain_count):
+        """写入缓存条目，超出容量时淘汰最久未使用的会话"""
+        entry = {
+            'messages': deque(messages, maxlen=self.max_history),
+            'bargain_count': bargain_count
+        }
+        self._entries[chat_id] = entry
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+    
+    def append_message(self, chat_id, role, content):
+        """会话已缓存时追加一条消息"""
+        entry = self._entries.get(chat_id)
+        if entry is not None:
+            entry['messages'].append({"role": role, "content": content})
+    
+    def increment_bargain(self, chat_id):
+        """会话已缓存时议价次数加一"""
+        entry = self._entries.get(chat_id)
+        if entry is not None:
+            entry['bargain_count'] += 1
+    
+    def get_stats(self):
+        """获取缓存命中统计"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total * 100, 2) if total > 0 else 0
+        }
+
 
 class ChatContextManager:
     """
@@ -21,7 +104,7 @@ class ChatContextManager:
     支持按会话ID检索对话历史，以及议价次数统计。
     """
     
-    def __init__(self, max_history=100, db_path="data/chat_history.db", force_file_mode=False):
+    def __init__(self, max_history=100, db_path="data/chat_history.db", force_file_mode=False, write_behind=None):
         """
         初始化聊天上下文管理器
         
@@ -29,9 +112,23 @@ class ChatContextManager:
             max_history: 每个对话保留的最大消息数
             db_path: SQLite数据库文件路径或数据目录路径
             force_file_mode: 强制使用文件模式
+            write_behind: 数据库模式下是否批量延迟写入消息，默认读取MESSAGE_WRITE_BEHIND
         """
         self.max_history = max_history
         self.db_path = db_path
+        self.write_buffer = None
+        
+        # 数据库模式下的热点会话缓存
+        self.context_cache = ConversationCache(
+            capacity=int(os.getenv("CONTEXT_CACHE_SIZE", "1000")),
+            max_history=max_history
+        )
+        self._cache_lock = threading.RLock()
+        
+        # 历史裁剪：记录每个会话的消息数，超过 max_history + trim_slack 才批量删除
+        self.trim_slack = int(os.getenv("HISTORY_TRIM_SLACK", "20"))
+        self._history_counts = {}  # chat_id -> 当前消息数（估计值，只会偏大）
+        self._retention_lock = threading.Lock()
         
         # 自动选择存储模式
         self.use_file_mode = force_file_mode or not SQLITE_AVAILABLE
@@ -41,7 +138,19 @@ class ChatContextManager:
             self._init_file_storage()
         else:
             logger.info("使用SQLite数据库存储数据")
+            self.db_pool = get_sqlite_pool(self.db_path)
             self._init_db()
+            
+            if write_behind is None:
+                write_behind = os.getenv("MESSAGE_WRITE_BEHIND", "true").lower() == "true"
+            if write_behind:
+                self.write_buffer = MessageWriteBuffer(
+                    self.db_pool,
+                    self._trim_history,
+                    flush_interval_ms=int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "200")),
+                    batch_size=int(os.getenv("MESSAGE_FLUSH_BATCH_SIZE", "100"))
+                )
+                atexit.register(self.close)
         
     def _init_db(self):
         """初始化数据库表结构"""
@@ -50,7 +159,7 @@ class ChatContextManager:
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
             
-        conn = sqlite3.connect(self.db_path)
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
         
         # 创建消息表
@@ -78,8 +187,13 @@ class ChatContextManager:
         CREATE INDEX IF NOT EXISTS idx_user_item ON messages (user_id, item_id)
         ''')
         
+        # (chat_id, id) 复合索引覆盖按会话读取最近消息和裁剪，取代单列的chat_id索引
         cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_chat_id ON messages (chat_id)
+        CREATE INDEX IF NOT EXISTS idx_chat_id_id ON messages (chat_id, id)
+        ''')
+        
+        cursor.execute('''
+        DROP INDEX IF EXISTS idx_chat_id
         ''')
         
         cursor.execute('''
@@ -106,8 +220,17 @@ class ChatContextManager:
         )
         ''')
         
+        # 创建会话摘要表（早期对话的滚动摘要）
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
         conn.commit()
-        conn.close()
         logger.info(f"聊天历史数据库初始化完成: {self.db_path}")
 
     def _init_file_storage(self):
@@ -126,23 +249,43 @@ class ChatContextManager:
         self.chat_messages = defaultdict(lambda: deque(maxlen=self.max_history))
         self.bargain_counts = defaultdict(int)
         self.item_cache = {}
+        self.chat_summaries = {}
         
         # 数据文件路径
         self.messages_file = os.path.join(self.data_dir, "chat_messages.json")
         self.bargain_file = os.path.join(self.data_dir, "bargain_counts.json") 
         self.items_file = os.path.join(self.data_dir, "item_cache.json")
+        self.summaries_file = os.path.join(self.data_dir, "chat_summaries.json")
+        self.journal_file = os.path.join(self.data_dir, "chat_journal.jsonl")
         
-        # 加载现有数据
-        self._load_file_data()
+        # 消息和议价次数走追加写日志，快照由后台定期合并
+        self.journal = AppendOnlyJournal(
+            self.journal_file,
+            compact_threshold=int(os.getenv("JOURNAL_COMPACT_THRESHOLD", "1000")),
+            compact_interval=float(os.getenv("JOURNAL_COMPACT_INTERVAL", "60"))
+        )
+        
+        # 加载现有数据：快照 + 日志回放
+        messages_seq, bargain_seq = self._load_file_data()
+        self._replay_journal(messages_seq, bargain_seq)
+        self.journal.start_background_compaction(self._capture_snapshot, self._write_snapshot)
+        atexit.register(self.close)
         logger.info(f"文件存储模式初始化完成: {self.data_dir}")
 
     def _load_file_data(self):
-        """从文件加载数据到内存"""
+        """
+        从文件加载数据到内存
+        
+        Returns:
+            tuple: (消息快照已合并的日志序号, 议价快照已合并的日志序号)
+        """
+        messages_seq = bargain_seq = 0
         try:
             # 加载对话历史
             if os.path.exists(self.messages_file):
                 with open(self.messages_file, 'r', encoding='utf-8') as f:
                     messages_data = json.load(f)
+                    messages_seq = messages_data.pop(SNAPSHOT_SEQ_KEY, 0)
                     for chat_id, messages in messages_data.items():
                         self.chat_messages[chat_id] = deque(messages, maxlen=self.max_history)
                 logger.info(f"加载对话历史: {len(messages_data)} 个会话")
@@ -150,7 +293,9 @@ class ChatContextManager:
             # 加载议价统计
             if os.path.exists(self.bargain_file):
                 with open(self.bargain_file, 'r', encoding='utf-8') as f:
-                    self.bargain_counts.update(json.load(f))
+                    bargain_data = json.load(f)
+                    bargain_seq = bargain_data.pop(SNAPSHOT_SEQ_KEY, 0)
+                    self.bargain_counts.update(bargain_data)
                 logger.info(f"加载议价统计: {len(self.bargain_counts)} 个会话")
             
             # 加载商品缓存
@@ -158,31 +303,79 @@ class ChatContextManager:
                 with open(self.items_file, 'r', encoding='utf-8') as f:
                     self.item_cache.update(json.load(f))
                 logger.info(f"加载商品缓存: {len(self.item_cache)} 个商品")
+            
+            # 加载会话摘要
+            if os.path.exists(self.summaries_file):
+                with open(self.summaries_file, 'r', encoding='utf-8') as f:
+                    self.chat_summaries.update(json.load(f))
+                logger.info(f"加载会话摘要: {len(self.chat_summaries)} 个会话")
                 
         except Exception as e:
             logger.warning(f"加载数据文件失败: {e}")
+        
+        return messages_seq, bargain_seq
+
+    def _replay_journal(self, messages_seq, bargain_seq):
+        """
+        回放快照之后的日志记录
+
+        两个快照分别写入，合并时可能在两次写入之间崩溃，因此按各自的序号过滤：
+        消息追加不是幂等的，已在消息快照中的记录不能再次回放
+        """
+        replayed = 0
+        for record in self.journal.replay(min(messages_seq, bargain_seq)):
+            chat_id = record.get('chat_id')
+            seq = record.get('seq', 0)
+            if record.get('type') == 'message' and seq > messages_seq:
+                self.chat_messages[chat_id].append(record['message'])
+            elif record.get('type') == 'bargain' and seq > bargain_seq:
+                # 议价记录保存的是绝对值，重复回放结果不变
+                self.bargain_counts[chat_id] = record['count']
+            else:
+                continue
+            replayed += 1
+        if replayed:
+            logger.info(f"回放日志记录: {replayed} 条")
+
+    def _capture_snapshot(self):
+        """拷贝当前消息和议价状态（在日志锁内调用）"""
+        messages_data = {chat_id: list(messages) for chat_id, messages in self.chat_messages.items()}
+        return messages_data, dict(self.bargain_counts)
+
+    def _write_snapshot(self, state, seq):
+        """原子写入消息和议价快照"""
+        messages_data, bargain_data = state
+        messages_data[SNAPSHOT_SEQ_KEY] = seq
+        bargain_data[SNAPSHOT_SEQ_KEY] = seq
+        atomic_write_json(self.messages_file, messages_data)
+        atomic_write_json(self.bargain_file, bargain_data)
+
+    def close(self):
+        """关闭存储：文件模式下合并日志生成最终快照，数据库模式下写入缓冲中的消息"""
+        if self.use_file_mode:
+            self.journal.close(self._capture_snapshot, self._write_snapshot)
+        elif self.write_buffer:
+            self.write_buffer.close()
+
+    def flush(self):
+        """立即写入缓冲中尚未落库的消息"""
+        if self.write_buffer:
+            self.write_buffer.flush()
 
     def _save_file_data(self, data_type='all'):
         """保存数据到文件"""
         try:
-            if data_type in ['all', 'messages']:
-                # 保存对话历史
-                messages_data = {}
-                for chat_id, messages in self.chat_messages.items():
-                    messages_data[chat_id] = list(messages)
-                
-                with open(self.messages_file, 'w', encoding='utf-8') as f:
-                    json.dump(messages_data, f, ensure_ascii=False, indent=2)
-            
-            if data_type in ['all', 'bargain']:
-                # 保存议价统计
-                with open(self.bargain_file, 'w', encoding='utf-8') as f:
-                    json.dump(dict(self.bargain_counts), f, ensure_ascii=False, indent=2)
+            if data_type in ['all', 'messages', 'bargain']:
+                # 对话历史和议价统计通过合并日志写入快照
+                self.journal.compact(self._capture_snapshot, self._write_snapshot)
             
             if data_type in ['all', 'items']:
                 # 保存商品缓存
-                with open(self.items_file, 'w', encoding='utf-8') as f:
-                    json.dump(self.item_cache, f, ensure_ascii=False, indent=2)
+                atomic_write_json(self.items_file, self.item_cache)
+            
+            if data_type in ['all', 'summaries']:
+                # 保存会话摘要
+                atomic_write_json(self.summaries_file, self.chat_summaries)
                     
         except Exception as e:
             logger.error(f"保存数据文件失败: {e}")
@@ -233,7 +426,9 @@ class ChatContextManager:
     
     def _get_all_conversations_db_mode(self, limit=50):
         """数据库模式：获取所有会话列表"""
-        conn = sqlite3.connect(self.db_path)
+        # 先写入缓冲中的消息，保证统计结果完整
+        self.flush()
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
         
         try:
@@ -265,8 +460,6 @@ class ChatContextManager:
         except Exception as e:
             logger.error(f"获取会话列表时出错: {e}")
             return []
-        finally:
-            conn.close()
     
     def get_conversation_detail(self, chat_id):
         """
@@ -316,7 +509,9 @@ class ChatContextManager:
     
     def _get_conversation_detail_db_mode(self, chat_id):
         """数据库模式：获取会话详情"""
-        conn = sqlite3.connect(self.db_path)
+        # 先写入缓冲中的消息，保证统计结果完整
+        self.flush()
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
         
         try:
@@ -355,8 +550,6 @@ class ChatContextManager:
         except Exception as e:
             logger.error(f"获取会话详情时出错: {e}")
             return None
-        finally:
-            conn.close()
     
     def get_stats(self):
         """
@@ -386,7 +579,9 @@ class ChatContextManager:
     
     def _get_stats_db_mode(self):
         """数据库模式：获取统计信息"""
-        conn = sqlite3.connect(self.db_path)
+        # 先写入缓冲中的消息，保证统计结果完整
+        self.flush()
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
         
         try:
@@ -410,7 +605,8 @@ class ChatContextManager:
                 'total_conversations': total_conversations,
                 'total_messages': total_messages,
                 'cached_items': cached_items,
-                'active_bargains': active_bargains
+                'active_bargains': active_bargains,
+                'context_cache': self.get_cache_stats()
             }
         except Exception as e:
             logger.error(f"获取统计信息时出错: {e}")
@@ -420,8 +616,6 @@ class ChatContextManager:
                 'cached_items': 0,
                 'active_bargains': 0
             }
-        finally:
-            conn.close()
             
     def save_item_info(self, item_id, item_data):
         """
@@ -444,7 +638,7 @@ class ChatContextManager:
             logger.debug(f"缓存商品信息: {item_id}")
             self._save_file_data('items')
         else:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
             
             try:
@@ -453,7 +647,7 @@ class ChatContextManager:
                 description = item_data.get('desc', '')
                 
                 # 将整个商品数据转换为JSON字符串
-                data_json = json.dumps(item_data, ensure_ascii=False)
+                data_json = serializer.dumps(item_data)
                 
                 cursor.execute(
                     """
@@ -473,8 +667,6 @@ class ChatContextManager:
             except Exception as e:
                 logger.error(f"保存商品信息时出错: {e}")
                 conn.rollback()
-            finally:
-                conn.close()
     
     def get_item_info(self, item_id):
         """
@@ -489,7 +681,7 @@ class ChatContextManager:
         if self.use_file_mode:
             return self.item_cache.get(item_id)
         else:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
             
             try:
@@ -500,13 +692,122 @@ class ChatContextManager:
                 
                 result = cursor.fetchone()
                 if result:
-                    return json.loads(result[0])
+                    return serializer.loads(result[0])
                 return None
             except Exception as e:
                 logger.error(f"获取商品信息时出错: {e}")
                 return None
-            finally:
-                conn.close()
+
+    def get_item_record(self, item_id):
+        """
+        获取商品信息及其最后更新时间，用于判断缓存是否过期
+        
+        Args:
+            item_id: 商品ID
+            
+        Returns:
+            tuple: (商品信息字典, 最后更新时间datetime)，不存在时返回(None, None)
+        """
+        if self.use_file_mode:
+            item = self.item_cache.get(item_id)
+            if not item:
+                return None, None
+            return item, _parse_time(item.get('cached_time'))
+        
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT data, last_updated FROM items WHERE item_id = ?",
+                (item_id,)
+            )
+            result = cursor.fetchone()
+            if result:
+                return serializer.loads(result[0]), _parse_time(result[1])
+            return None, None
+        except Exception as e:
+            logger.error(f"获取商品信息时出错: {e}")
+            return None, None
+
+    def save_summary_by_chat(self, chat_id, summary, fingerprint):
+        """
+        保存会话的滚动摘要
+        
+        Args:
+            chat_id: 会话ID
+            summary: 早期对话摘要
+            fingerprint: 摘要覆盖到的最后几条消息的指纹，用于判断摘要是否过期
+        """
+        if self.use_file_mode:
+            # 摘要在回复线程池中生成，多个会话可能同时写入
+            with self.journal.lock:
+                self.chat_summaries[chat_id] = {
+                    "summary": summary,
+                    "fingerprint": fingerprint,
+                    "last_updated": datetime.now().isoformat()
+                }
+                self._save_file_data('summaries')
+        else:
+            conn = self.db_pool.get_connection()
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute(
+                    """
+                    INSERT INTO chat_summaries (chat_id, summary, fingerprint, last_updated)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(chat_id) 
+                    DO UPDATE SET summary = excluded.summary, fingerprint = excluded.fingerprint, 
+                                  last_updated = excluded.last_updated
+                    """,
+                    (chat_id, summary, fingerprint, datetime.now().isoformat())
+                )
+                
+                conn.commit()
+                logger.debug(f"会话摘要已保存: {chat_id}")
+            except Exception as e:
+                logger.error(f"保存会话摘要时出错: {e}")
+                conn.rollback()
+    
+    def get_summary_by_chat(self, chat_id):
+        """
+        获取会话的滚动摘要
+        
+        Args:
+            chat_id: 会话ID
+            
+        Returns:
+            dict: {'summary': 摘要, 'fingerprint': 指纹}，不存在返回None
+        """
+        if self.use_file_mode:
+            return self.chat_summaries.get(chat_id)
+        else:
+            conn = self.db_pool.get_connection()
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute(
+                    "SELECT summary, fingerprint FROM chat_summaries WHERE chat_id = ?",
+                    (chat_id,)
+                )
+                
+                result = cursor.fetchone()
+                if result:
+                    return {"summary": result[0], "fingerprint": result[1]}
+                return None
+            except Exception as e:
+                logger.error(f"获取会话摘要时出错: {e}")
+                return None
+
+    def get_cache_stats(self):
+        """
+        获取会话缓存命中统计
+        
+        Returns:
+            dict: 缓存大小、命中/未命中次数和命中率
+        """
+        with self._cache_lock:
+            return self.context_cache.get_stats()
 
     def add_message_by_chat(self, chat_id, user_id, item_id, role, content):
         """
@@ -522,7 +823,9 @@ class ChatContextManager:
         if self.use_file_mode:
             self._add_message_file_mode(chat_id, user_id, item_id, role, content)
         else:
-            self._add_message_db_mode(chat_id, user_id, item_id, role, content)
+            with self._cache_lock:
+                self._add_message_db_mode(chat_id, user_id, item_id, role, content)
+                self.context_cache.append_message(chat_id, role, content)
 
     def _add_message_file_mode(self, chat_id, user_id, item_id, role, content):
         """文件模式：添加消息"""
@@ -534,12 +837,18 @@ class ChatContextManager:
             "timestamp": datetime.now().isoformat()
         }
         
-        self.chat_messages[chat_id].append(message)
-        self._save_file_data('messages')
+        with self.journal.lock:
+            self.chat_messages[chat_id].append(message)
+            self.journal.append({"type": "message", "chat_id": chat_id, "message": message})
 
     def _add_message_db_mode(self, chat_id, user_id, item_id, role, content):
         """数据库模式：添加消息"""
-        conn = sqlite3.connect(self.db_path)
+        if self.write_buffer:
+            # 写缓冲模式：入队后由后台线程批量写入并裁剪
+            self.write_buffer.add(chat_id, user_id, item_id, role, content, datetime.now().isoformat())
+            return
+        
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
         
         try:
@@ -547,30 +856,53 @@ class ChatContextManager:
                 "INSERT INTO messages (user_id, item_id, role, content, timestamp, chat_id) VALUES (?, ?, ?, ?, ?, ?)",
                 (user_id, item_id, role, content, datetime.now().isoformat(), chat_id)
             )
-            
-            cursor.execute(
-                """
-                SELECT id FROM messages 
-                WHERE chat_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT ?, 1
-                """, 
-                (chat_id, self.max_history)
-            )
-            
-            oldest_to_keep = cursor.fetchone()
-            if oldest_to_keep:
-                cursor.execute(
-                    "DELETE FROM messages WHERE chat_id = ? AND id < ?",
-                    (chat_id, oldest_to_keep[0])
-                )
-            
+            self._trim_history(cursor, {chat_id: 1})
             conn.commit()
         except Exception as e:
             logger.error(f"添加消息到数据库时出错: {e}")
             conn.rollback()
-        finally:
-            conn.close()
+
+    def _trim_history(self, cursor, chat_counts):
+        """
+        增量裁剪会话历史
+        
+        内存中记录每个会话的消息数（首次或裁剪后用COUNT初始化），只有超过 max_history + trim_slack
+        时才执行一次删除，把会话裁剪回最近max_history条，裁剪开销分摊到多次插入上。
+        
+        Args:
+            cursor: 当前事务的游标
+            chat_counts: {chat_id: 本次新插入的消息数}
+        """
+        with self._retention_lock:
+            for chat_id, added in chat_counts.items():
+                count = self._history_counts.get(chat_id)
+                if count is None:
+                    # 同一事务内，COUNT已包含本次插入的消息
+                    cursor.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,))
+                    count = cursor.fetchone()[0]
+                else:
+                    # 事务回滚后重试会重复计数，估计值只会偏大，最多导致提前裁剪
+                    count += added
+                
+                if count > self.max_history + self.trim_slack:
+                    cursor.execute(
+                        """
+                        DELETE FROM messages 
+                        WHERE chat_id = ? AND id <= (
+                            SELECT id FROM messages 
+                            WHERE chat_id = ? 
+                            ORDER BY id DESC 
+                            LIMIT 1 OFFSET ?
+                        )
+                        """,
+                        (chat_id, chat_id, self.max_history)
+                    )
+                    # 删除在调用方提交前可能回滚，此时缓存max_history会偏小；
+                    # 移除计数，下次插入时在其事务内重新COUNT
+                    self._history_counts.pop(chat_id, None)
+                    continue
+                
+                self._history_counts[chat_id] = count
 
     def get_context_by_chat(self, chat_id):
         """
@@ -609,38 +941,59 @@ class ChatContextManager:
         return messages
 
     def _get_context_db_mode(self, chat_id):
-        """数据库模式：获取对话历史"""
-        conn = sqlite3.connect(self.db_path)
+        """数据库模式：获取对话历史（优先读取会话缓存）"""
+        with self._cache_lock:
+            entry = self.context_cache.get(chat_id)
+            if entry is None:
+                entry = self._load_context_db_mode(chat_id)
+                if entry is None:
+                    return []
+            
+            messages = list(entry['messages'])
+            
+            # 添加议价次数到上下文中
+            if entry['bargain_count'] > 0:
+                messages.append({
+                    "role": "system", 
+                    "content": f"议价次数: {entry['bargain_count']}"
+                })
+            
+            return messages
+
+    def _load_context_db_mode(self, chat_id):
+        """从数据库加载会话历史和议价次数并写入缓存，出错时返回None"""
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
         
-        try:
+        def read_messages():
+            # 取最近的max_history条，再按时间正序返回
             cursor.execute(
                 """
-                SELECT role, content FROM messages 
-                WHERE chat_id = ? 
-                ORDER BY timestamp ASC
-                LIMIT ?
+                SELECT role, content FROM (
+                    SELECT id, role, content FROM messages 
+                    WHERE chat_id = ? 
+                    ORDER BY id DESC
+                    LIMIT ?
+                ) ORDER BY id ASC
                 """, 
                 (chat_id, self.max_history)
             )
+            return [{"role": role, "content": content} for role, content in cursor.fetchall()]
+        
+        try:
+            if self.write_buffer:
+                # 合并尚未落库的消息
+                messages = self.write_buffer.read(chat_id, read_messages)[-self.max_history:]
+            else:
+                messages = read_messages()
             
-            messages = [{"role": role, "content": content} for role, content in cursor.fetchall()]
-            
-            # 获取议价次数并添加到上下文中
-            bargain_count = self.get_bargain_count_by_chat(chat_id)
-            if bargain_count > 0:
-                messages.append({
-                    "role": "system", 
-                    "content": f"议价次数: {bargain_count}"
-                })
+            bargain_count = self._get_bargain_count_db_mode(chat_id)
             
         except Exception as e:
             logger.error(f"获取对话历史时出错: {e}")
-            messages = []
-        finally:
-            conn.close()
+            return None
         
-        return messages
+        return self.context_cache.put(chat_id, messages, bargain_count)
 
     def increment_bargain_count_by_chat(self, chat_id):
         """
@@ -650,11 +1003,12 @@ class ChatContextManager:
             chat_id: 会话ID
         """
         if self.use_file_mode:
-            self.bargain_counts[chat_id] += 1
+            with self.journal.lock:
+                self.bargain_counts[chat_id] += 1
+                self.journal.append({"type": "bargain", "chat_id": chat_id, "count": self.bargain_counts[chat_id]})
             logger.debug(f"会话 {chat_id} 议价次数: {self.bargain_counts[chat_id]}")
-            self._save_file_data('bargain')
         else:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
             
             try:
@@ -669,12 +1023,12 @@ class ChatContextManager:
                 )
                 
                 conn.commit()
+                with self._cache_lock:
+                    self.context_cache.increment_bargain(chat_id)
                 logger.debug(f"会话 {chat_id} 议价次数已增加")
             except Exception as e:
                 logger.error(f"增加议价次数时出错: {e}")
                 conn.rollback()
-            finally:
-                conn.close()
 
     def get_bargain_count_by_chat(self, chat_id):
         """
@@ -689,19 +1043,25 @@ class ChatContextManager:
         if self.use_file_mode:
             return self.bargain_counts.get(chat_id, 0)
         else:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self._cache_lock:
+                entry = self.context_cache.peek(chat_id)
+                if entry is not None:
+                    return entry['bargain_count']
+            return self._get_bargain_count_db_mode(chat_id)
+
+    def _get_bargain_count_db_mode(self, chat_id):
+        """数据库模式：查询议价次数"""
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                "SELECT count FROM chat_bargain_counts WHERE chat_id = ?",
+                (chat_id,)
+            )
             
-            try:
-                cursor.execute(
-                    "SELECT count FROM chat_bargain_counts WHERE chat_id = ?",
-                    (chat_id,)
-                )
-                
-                result = cursor.fetchone()
-                return result[0] if result else 0
-            except Exception as e:
-                logger.error(f"获取议价次数时出错: {e}")
-                return 0
-            finally:
-                conn.close() 
\ No newline at end of file
+            result = cursor.fetchone()
+            return result[0] if result else 0
+        except Exception as e:
+            logger.error(f"获取议价次数时出错: {e}")
+            return 0
@@ -6,9 +6,11 @@
 
 import os
 import json
-from datetime import datetime
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from loguru import logger
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional
 
 # 尝试导入sqlite3
 try:
@@ -18,6 +20,9 @@ except ImportError:
     SQLITE_AVAILABLE = False
     logger.warning("SQLite不可用，将使用文件模式存储数据")
 
+from utils.sqlite_pool import get_sqlite_pool
+from utils.message_journal import atomic_write_json
+
 
 class DeliveryManager:
     """
@@ -27,6 +32,9 @@ class DeliveryManager:
     支持网盘链接、卡密、自定义文本等多种发货方式
     """
 
+    # 计入发货统计的最终状态（processing是尚未完成的订单事件占用）
+    COUNTED_STATUSES = ('success', 'failed')
+
     def __init__(self, db_path="data/delivery.db", force_file_mode=False):
         """
         初始化发货管理器
@@ -37,6 +45,16 @@ class DeliveryManager:
         """
         self.db_path = db_path
 
+        # 库存预留：超过该时间仍未确认的预留视为进程崩溃遗留，启动时归还库存
+        self.reservation_timeout = int(os.getenv("STOCK_RESERVATION_TIMEOUT", "600"))
+        # 未单独设置低库存阈值的商品使用的默认阈值
+        self.default_low_stock_threshold = int(os.getenv("LOW_STOCK_THRESHOLD", "5"))
+
+        # 最近处理过的订单事件ID（有界LRU），重放的事件不再访问数据库
+        self.event_cache_size = int(os.getenv("ORDER_EVENT_CACHE_SIZE", "10000"))
+        self._recent_events = OrderedDict()
+        self._events_lock = threading.Lock()
+
         # 自动选择存储模式
         self.use_file_mode = force_file_mode or not SQLITE_AVAILABLE
 
@@ -45,8 +63,12 @@ class DeliveryManager:
             self._init_file_storage()
         else:
             logger.info("发货管理器使用SQLite数据库存储数据")
+            self.db_pool = get_sqlite_pool(self.db_path)
             self._init_db()
 
+        self.release_expired_reservations()
+        self.release_stale_delivery_jobs()
+
     def _init_db(self):
         """初始化数据库表结构"""
         # 确保数据库目录存在
@@ -54,7 +76,7 @@ class DeliveryManager:
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
 
-        conn = sqlite3.connect(self.db_path)
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
 
         # 创建商品发货配置表
@@ -88,27 +110,193 @@ class DeliveryManager:
         )
         ''')
 
+        # 创建库存预留表：预留扣减库存，发货成功后确认，失败时归还
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_id TEXT NOT NULL,
+            buyer_id TEXT,
+            chat_id TEXT,
+            quantity INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'reserved',
+            card_key_id INTEGER,
+            created_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL
+        )
+        ''')
+
+        # 创建卡密库存表：每个卡密只发给一个买家
+        # status: available可用 / allocated已分配 / suspect预留超时、可能已发出，待人工核对
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_keys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_id TEXT NOT NULL,
+            code TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'available',
+            buyer_id TEXT,
+            chat_id TEXT,
+            created_at DATETIME NOT NULL,
+            allocated_at DATETIME,
+            UNIQUE (item_id, code)
+        )
+        ''')
+
+        # 兼容旧数据库：低库存阈值、发货记录和库存预留关联的卡密
+        cursor.execute("PRAGMA table_info(delivery_configs)")
+        if 'low_stock_threshold' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE delivery_configs ADD COLUMN low_stock_threshold INTEGER')
+            logger.info("已为delivery_configs表添加low_stock_threshold字段")
+
+        cursor.execute("PRAGMA table_info(delivery_records)")
+        if 'card_key_id' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE delivery_records ADD COLUMN card_key_id INTEGER')
+            logger.info("已为delivery_records表添加card_key_id字段")
+
+        cursor.execute("PRAGMA table_info(stock_reservations)")
+        if 'card_key_id' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE stock_reservations ADD COLUMN card_key_id INTEGER')
+            logger.info("已为stock_reservations表添加card_key_id字段")
+
+        cursor.execute("PRAGMA table_info(delivery_records)")
+        if 'event_id' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE delivery_records ADD COLUMN event_id TEXT')
+            logger.info("已为delivery_records表添加event_id字段")
+
         # 创建索引
         cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_delivery_item_id ON delivery_configs (item_id)
         ''')
 
+        # 只索引未分配的卡密，分配时按 (item_id, id) 直接定位下一个
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_card_keys_available ON card_keys (item_id, id) WHERE status = 'available'
+        ''')
+
         cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_delivery_records_item ON delivery_records (item_id)
+        CREATE INDEX IF NOT EXISTS idx_stock_reservations_status ON stock_reservations (status, created_at)
         ''')
 
+        # 发货记录按 (delivery_time, id) 倒序分页，按商品/买家筛选时同样走索引
+        # （索引隐含rowid即id，旧的单列索引由复合索引代替）
+        cursor.execute('DROP INDEX IF EXISTS idx_delivery_records_item')
+        cursor.execute('DROP INDEX IF EXISTS idx_delivery_records_buyer')
+
         cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_delivery_records_buyer ON delivery_records (buyer_id)
+        CREATE INDEX IF NOT EXISTS idx_delivery_records_item_time ON delivery_records (item_id, delivery_time)
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_delivery_records_buyer_time ON delivery_records (buyer_id, delivery_time)
         ''')
 
         cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_delivery_records_time ON delivery_records (delivery_time)
         ''')
 
+        # 创建发货任务表：订单事件先入队，由发货工作协程发送，失败后按退避时间重试
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id TEXT UNIQUE,
+            seller_id TEXT NOT NULL DEFAULT '',
+            item_id TEXT NOT NULL,
+            buyer_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_run_at DATETIME NOT NULL,
+            last_error TEXT,
+            created_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_delivery_jobs_status ON delivery_jobs (seller_id, status, next_run_at)
+        ''')
+
+        # 同一订单事件只能有一条发货记录（event_id为NULL的旧记录不受约束）
+        cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_delivery_records_event ON delivery_records (event_id)
+        ''')
+
+        self._init_stats_rollup(cursor)
+
         conn.commit()
-        conn.close()
         logger.info(f"发货数据库初始化完成: {self.db_path}")
 
+    def _init_stats_rollup(self, cursor):
+        """
+        创建按天、按状态汇总的发货统计表，由触发器随发货记录的增删改同步更新，
+        统计接口只读汇总表，与发货记录数量无关
+
+        触发器中不使用INSERT OR IGNORE：外层语句带冲突处理（如record_delivery的UPSERT）时
+        会覆盖触发器内的冲突策略
+        """
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'delivery_stats_daily'")
+        exists = cursor.fetchone() is not None
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_stats_daily (
+            day TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, status)
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_delivery_records_stats_insert
+        AFTER INSERT ON delivery_records
+        BEGIN
+            INSERT INTO delivery_stats_daily (day, status, count)
+            SELECT substr(NEW.delivery_time, 1, 10), NEW.status, 0
+            WHERE NOT EXISTS (
+                SELECT 1 FROM delivery_stats_daily
+                WHERE day = substr(NEW.delivery_time, 1, 10) AND status = NEW.status
+            );
+            UPDATE delivery_stats_daily SET count = count + 1
+            WHERE day = substr(NEW.delivery_time, 1, 10) AND status = NEW.status;
+        END
+        ''')
+
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_delivery_records_stats_update
+        AFTER UPDATE OF status, delivery_time ON delivery_records
+        BEGIN
+            UPDATE delivery_stats_daily SET count = count - 1
+            WHERE day = substr(OLD.delivery_time, 1, 10) AND status = OLD.status;
+            INSERT INTO delivery_stats_daily (day, status, count)
+            SELECT substr(NEW.delivery_time, 1, 10), NEW.status, 0
+            WHERE NOT EXISTS (
+                SELECT 1 FROM delivery_stats_daily
+                WHERE day = substr(NEW.delivery_time, 1, 10) AND status = NEW.status
+            );
+            UPDATE delivery_stats_daily SET count = count + 1
+            WHERE day = substr(NEW.delivery_time, 1, 10) AND status = NEW.status;
+        END
+        ''')
+
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_delivery_records_stats_delete
+        AFTER DELETE ON delivery_records
+        BEGIN
+            UPDATE delivery_stats_daily SET count = count - 1
+            WHERE day = substr(OLD.delivery_time, 1, 10) AND status = OLD.status;
+        END
+        ''')
+
+        if not exists:
+            # 首次创建时汇总已有的发货记录
+            cursor.execute('''
+            INSERT INTO delivery_stats_daily (day, status, count)
+            SELECT substr(delivery_time, 1, 10), status, COUNT(*)
+            FROM delivery_records
+            GROUP BY substr(delivery_time, 1, 10), status
+            ''')
+            if cursor.rowcount > 0:
+                logger.info("已根据现有发货记录生成每日统计")
+
     def _init_file_storage(self):
         """初始化文件存储模式"""
         # 确定数据目录
@@ -124,10 +312,30 @@ class DeliveryManager:
         # 数据文件路径
         self.configs_file = os.path.join(self.data_dir, "delivery_configs.json")
         self.records_file = os.path.join(self.data_dir, "delivery_records.json")
+        self.card_keys_file = os.path.join(self.data_dir, "card_keys.json")
+        self.jobs_file = os.path.join(self.data_dir, "delivery_jobs.json")
 
         # 内存存储结构
         self.configs = {}
         self.records = []
+        self.event_records = {}  # event_id -> 发货记录
+        # 按商品/买家索引的发货记录（按写入顺序），以及按天、按状态的统计
+        self.records_by_item = {}
+        self.records_by_buyer = {}
+        self.stats_daily = {}  # (day, status) -> 数量
+        # 卡密库存：item_id -> {'available': deque[[id, code]], 'allocated': {id: 卡密信息}}
+        self.card_keys = {}
+        self.next_card_key_id = 1
+
+        # 库存预留（仅内存，进程重启后未确认的预留随之失效，库存已在预留时落盘）
+        self.reservations = {}
+        self._next_reservation_id = 1
+        self._stock_lock = threading.Lock()
+
+        # 发货任务：id -> 任务（已完成的任务不保留）
+        self.jobs = {}
+        self._next_job_id = 1
+        self._jobs_lock = threading.Lock()
 
         # 加载现有数据
         self._load_file_data()
@@ -146,21 +354,55 @@ class DeliveryManager:
             if os.path.exists(self.records_file):
                 with open(self.records_file, 'r', encoding='utf-8') as f:
                     self.records = json.load(f)
+                # 旧版本更新记录时不调整顺序，加载时按 (delivery_time, id) 排序
+                self.records.sort(key=lambda r: (r.get('delivery_time') or '', r['id']))
+                self.event_records = {r['event_id']: r for r in self.records if r.get('event_id')}
+                for record in self.records:
+                    self._index_record_file_mode(record)
                 logger.info(f"加载发货记录: {len(self.records)} 条")
 
+            # 加载发货任务
+            if os.path.exists(self.jobs_file):
+                with open(self.jobs_file, 'r', encoding='utf-8') as f:
+                    self.jobs = {job['id']: job for job in json.load(f)}
+                self._next_job_id = max(self.jobs, default=0) + 1
+
+            # 加载卡密库存
+            if os.path.exists(self.card_keys_file):
+                with open(self.card_keys_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.next_card_key_id = data.get('next_id', 1)
+                for item_id, pool in data.get('items', {}).items():
+                    self.card_keys[item_id] = {
+                        'available': deque(pool.get('available', [])),
+                        'allocated': {int(k): v for k, v in pool.get('allocated', {}).items()}
+                    }
+
         except Exception as e:
             logger.warning(f"加载数据文件失败: {e}")
 
     def _save_file_data(self, data_type='all'):
         """保存数据到文件"""
         try:
+            # 先写临时文件再替换，写入中途崩溃不会留下半个文件（库存、卡密随发货频繁改写）
             if data_type in ['all', 'configs']:
-                with open(self.configs_file, 'w', encoding='utf-8') as f:
-                    json.dump(self.configs, f, ensure_ascii=False, indent=2)
+                atomic_write_json(self.configs_file, self.configs)
 
             if data_type in ['all', 'records']:
-                with open(self.records_file, 'w', encoding='utf-8') as f:
-                    json.dump(self.records, f, ensure_ascii=False, indent=2)
+                atomic_write_json(self.records_file, self.records)
+
+            if data_type in ['all', 'jobs']:
+                atomic_write_json(self.jobs_file, list(self.jobs.values()))
+
+            if data_type in ['all', 'card_keys']:
+                data = {
+                    'next_id': self.next_card_key_id,
+                    'items': {
+                        item_id: {'available': list(pool['available']), 'allocated': pool['allocated']}
+                        for item_id, pool in self.card_keys.items()
+                    }
+                }
+                atomic_write_json(self.card_keys_file, data, indent=None)
 
         except Exception as e:
             logger.error(f"保存数据文件失败: {e}")
@@ -179,7 +421,8 @@ class DeliveryManager:
                 - extraction_code: 提取码（可选）
                 - custom_message: 自定义消息模板（可选）
                 - is_enabled: 是否启用自动发货（默认True）
-                - stock_count: 库存数量（默认-1表示无限）
+                - stock_count: 库存数量（默认-1表示无限；已导入卡密的卡密商品以可用卡密数为准）
+                - low_stock_threshold: 低库存提醒阈值（可选，默认使用LOW_STOCK_THRESHOLD）
 
         Returns:
             bool: 是否成功
@@ -200,9 +443,15 @@ class DeliveryManager:
                 'custom_message': config.get('custom_message', ''),
                 'is_enabled': config.get('is_enabled', True),
                 'stock_count': config.get('stock_count', -1),
+                'low_stock_threshold': config.get('low_stock_threshold'),
                 'updated_at': datetime.now().isoformat()
             }
 
+            # 卡密商品的库存由卡密池决定
+            pool = self.card_keys.get(item_id)
+            if self.configs[item_id]['delivery_type'] == 'cardkey' and pool is not None:
+                self.configs[item_id]['stock_count'] = len(pool['available'])
+
             # 添加创建时间（仅首次）
             if 'created_at' not in self.configs[item_id]:
                 self.configs[item_id]['created_at'] = datetime.now().isoformat()
@@ -217,16 +466,38 @@ class DeliveryManager:
 
     def _save_config_db_mode(self, item_id: str, config: Dict) -> bool:
         """数据库模式：保存发货配置"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
 
         try:
+            delivery_type = config.get('delivery_type', 'netdisk')
+            stock_count = config.get('stock_count', -1)
+            if delivery_type == 'cardkey':
+                # 卡密商品的库存由卡密池决定
+                cursor.execute("SELECT 1 FROM card_keys WHERE item_id = ? LIMIT 1", (item_id,))
+                if cursor.fetchone():
+                    cursor.execute(
+                        "SELECT COUNT(*) FROM card_keys WHERE item_id = ? AND status = 'available'",
+                        (item_id,)
+                    )
+                    stock_count = cursor.fetchone()[0]
+
+            values = (
+                delivery_type,
+                config.get('delivery_content', ''),
+                config.get('extraction_code', ''),
+                config.get('custom_message', ''),
+                1 if config.get('is_enabled', True) else 0,
+                stock_count,
+                config.get('low_stock_threshold'),
+                datetime.now().isoformat()
+            )
             cursor.execute(
                 """
                 INSERT INTO delivery_configs
                 (item_id, delivery_type, delivery_content, extraction_code,
-                 custom_message, is_enabled, stock_count, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                 custom_message, is_enabled, stock_count, low_stock_threshold, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ON CONFLICT(item_id)
                 DO UPDATE SET
                     delivery_type = ?,
@@ -235,26 +506,10 @@ class DeliveryManager:
                     custom_message = ?,
                     is_enabled = ?,
                     stock_count = ?,
+                    low_stock_threshold = ?,
                     updated_at = ?
                 """,
-                (
-                    item_id,
-                    config.get('delivery_type', 'netdisk'),
-                    config.get('delivery_content', ''),
-                    config.get('extraction_code', ''),
-                    config.get('custom_message', ''),
-                    1 if config.get('is_enabled', True) else 0,
-                    config.get('stock_count', -1),
-                    datetime.now().isoformat(),
-                    # UPDATE部分
-                    config.get('delivery_type', 'netdisk'),
-                    config.get('delivery_content', ''),
-                    config.get('extraction_code', ''),
-                    config.get('custom_message', ''),
-                    1 if config.get('is_enabled', True) else 0,
-                    config.get('stock_count', -1),
-                    datetime.now().isoformat()
-                )
+                (item_id,) + values + values
             )
 
             conn.commit()
@@ -266,8 +521,6 @@ class DeliveryManager:
             conn.rollback()
             return False
 
-        finally:
-            conn.close()
 
     def get_delivery_config(self, item_id: str) -> Optional[Dict]:
         """
@@ -290,14 +543,15 @@ class DeliveryManager:
 
     def _get_config_db_mode(self, item_id: str) -> Optional[Dict]:
         """数据库模式：获取发货配置"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
 
         try:
             cursor.execute(
                 """
                 SELECT item_id, delivery_type, delivery_content, extraction_code,
-                       custom_message, is_enabled, stock_count, created_at, updated_at
+                       custom_message, is_enabled, stock_count, created_at, updated_at,
+                       low_stock_threshold
                 FROM delivery_configs
                 WHERE item_id = ?
                 """,
@@ -315,7 +569,8 @@ class DeliveryManager:
                     'is_enabled': bool(row[5]),
                     'stock_count': row[6],
                     'created_at': row[7],
-                    'updated_at': row[8]
+                    'updated_at': row[8],
+                    'low_stock_threshold': row[9]
                 }
             return None
 
@@ -323,8 +578,6 @@ class DeliveryManager:
             logger.error(f"获取发货配置失败: {e}")
             return None
 
-        finally:
-            conn.close()
 
     def delete_delivery_config(self, item_id: str) -> bool:
         """
@@ -344,7 +597,7 @@ class DeliveryManager:
                 return True
             return False
         else:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
 
             try:
@@ -358,8 +611,6 @@ class DeliveryManager:
                 conn.rollback()
                 return False
 
-            finally:
-                conn.close()
 
     def list_delivery_configs(self, enabled_only: bool = False) -> List[Dict]:
         """
@@ -377,13 +628,14 @@ class DeliveryManager:
                 configs = [c for c in configs if c.get('is_enabled', False)]
             return configs
         else:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
 
             try:
                 query = """
                     SELECT item_id, delivery_type, delivery_content, extraction_code,
-                           custom_message, is_enabled, stock_count, created_at, updated_at
+                           custom_message, is_enabled, stock_count, created_at, updated_at,
+                           low_stock_threshold
                     FROM delivery_configs
                 """
                 if enabled_only:
@@ -402,7 +654,8 @@ class DeliveryManager:
                         'is_enabled': bool(row[5]),
                         'stock_count': row[6],
                         'created_at': row[7],
-                        'updated_at': row[8]
+                        'updated_at': row[8],
+                        'low_stock_threshold': row[9]
                     })
 
                 return configs
@@ -411,8 +664,6 @@ class DeliveryManager:
                 logger.error(f"获取发货配置列表失败: {e}")
                 return []
 
-            finally:
-                conn.close()
 
     # ========== 发货记录管理 ==========
 
@@ -430,6 +681,8 @@ class DeliveryManager:
                 - delivery_content: 发货内容
                 - status: 状态 (success/failed)
                 - error_message: 错误信息（可选）
+                - card_key_id: 发出的卡密ID（可选）
+                - event_id: 订单事件ID（可选），已由claim_order_event占用时更新该记录
 
         Returns:
             bool: 是否成功
@@ -452,10 +705,20 @@ class DeliveryManager:
                 'delivery_content': record.get('delivery_content', ''),
                 'delivery_time': datetime.now().isoformat(),
                 'status': record.get('status', 'success'),
-                'error_message': record.get('error_message', '')
+                'error_message': record.get('error_message', ''),
+                'card_key_id': record.get('card_key_id'),
+                'event_id': record.get('event_id')
             }
 
-            self.records.append(delivery_record)
+            claimed = self.event_records.get(delivery_record['event_id'])
+            if claimed is not None:
+                delivery_record['id'] = claimed['id']
+                self._update_record_file_mode(claimed, delivery_record)
+            else:
+                self.records.append(delivery_record)
+                self._index_record_file_mode(delivery_record)
+                if delivery_record['event_id']:
+                    self.event_records[delivery_record['event_id']] = delivery_record
             self._save_file_data('records')
             logger.info(f"发货记录已保存: 商品{record.get('item_id')}, 买家{record.get('buyer_id')}")
             return True
@@ -466,7 +729,7 @@ class DeliveryManager:
 
     def _record_delivery_db_mode(self, record: Dict) -> bool:
         """数据库模式：记录发货"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
 
         try:
@@ -474,8 +737,20 @@ class DeliveryManager:
                 """
                 INSERT INTO delivery_records
                 (order_id, item_id, buyer_id, chat_id, delivery_type,
-                 delivery_content, delivery_time, status, error_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 delivery_content, delivery_time, status, error_message, card_key_id, event_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(event_id)
+                DO UPDATE SET
+                    order_id = excluded.order_id,
+                    item_id = excluded.item_id,
+                    buyer_id = excluded.buyer_id,
+                    chat_id = excluded.chat_id,
+                    delivery_type = excluded.delivery_type,
+                    delivery_content = excluded.delivery_content,
+                    delivery_time = excluded.delivery_time,
+                    status = excluded.status,
+                    error_message = excluded.error_message,
+                    card_key_id = excluded.card_key_id
                 """,
                 (
                     record.get('order_id', ''),
@@ -486,7 +761,9 @@ class DeliveryManager:
                     record.get('delivery_content', ''),
                     datetime.now().isoformat(),
                     record.get('status', 'success'),
-                    record.get('error_message', '')
+                    record.get('error_message', ''),
+                    record.get('card_key_id'),
+                    record.get('event_id')
                 )
             )
 
@@ -499,8 +776,160 @@ class DeliveryManager:
             conn.rollback()
             return False
 
-        finally:
-            conn.close()
+
+    def claim_order_event(self, event_id: str, item_id: str = None, buyer_id: str = None,
+                          chat_id: str = None) -> bool:
+        """
+        占用订单事件，保证同一事件只发货一次
+
+        重连后重复推送的同步包会带来相同的事件：先查内存中的最近事件（O(1)），
+        再写入一条processing状态的发货记录，由event_id唯一索引拒绝重复占用。
+        processing记录超过STOCK_RESERVATION_TIMEOUT仍未完成时视为上次发货中断，允许重新占用。
+
+        Returns:
+            bool: 是否占用成功（False表示重复事件，应跳过）
+        """
+        claimed, _ = self._claim_event(event_id, item_id, buyer_id, chat_id)
+        return claimed
+
+    def claim_and_enqueue_delivery(self, event_id: str, item_id: str, buyer_id: str, chat_id: str,
+                                   seller_id: str = '') -> Optional[int]:
+        """
+        占用订单事件并写入发货任务（一个事务）
+
+        占用记录和任务同时写入，进程在两者之间崩溃时不会留下没有任务的占用，
+        导致订单在占用超时前既不发货也无法重新入队。
+
+        Returns:
+            int: 任务ID，重复事件或该事件已有任务时返回None
+        """
+        _, job_id = self._claim_event(event_id, item_id, buyer_id, chat_id, seller_id, enqueue=True)
+        return job_id
+
+    def _claim_event(self, event_id: str, item_id: str, buyer_id: str, chat_id: str,
+                     seller_id: str = '', enqueue: bool = False):
+        """占用订单事件，enqueue为True时在同一事务中写入发货任务，返回 (是否占用, 任务ID)"""
+        with self._events_lock:
+            if event_id in self._recent_events:
+                self._recent_events.move_to_end(event_id)
+                return False, None
+
+            job_id = None
+            if self.use_file_mode:
+                with self._jobs_lock:
+                    claimed = self._claim_event_file_mode(event_id, item_id, buyer_id, chat_id)
+                    if claimed and enqueue:
+                        job_id = self._insert_job_file_mode(item_id, buyer_id, chat_id, event_id, seller_id)
+            else:
+                conn = self.db_pool.get_connection()
+                cursor = conn.cursor()
+                try:
+                    claimed = self._claim_event_db_mode(cursor, event_id, item_id, buyer_id, chat_id)
+                    if claimed and enqueue:
+                        job_id = self._insert_job_db_mode(cursor, item_id, buyer_id, chat_id, event_id, seller_id)
+                    conn.commit()
+                except Exception as e:
+                    logger.error(f"占用订单事件失败: {e}")
+                    conn.rollback()
+                    return False, None
+
+            self._recent_events[event_id] = True
+            while len(self._recent_events) > self.event_cache_size:
+                self._recent_events.popitem(last=False)
+            return claimed, job_id
+
+    def _claim_event_file_mode(self, event_id: str, item_id: str, buyer_id: str, chat_id: str) -> bool:
+        now = datetime.now()
+        record = self.event_records.get(event_id)
+        if record is not None:
+            expired = (now - timedelta(seconds=self.reservation_timeout)).isoformat()
+            if record['status'] != 'processing' or record['delivery_time'] >= expired:
+                return False
+            self._update_record_file_mode(record, {'delivery_time': now.isoformat()})
+            self._save_file_data('records')
+            logger.warning(f"订单事件{event_id}上次处理未完成，重新处理")
+        else:
+            self._record_delivery_file_mode({
+                'item_id': item_id, 'buyer_id': buyer_id, 'chat_id': chat_id,
+                'status': 'processing', 'event_id': event_id
+            })
+        return True
+
+    def _claim_event_db_mode(self, cursor, event_id: str, item_id: str, buyer_id: str, chat_id: str) -> bool:
+        """写入processing记录或接管超时的processing记录，由调用方提交事务"""
+        now = datetime.now()
+
+        try:
+            cursor.execute(
+                """
+                INSERT INTO delivery_records
+                (item_id, buyer_id, chat_id, delivery_type, delivery_content, delivery_time, status, event_id)
+                VALUES (?, ?, ?, '', '', ?, 'processing', ?)
+                """,
+                (item_id or '', buyer_id or '', chat_id or '', now.isoformat(), event_id)
+            )
+            return True
+        except sqlite3.IntegrityError:
+            pass
+
+        cursor.execute(
+            """
+            UPDATE delivery_records SET delivery_time = ?
+            WHERE event_id = ? AND status = 'processing' AND delivery_time < ?
+            """,
+            (now.isoformat(), event_id, (now - timedelta(seconds=self.reservation_timeout)).isoformat())
+        )
+        claimed = cursor.rowcount == 1
+        if claimed:
+            logger.warning(f"订单事件{event_id}上次处理未完成，重新处理")
+        return claimed
+
+    def _index_record_file_mode(self, record: Dict):
+        """文件模式：把新记录加入商品/买家索引并计入统计"""
+        self.records_by_item.setdefault(record.get('item_id', ''), []).append(record)
+        self.records_by_buyer.setdefault(record.get('buyer_id', ''), []).append(record)
+        self._count_record_file_mode(record, 1)
+
+    def _update_record_file_mode(self, record: Dict, changes: Dict):
+        """
+        文件模式：更新已有记录（占用的订单事件完成或重新占用）
+
+        发货时间随之更新，记录移到各列表末尾，列表保持按 (delivery_time, id) 有序，
+        按天统计也随之移动
+        """
+        self._count_record_file_mode(record, -1)
+        for records in (self.records, self.records_by_item.get(record.get('item_id', ''), []),
+                        self.records_by_buyer.get(record.get('buyer_id', ''), [])):
+            # 被更新的记录通常是最近写入的，从末尾查找
+            for index in range(len(records) - 1, -1, -1):
+                if records[index] is record:
+                    del records[index]
+                    break
+        record.update(changes)
+        self.records.append(record)
+        self._index_record_file_mode(record)
+
+    def _count_record_file_mode(self, record: Dict, delta: int):
+        key = ((record.get('delivery_time') or '')[:10], record.get('status', 'success'))
+        self.stats_daily[key] = self.stats_daily.get(key, 0) + delta
+
+    @staticmethod
+    def encode_records_cursor(record: Dict) -> str:
+        """分页游标：最后一条记录的 delivery_time 和 id"""
+        return f"{record['delivery_time']}|{record['id']}"
+
+    @staticmethod
+    def decode_records_cursor(cursor: str):
+        """
+        解析分页游标
+
+        Raises:
+            ValueError: 游标格式错误
+        """
+        delivery_time, _, record_id = cursor.rpartition('|')
+        if not delivery_time:
+            raise ValueError(f"无效的分页游标: {cursor}")
+        return delivery_time, int(record_id)
 
     def get_delivery_records(self, item_id: str = None, buyer_id: str = None,
                             limit: int = 100) -> List[Dict]:
@@ -515,35 +944,68 @@ class DeliveryManager:
         Returns:
             list: 发货记录列表
         """
-        if self.use_file_mode:
-            return self._get_records_file_mode(item_id, buyer_id, limit)
-        else:
-            return self._get_records_db_mode(item_id, buyer_id, limit)
-
-    def _get_records_file_mode(self, item_id: str, buyer_id: str, limit: int) -> List[Dict]:
-        """文件模式：获取发货记录"""
-        records = self.records.copy()
-
-        # 筛选
-        if item_id:
-            records = [r for r in records if r.get('item_id') == item_id]
-        if buyer_id:
-            records = [r for r in records if r.get('buyer_id') == buyer_id]
+        return self.get_delivery_records_page(item_id, buyer_id, limit)['records']
 
-        # 按时间倒序排序
-        records.sort(key=lambda x: x.get('delivery_time', ''), reverse=True)
+    def get_delivery_records_page(self, item_id: str = None, buyer_id: str = None,
+                                  limit: int = 100, cursor: str = None) -> Dict:
+        """
+        按发货时间倒序分页获取发货记录（键集分页，翻页代价与页码无关）
 
-        return records[:limit]
+        Args:
+            item_id: 商品ID（可选）
+            buyer_id: 买家ID（可选）
+            limit: 每页记录数
+            cursor: 上一页返回的next_cursor，为空时获取第一页
 
-    def _get_records_db_mode(self, item_id: str, buyer_id: str, limit: int) -> List[Dict]:
+        Returns:
+            dict: {'records': 发货记录列表, 'next_cursor': 下一页游标，没有更多记录时为None}
+        """
+        after = self.decode_records_cursor(cursor) if cursor else None
+        if self.use_file_mode:
+            records = self._get_records_file_mode(item_id, buyer_id, limit + 1, after)
+        else:
+            records = self._get_records_db_mode(item_id, buyer_id, limit + 1, after)
+
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = self.encode_records_cursor(records[-1])
+        return {'records': records, 'next_cursor': next_cursor}
+
+    def _get_records_file_mode(self, item_id: str, buyer_id: str, limit: int, after=None) -> List[Dict]:
+        """文件模式：获取发货记录（列表按 (delivery_time, id) 有序，倒序遍历，与数据库模式顺序一致）"""
+        # 从较小的索引开始筛选
+        if item_id and buyer_id:
+            by_item = self.records_by_item.get(item_id, [])
+            by_buyer = self.records_by_buyer.get(buyer_id, [])
+            candidates = by_item if len(by_item) <= len(by_buyer) else by_buyer
+        elif item_id:
+            candidates = self.records_by_item.get(item_id, [])
+        elif buyer_id:
+            candidates = self.records_by_buyer.get(buyer_id, [])
+        else:
+            candidates = self.records
+
+        records = []
+        for record in reversed(candidates):
+            if after is not None and (record['delivery_time'], record['id']) >= after:
+                continue
+            if (item_id and record.get('item_id') != item_id) or (buyer_id and record.get('buyer_id') != buyer_id):
+                continue
+            records.append(dict(record))
+            if len(records) >= limit:
+                break
+        return records
+
+    def _get_records_db_mode(self, item_id: str, buyer_id: str, limit: int, after=None) -> List[Dict]:
         """数据库模式：获取发货记录"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
 
         try:
             query = """
                 SELECT id, order_id, item_id, buyer_id, chat_id, delivery_type,
-                       delivery_content, delivery_time, status, error_message
+                       delivery_content, delivery_time, status, error_message, card_key_id, event_id
                 FROM delivery_records
                 WHERE 1=1
             """
@@ -557,7 +1019,11 @@ class DeliveryManager:
                 query += " AND buyer_id = ?"
                 params.append(buyer_id)
 
-            query += " ORDER BY delivery_time DESC LIMIT ?"
+            if after is not None:
+                query += " AND (delivery_time, id) < (?, ?)"
+                params.extend(after)
+
+            query += " ORDER BY delivery_time DESC, id DESC LIMIT ?"
             params.append(limit)
 
             cursor.execute(query, params)
@@ -574,7 +1040,9 @@ class DeliveryManager:
                     'delivery_content': row[6],
                     'delivery_time': row[7],
                     'status': row[8],
-                    'error_message': row[9]
+                    'error_message': row[9],
+                    'card_key_id': row[10],
+                    'event_id': row[11]
                 })
 
             return records
@@ -583,53 +1051,378 @@ class DeliveryManager:
             logger.error(f"获取发货记录失败: {e}")
             return []
 
-        finally:
-            conn.close()
-
     def get_delivery_stats(self) -> Dict:
         """
-        获取发货统计信息
+        获取发货统计信息（发货数量来自每日统计表，不扫描发货记录，只统计成功和失败）
 
         Returns:
             dict: 统计信息
         """
+        today = datetime.now().strftime('%Y-%m-%d')
+
         if self.use_file_mode:
             total_configs = len(self.configs)
             enabled_configs = len([c for c in self.configs.values() if c.get('is_enabled', False)])
-            total_deliveries = len(self.records)
-            success_deliveries = len([r for r in self.records if r.get('status') == 'success'])
+            by_status = {}
+            today_by_status = {}
+            for (day, status), count in self.stats_daily.items():
+                if status not in self.COUNTED_STATUSES:
+                    continue
+                by_status[status] = by_status.get(status, 0) + count
+                if day == today:
+                    today_by_status[status] = count
         else:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
 
             try:
-                cursor.execute("SELECT COUNT(*) FROM delivery_configs")
-                total_configs = cursor.fetchone()[0]
-
-                cursor.execute("SELECT COUNT(*) FROM delivery_configs WHERE is_enabled = 1")
-                enabled_configs = cursor.fetchone()[0]
+                cursor.execute("SELECT COUNT(*), COALESCE(SUM(is_enabled = 1), 0) FROM delivery_configs")
+                total_configs, enabled_configs = cursor.fetchone()
 
-                cursor.execute("SELECT COUNT(*) FROM delivery_records")
-                total_deliveries = cursor.fetchone()[0]
+                cursor.execute(
+                    "SELECT status, SUM(count) FROM delivery_stats_daily WHERE status IN (?, ?) GROUP BY status",
+                    self.COUNTED_STATUSES
+                )
+                by_status = dict(cursor.fetchall())
 
-                cursor.execute("SELECT COUNT(*) FROM delivery_records WHERE status = 'success'")
-                success_deliveries = cursor.fetchone()[0]
+                cursor.execute(
+                    "SELECT status, count FROM delivery_stats_daily WHERE day = ? AND status IN (?, ?)",
+                    (today,) + self.COUNTED_STATUSES
+                )
+                today_by_status = dict(cursor.fetchall())
 
             except Exception as e:
                 logger.error(f"获取统计信息失败: {e}")
                 return {}
 
-            finally:
-                conn.close()
+        total_deliveries = sum(by_status.values())
+        success_deliveries = by_status.get('success', 0)
 
         return {
             'total_configs': total_configs,
             'enabled_configs': enabled_configs,
             'total_deliveries': total_deliveries,
             'success_deliveries': success_deliveries,
-            'success_rate': round(success_deliveries / total_deliveries * 100, 2) if total_deliveries > 0 else 0
+            'success_rate': round(success_deliveries / total_deliveries * 100, 2) if total_deliveries > 0 else 0,
+            'today_deliveries': sum(today_by_status.values()),
+            'today_success_deliveries': today_by_status.get('success', 0)
+        }
+
+    def get_daily_delivery_stats(self, days: int = 30) -> List[Dict]:
+        """
+        获取最近days天每天的发货数量（处理中的订单事件不计入）
+
+        Returns:
+            list: [{'day': 日期, 'success': 成功数, 'failed': 失败数, 'total': 总数}, ...]，按日期倒序
+        """
+        since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+
+        if self.use_file_mode:
+            rows = [(day, status, count) for (day, status), count in self.stats_daily.items()
+                    if day >= since and status in self.COUNTED_STATUSES]
+        else:
+            conn = self.db_pool.get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "SELECT day, status, count FROM delivery_stats_daily WHERE day >= ? AND status IN (?, ?)",
+                    (since,) + self.COUNTED_STATUSES
+                )
+                rows = cursor.fetchall()
+            except Exception as e:
+                logger.error(f"获取每日发货统计失败: {e}")
+                return []
+
+        daily = {}
+        for day, status, count in rows:
+            entry = daily.setdefault(day, {'day': day, 'success': 0, 'failed': 0, 'total': 0})
+            entry[status] += count
+            entry['total'] += count
+        return sorted(daily.values(), key=lambda e: e['day'], reverse=True)
+
+    # ========== 卡密库存 ==========
+
+    def import_card_keys(self, item_id: str, codes: Iterable[str]) -> Dict:
+        """
+        批量导入卡密（一个事务），重复的卡密自动跳过；卡密商品的库存随之增加
+
+        Args:
+            item_id: 商品ID
+            codes: 卡密列表
+
+        Returns:
+            dict: {'imported': 导入数量, 'duplicates': 重复跳过数量}
+        """
+        codes = [code for code in dict.fromkeys(str(c).strip() for c in codes) if code]
+        now = datetime.now().isoformat()
+
+        if self.use_file_mode:
+            with self._stock_lock:
+                pool = self.card_keys.setdefault(item_id, {'available': deque(), 'allocated': {}})
+                existing = {code for _, code in pool['available']}
+                existing.update(key['code'] for key in pool['allocated'].values())
+                imported = 0
+                for code in codes:
+                    if code in existing:
+                        continue
+                    pool['available'].append([self.next_card_key_id, code])
+                    self.next_card_key_id += 1
+                    imported += 1
+                config = self.configs.get(item_id)
+                if config is not None and config.get('delivery_type') == 'cardkey':
+                    config['stock_count'] = len(pool['available'])
+                    self._save_file_data('configs')
+                self._save_file_data('card_keys')
+        else:
+            conn = self.db_pool.get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1 FROM card_keys WHERE item_id = ? LIMIT 1", (item_id,))
+                first_import = cursor.fetchone() is None
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO card_keys (item_id, code, status, created_at) VALUES (?, ?, 'available', ?)",
+                    [(item_id, code, now) for code in codes]
+                )
+                imported = max(cursor.rowcount, 0)
+                # 首次导入时库存从0开始计数，之后按导入数量增加
+                cursor.execute(
+                    """
+                    UPDATE delivery_configs
+                    SET stock_count = (CASE WHEN ? OR stock_count < 0 THEN 0 ELSE stock_count END) + ?,
+                        updated_at = ?
+                    WHERE item_id = ? AND delivery_type = 'cardkey'
+                    """,
+                    (first_import, imported, now, item_id)
+                )
+                conn.commit()
+            except Exception as e:
+                logger.error(f"导入卡密失败: {e}")
+                conn.rollback()
+                raise
+
+        logger.info(f"商品{item_id}导入卡密 {imported} 个，重复跳过 {len(codes) - imported} 个")
+        return {'imported': imported, 'duplicates': len(codes) - imported}
+
+    def has_card_keys(self, item_id: str) -> bool:
+        """商品是否使用卡密池发货（导入过卡密）"""
+        if self.use_file_mode:
+            return item_id in self.card_keys
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM card_keys WHERE item_id = ? LIMIT 1", (item_id,))
+        return cursor.fetchone() is not None
+
+    def reserve_card_key(self, item_id: str, buyer_id: str = None, chat_id: str = None) -> Optional[Dict]:
+        """
+        为卡密商品预留库存并分配下一个未使用的卡密（一个事务）
+
+        先条件扣减库存取得写锁，再通过部分索引定位下一个可用卡密并带状态条件占用，
+        预留记录关联该卡密。多个进程并发分配时不会发出同一个卡密；发货失败时
+        release_reservation同时归还库存和卡密，不需要单独撤销。
+
+        Returns:
+            dict: {'reservation_id': 预留ID, 'id': 卡密ID, 'code': 卡密}，库存或卡密不足时返回None
+        """
+        now = datetime.now().isoformat()
+
+        if self.use_file_mode:
+            with self._stock_lock:
+                pool = self.card_keys.get(item_id)
+                if not pool or not pool['available']:
+                    return None
+                if not self._take_stock_file_mode(item_id, 1):
+                    return None
+                key_id, code = pool['available'].popleft()
+                pool['allocated'][key_id] = {
+                    'code': code, 'buyer_id': buyer_id, 'chat_id': chat_id, 'allocated_at': now
+                }
+                self._save_file_data('card_keys')
+                reservation_id = self._next_reservation_id
+                self._next_reservation_id += 1
+                self.reservations[reservation_id] = {
+                    'item_id': item_id,
+                    'buyer_id': buyer_id,
+                    'chat_id': chat_id,
+                    'quantity': 1,
+                    'status': 'reserved',
+                    'card_key_id': key_id,
+                    'created_at': now
+                }
+                return {'reservation_id': reservation_id, 'id': key_id, 'code': code}
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            if not self._take_stock_db_mode(cursor, item_id, 1):
+                conn.rollback()
+                return None
+            cursor.execute(
+                "SELECT id, code FROM card_keys WHERE item_id = ? AND status = 'available' ORDER BY id LIMIT 1",
+                (item_id,)
+            )
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute(
+                    """
+                    UPDATE card_keys SET status = 'allocated', buyer_id = ?, chat_id = ?, allocated_at = ?
+                    WHERE id = ? AND status = 'available'
+                    """,
+                    (buyer_id, chat_id, now, row[0])
+                )
+            if row is None or cursor.rowcount != 1:
+                logger.warning(f"商品{item_id}没有可用卡密")
+                conn.rollback()
+                return None
+            cursor.execute(
+                """
+                INSERT INTO stock_reservations
+                (item_id, buyer_id, chat_id, quantity, status, card_key_id, created_at, updated_at)
+                VALUES (?, ?, ?, 1, 'reserved', ?, ?, ?)
+                """,
+                (item_id, buyer_id, chat_id, row[0], now, now)
+            )
+            conn.commit()
+            return {'reservation_id': cursor.lastrowid, 'id': row[0], 'code': row[1]}
+        except Exception as e:
+            logger.error(f"分配卡密失败: {e}")
+            conn.rollback()
+            return None
+
+    def get_card_key_stats(self, item_id: str) -> Dict:
+        """获取商品卡密的可用/已分配/待核对数量"""
+        suspect = 0
+        if self.use_file_mode:
+            pool = self.card_keys.get(item_id, {'available': (), 'allocated': {}})
+            available, allocated = len(pool['available']), len(pool['allocated'])
+        else:
+            conn = self.db_pool.get_connection()
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT status, COUNT(*) FROM card_keys WHERE item_id = ? GROUP BY status",
+                (item_id,)
+            )
+            counts = dict(cursor.fetchall())
+            available, allocated = counts.get('available', 0), counts.get('allocated', 0)
+            suspect = counts.get('suspect', 0)
+
+        return {
+            'item_id': item_id,
+            'available': available,
+            'allocated': allocated,
+            'suspect': suspect,
+            'total': available + allocated + suspect
         }
 
+    def get_suspect_card_keys(self, item_id: str = None) -> List[Dict]:
+        """
+        获取待核对的卡密（超时未确认的卡密预留遗留，文件模式下预留不持久化，不会产生）
+
+        Returns:
+            list: [{'id', 'item_id', 'code', 'buyer_id', 'chat_id', 'allocated_at'}, ...]
+        """
+        if self.use_file_mode:
+            return []
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        query = "SELECT id, item_id, code, buyer_id, chat_id, allocated_at FROM card_keys WHERE status = 'suspect'"
+        params = []
+        if item_id:
+            query += " AND item_id = ?"
+            params.append(item_id)
+        cursor.execute(query + " ORDER BY id", params)
+        return [
+            {'id': row[0], 'item_id': row[1], 'code': row[2], 'buyer_id': row[3],
+             'chat_id': row[4], 'allocated_at': row[5]}
+            for row in cursor.fetchall()
+        ]
+
+    def resolve_suspect_card_key(self, card_key_id: int, sent: bool) -> bool:
+        """
+        人工核对待核对的卡密
+
+        Args:
+            card_key_id: 卡密ID
+            sent: 已经发给买家时为True（标记为已分配），否则放回卡密池并归还库存
+
+        Returns:
+            bool: 卡密是否处于待核对状态
+        """
+        if self.use_file_mode:
+            return False
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            if sent:
+                cursor.execute(
+                    "UPDATE card_keys SET status = 'allocated' WHERE id = ? AND status = 'suspect'",
+                    (card_key_id,)
+                )
+            else:
+                cursor.execute(
+                    """
+                    UPDATE card_keys SET status = 'available', buyer_id = NULL, chat_id = NULL, allocated_at = NULL
+                    WHERE id = ? AND status = 'suspect'
+                    """,
+                    (card_key_id,)
+                )
+            resolved = cursor.rowcount == 1
+            if resolved and not sent:
+                cursor.execute(
+                    """
+                    UPDATE delivery_configs SET stock_count = stock_count + 1, updated_at = ?
+                    WHERE item_id = (SELECT item_id FROM card_keys WHERE id = ?) AND stock_count != -1
+                    """,
+                    (datetime.now().isoformat(), card_key_id)
+                )
+            conn.commit()
+            return resolved
+        except Exception as e:
+            logger.error(f"核对卡密失败: {e}")
+            conn.rollback()
+            return False
+
+    def get_low_stock_items(self) -> List[Dict]:
+        """
+        获取库存不高于低库存阈值的已启用商品（无限库存的商品除外）
+
+        库存计数保存在delivery_configs中，查询只扫描配置表，与卡密数量无关
+        """
+        if self.use_file_mode:
+            items = []
+            for config in self.configs.values():
+                threshold = config.get('low_stock_threshold')
+                if threshold is None:
+                    threshold = self.default_low_stock_threshold
+                stock_count = config.get('stock_count', -1)
+                if config.get('is_enabled', False) and stock_count != -1 and stock_count <= threshold:
+                    items.append({'item_id': config['item_id'], 'stock_count': stock_count,
+                                  'low_stock_threshold': threshold})
+            return items
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT item_id, stock_count, COALESCE(low_stock_threshold, ?) AS threshold
+                FROM delivery_configs
+                WHERE is_enabled = 1 AND stock_count != -1
+                  AND stock_count <= COALESCE(low_stock_threshold, ?)
+                ORDER BY stock_count
+                """,
+                (self.default_low_stock_threshold, self.default_low_stock_threshold)
+            )
+            return [
+                {'item_id': row[0], 'stock_count': row[1], 'low_stock_threshold': row[2]}
+                for row in cursor.fetchall()
+            ]
+        except Exception as e:
+            logger.error(f"获取低库存商品失败: {e}")
+            return []
+
     # ========== 发货消息生成 ==========
 
     def build_delivery_message(self, config: Dict, item_info: Dict = None) -> str:
@@ -679,7 +1472,7 @@ class DeliveryManager:
 
     def check_stock(self, item_id: str) -> bool:
         """
-        检查库存是否充足
+        检查库存是否充足（只读，发货时请使用reserve_stock）
 
         Args:
             item_id: 商品ID
@@ -702,7 +1495,7 @@ class DeliveryManager:
 
     def decrease_stock(self, item_id: str, count: int = 1) -> bool:
         """
-        减少库存
+        减少库存（原子操作，库存不足时不扣减）
 
         Args:
             item_id: 商品ID
@@ -711,21 +1504,606 @@ class DeliveryManager:
         Returns:
             bool: 是否成功
         """
-        config = self.get_delivery_config(item_id)
-        if not config:
+        if self.use_file_mode:
+            with self._stock_lock:
+                return self._take_stock_file_mode(item_id, count)
+
+        conn = self.db_pool.get_connection()
+        try:
+            taken = self._take_stock_db_mode(conn.cursor(), item_id, count)
+            conn.commit()
+            return taken
+        except Exception as e:
+            logger.error(f"减少库存失败: {e}")
+            conn.rollback()
             return False
 
-        stock_count = config.get('stock_count', -1)
+    # ========== 库存预留 ==========
+
+    def reserve_stock(self, item_id: str, count: int = 1, buyer_id: str = None,
+                      chat_id: str = None) -> Optional[int]:
+        """
+        预留库存：在一个事务中条件扣减库存并登记预留
+
+        并发订单通过 stock_count >= count 的条件更新竞争库存，不会超卖。
+        发货成功后调用commit_reservation确认，失败时调用release_reservation归还。
+
+        Args:
+            item_id: 商品ID
+            count: 预留数量
+            buyer_id: 买家ID（可选）
+            chat_id: 会话ID（可选）
+
+        Returns:
+            int: 预留ID，库存不足或商品未配置时返回None
+        """
+        now = datetime.now().isoformat()
+
+        if self.use_file_mode:
+            with self._stock_lock:
+                if not self._take_stock_file_mode(item_id, count):
+                    return None
+                reservation_id = self._next_reservation_id
+                self._next_reservation_id += 1
+                self.reservations[reservation_id] = {
+                    'item_id': item_id,
+                    'buyer_id': buyer_id,
+                    'chat_id': chat_id,
+                    'quantity': count,
+                    'status': 'reserved',
+                    'created_at': now
+                }
+                return reservation_id
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            if not self._take_stock_db_mode(cursor, item_id, count):
+                conn.rollback()
+                return None
+            cursor.execute(
+                """
+                INSERT INTO stock_reservations
+                (item_id, buyer_id, chat_id, quantity, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'reserved', ?, ?)
+                """,
+                (item_id, buyer_id, chat_id, count, now, now)
+            )
+            conn.commit()
+            return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"预留库存失败: {e}")
+            conn.rollback()
+            return None
+
+    def commit_reservation(self, reservation_id: int) -> bool:
+        """
+        确认预留（发货成功），库存已在预留时扣减
+
+        Returns:
+            bool: 预留是否存在且处于预留状态
+        """
+        if self.use_file_mode:
+            with self._stock_lock:
+                reservation = self.reservations.pop(reservation_id, None)
+                return reservation is not None and reservation['status'] == 'reserved'
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "UPDATE stock_reservations SET status = 'committed', updated_at = ? WHERE id = ? AND status = 'reserved'",
+                (datetime.now().isoformat(), reservation_id)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+        except Exception as e:
+            logger.error(f"确认库存预留失败: {e}")
+            conn.rollback()
+            return False
+
+    def release_reservation(self, reservation_id: int) -> bool:
+        """
+        释放预留（发货失败），归还库存和预留关联的卡密
+
+        Returns:
+            bool: 是否归还了库存
+        """
+        if self.use_file_mode:
+            with self._stock_lock:
+                reservation = self.reservations.pop(reservation_id, None)
+                if reservation is None or reservation['status'] != 'reserved':
+                    return False
+                self._return_stock_file_mode(reservation['item_id'], reservation['quantity'])
+                if reservation.get('card_key_id') is not None:
+                    self._return_card_key_file_mode(reservation['item_id'], reservation['card_key_id'])
+                return True
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            released = self._release_db_mode(cursor, reservation_id)
+            conn.commit()
+            return released
+        except Exception as e:
+            logger.error(f"释放库存预留失败: {e}")
+            conn.rollback()
+            return False
+
+    def release_expired_reservations(self, max_age: int = None) -> int:
+        """
+        归还超时未确认的预留（发货过程中进程崩溃遗留）
+
+        Args:
+            max_age: 超时时间（秒），默认使用STOCK_RESERVATION_TIMEOUT
+
+        Returns:
+            int: 归还的预留数
+        """
+        if self.use_file_mode:
+            # 文件模式的预留只在内存中，进程重启时已经清空
+            return 0
+
+        cutoff = (datetime.now() - timedelta(seconds=max_age or self.reservation_timeout)).isoformat()
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT id FROM stock_reservations WHERE status = 'reserved' AND created_at < ?",
+                (cutoff,)
+            )
+            released = 0
+            for (reservation_id,) in cursor.fetchall():
+                released += self._release_db_mode(cursor, reservation_id, expired=True)
+            conn.commit()
+            if released:
+                logger.warning(f"归还 {released} 个超时未确认的库存预留")
+            return released
+        except Exception as e:
+            logger.error(f"归还超时库存预留失败: {e}")
+            conn.rollback()
+            return 0
+
+    def _take_stock_db_mode(self, cursor, item_id: str, count: int) -> bool:
+        """条件扣减库存（-1表示无限库存，不扣减），返回是否成功，由调用方提交事务"""
+        cursor.execute(
+            """
+            UPDATE delivery_configs
+            SET stock_count = CASE WHEN stock_count = -1 THEN -1 ELSE stock_count - ? END
+            WHERE item_id = ? AND (stock_count = -1 OR stock_count >= ?)
+            """,
+            (count, item_id, count)
+        )
+        if cursor.rowcount != 1:
+            logger.warning(f"商品{item_id}库存不足或未配置，需要{count}")
+            return False
+        return True
+
+    def _release_db_mode(self, cursor, reservation_id: int, expired: bool = False) -> bool:
+        """
+        把预留标记为已释放并归还库存和卡密，由调用方提交事务
 
-        # -1表示无限库存，不需要减少
+        超时的卡密预留可能是发送后、确认前进程崩溃遗留的，卡密也许已经发给买家：
+        不放回卡密池，转为suspect状态等待人工核对，库存也不归还
+        """
+        cursor.execute(
+            "UPDATE stock_reservations SET status = 'released', updated_at = ? WHERE id = ? AND status = 'reserved'",
+            (datetime.now().isoformat(), reservation_id)
+        )
+        if cursor.rowcount != 1:
+            return False
+        if expired:
+            cursor.execute(
+                """
+                UPDATE card_keys SET status = 'suspect'
+                WHERE id = (SELECT card_key_id FROM stock_reservations WHERE id = ?) AND status = 'allocated'
+                """,
+                (reservation_id,)
+            )
+            if cursor.rowcount == 1:
+                logger.warning(f"库存预留{reservation_id}超时未确认，关联的卡密可能已发出，转为待核对")
+                return True
+        cursor.execute(
+            """
+            UPDATE delivery_configs SET stock_count = stock_count +
+                (SELECT quantity FROM stock_reservations WHERE id = ?)
+            WHERE item_id = (SELECT item_id FROM stock_reservations WHERE id = ?) AND stock_count != -1
+            """,
+            (reservation_id, reservation_id)
+        )
+        cursor.execute(
+            """
+            UPDATE card_keys SET status = 'available', buyer_id = NULL, chat_id = NULL, allocated_at = NULL
+            WHERE id = (SELECT card_key_id FROM stock_reservations WHERE id = ?) AND status = 'allocated'
+            """,
+            (reservation_id,)
+        )
+        return True
+
+    def _take_stock_file_mode(self, item_id: str, count: int) -> bool:
+        """文件模式：扣减库存，调用方持有_stock_lock"""
+        config = self.configs.get(item_id)
+        if not config:
+            return False
+        stock_count = config.get('stock_count', -1)
         if stock_count == -1:
             return True
-
-        # 检查库存是否充足
         if stock_count < count:
             logger.warning(f"商品{item_id}库存不足: 当前{stock_count}, 需要{count}")
             return False
-
-        # 更新库存
         config['stock_count'] = stock_count - count
-        return self.save_delivery_config(item_id, config)
+        config['updated_at'] = datetime.now().isoformat()
+        self._save_file_data('configs')
+        return True
+
+    def _return_stock_file_mode(self, item_id: str, count: int):
+        """文件模式：归还库存，调用方持有_stock_lock"""
+        config = self.configs.get(item_id)
+        if config and config.get('stock_count', -1) != -1:
+            config['stock_count'] += count
+            config['updated_at'] = datetime.now().isoformat()
+            self._save_file_data('configs')
+
+    def _return_card_key_file_mode(self, item_id: str, card_key_id: int):
+        """文件模式：把已分配的卡密放回可用队列队首，调用方持有_stock_lock"""
+        pool = self.card_keys.get(item_id)
+        key = pool['allocated'].pop(card_key_id, None) if pool else None
+        if key is not None:
+            pool['available'].appendleft([card_key_id, key['code']])
+            self._save_file_data('card_keys')
+
+    # ========== 发货任务队列 ==========
+
+    def enqueue_delivery_job(self, item_id: str, buyer_id: str, chat_id: str, event_id: str = None,
+                             seller_id: str = '') -> Optional[int]:
+        """
+        发货任务入队
+
+        Args:
+            seller_id: 卖家账号ID，多账号共享数据库时只由该账号的连接发送
+
+        Returns:
+            int: 任务ID，同一订单事件已有任务时返回None
+        """
+        if self.use_file_mode:
+            with self._jobs_lock:
+                return self._insert_job_file_mode(item_id, buyer_id, chat_id, event_id, seller_id)
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            job_id = self._insert_job_db_mode(cursor, item_id, buyer_id, chat_id, event_id, seller_id)
+            conn.commit()
+            return job_id
+        except Exception as e:
+            logger.error(f"发货任务入队失败: {e}")
+            conn.rollback()
+            raise
+
+    def _insert_job_file_mode(self, item_id: str, buyer_id: str, chat_id: str, event_id: str,
+                              seller_id: str) -> Optional[int]:
+        """文件模式：写入待发货任务，调用方持有_jobs_lock"""
+        if event_id and any(job['event_id'] == event_id for job in self.jobs.values()):
+            return None
+        now = datetime.now().isoformat()
+        job_id = self._next_job_id
+        self._next_job_id += 1
+        self.jobs[job_id] = {
+            'id': job_id, 'event_id': event_id, 'seller_id': seller_id, 'item_id': item_id, 'buyer_id': buyer_id,
+            'chat_id': chat_id, 'status': 'pending', 'attempts': 0, 'next_run_at': now,
+            'last_error': '', 'created_at': now, 'updated_at': now
+        }
+        self._save_file_data('jobs')
+        return job_id
+
+    def _insert_job_db_mode(self, cursor, item_id: str, buyer_id: str, chat_id: str, event_id: str,
+                            seller_id: str) -> Optional[int]:
+        """写入待发货任务（同一事件已有任务时忽略），由调用方提交事务"""
+        now = datetime.now().isoformat()
+        cursor.execute(
+            """
+            INSERT OR IGNORE INTO delivery_jobs
+            (event_id, seller_id, item_id, buyer_id, chat_id, status, attempts, next_run_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?, ?)
+            """,
+            (event_id, seller_id, item_id, buyer_id, chat_id, now, now, now)
+        )
+        return cursor.lastrowid if cursor.rowcount == 1 else None
+
+    def acquire_delivery_job(self, seller_id: str = '') -> Optional[Dict]:
+        """
+        取出卖家账号一个到期的待发货任务并标记为running（尝试次数加1）
+
+        Returns:
+            dict: 任务信息，没有到期任务时返回None
+        """
+        now = datetime.now().isoformat()
+
+        if self.use_file_mode:
+            with self._jobs_lock:
+                due = [job for job in self.jobs.values()
+                       if job['status'] == 'pending' and job['next_run_at'] <= now
+                       and job.get('seller_id', '') == seller_id]
+                if not due:
+                    return None
+                job = min(due, key=lambda j: j['next_run_at'])
+                job.update(status='running', attempts=job['attempts'] + 1, updated_at=now)
+                self._save_file_data('jobs')
+                return dict(job)
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            # 多个工作协程并发获取时，条件更新保证一个任务只被一个协程取得；
+            # 尝试次数每次获取都会增加，作为版本号条件：查询之后任务被其他协程取走、
+            # 失败并放回队列时，本次更新不会用过期的查询结果取得任务
+            for _ in range(5):
+                cursor.execute(
+                    """
+                    SELECT id, event_id, item_id, buyer_id, chat_id, attempts, created_at
+                    FROM delivery_jobs
+                    WHERE seller_id = ? AND status = 'pending' AND next_run_at <= ?
+                    ORDER BY next_run_at LIMIT 1
+                    """,
+                    (seller_id, now)
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                cursor.execute(
+                    """
+                    UPDATE delivery_jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+                    WHERE id = ? AND status = 'pending' AND attempts = ?
+                    """,
+                    (now, row[0], row[5])
+                )
+                acquired = cursor.rowcount == 1
+                conn.commit()
+                if acquired:
+                    return {
+                        'id': row[0], 'event_id': row[1], 'item_id': row[2], 'buyer_id': row[3],
+                        'chat_id': row[4], 'status': 'running', 'attempts': row[5] + 1, 'created_at': row[6]
+                    }
+            return None
+        except Exception as e:
+            logger.error(f"获取发货任务失败: {e}")
+            conn.rollback()
+            return None
+
+    def complete_delivery_job(self, job_id: int) -> bool:
+        """任务完成（发货成功，或库存不足等无需重试的结果已记录）"""
+        return self._update_delivery_job(job_id, 'done')
+
+    def retry_delivery_job(self, job_id: int, error: str, delay: float) -> bool:
+        """任务失败，delay秒后重试"""
+        next_run_at = (datetime.now() + timedelta(seconds=delay)).isoformat()
+        return self._update_delivery_job(job_id, 'pending', error, next_run_at)
+
+    def dead_letter_delivery_job(self, job_id: int, error: str) -> bool:
+        """任务重试次数用完，转入死信并记录发货失败，等待人工处理"""
+        job = self.get_delivery_job(job_id)
+        if not self._update_delivery_job(job_id, 'dead', error):
+            return False
+        if job:
+            self.record_delivery({
+                'item_id': job['item_id'],
+                'buyer_id': job['buyer_id'],
+                'chat_id': job['chat_id'],
+                'status': 'failed',
+                'error_message': error,
+                'event_id': job['event_id']
+            })
+        return True
+
+    def requeue_delivery_job(self, job_id: int) -> bool:
+        """把死信任务重新放回队列（重新计算尝试次数）"""
+        now = datetime.now().isoformat()
+
+        if self.use_file_mode:
+            with self._jobs_lock:
+                job = self.jobs.get(job_id)
+                if not job or job['status'] != 'dead':
+                    return False
+                job.update(status='pending', attempts=0, next_run_at=now, updated_at=now)
+                self._save_file_data('jobs')
+                return True
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """
+                UPDATE delivery_jobs SET status = 'pending', attempts = 0, next_run_at = ?, updated_at = ?
+                WHERE id = ? AND status = 'dead'
+                """,
+                (now, now, job_id)
+            )
+            requeued = cursor.rowcount == 1
+            conn.commit()
+            return requeued
+        except Exception as e:
+            logger.error(f"重新入队发货任务失败: {e}")
+            conn.rollback()
+            return False
+
+    def release_stale_delivery_jobs(self, max_age: int = None) -> int:
+        """
+        把超时仍处于running状态的任务放回队列（发货过程中进程崩溃遗留）
+
+        Args:
+            max_age: 超时时间（秒），默认使用STOCK_RESERVATION_TIMEOUT
+
+        Returns:
+            int: 放回队列的任务数
+        """
+        now = datetime.now()
+        cutoff = (now - timedelta(seconds=max_age or self.reservation_timeout)).isoformat()
+
+        if self.use_file_mode:
+            with self._jobs_lock:
+                stale = [job for job in self.jobs.values()
+                         if job['status'] == 'running' and job['updated_at'] < cutoff]
+                for job in stale:
+                    job.update(status='pending', next_run_at=now.isoformat(), updated_at=now.isoformat())
+                if stale:
+                    self._save_file_data('jobs')
+                released = len(stale)
+        else:
+            conn = self.db_pool.get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    """
+                    UPDATE delivery_jobs SET status = 'pending', next_run_at = ?, updated_at = ?
+                    WHERE status = 'running' AND updated_at < ?
+                    """,
+                    (now.isoformat(), now.isoformat(), cutoff)
+                )
+                released = cursor.rowcount
+                conn.commit()
+            except Exception as e:
+                logger.error(f"恢复中断的发货任务失败: {e}")
+                conn.rollback()
+                return 0
+
+        if released:
+            logger.warning(f"{released} 个中断的发货任务已重新入队")
+        return released
+
+    def requeue_running_delivery_jobs(self, seller_id: str = '') -> int:
+        """
+        把卖家账号所有running状态的任务放回队列
+
+        只在该账号的发货队列启动、尚未取任务时调用：此时的running任务都是上次进程
+        退出或崩溃时中断的，不必等待STOCK_RESERVATION_TIMEOUT超时
+
+        Returns:
+            int: 放回队列的任务数
+        """
+        now = datetime.now().isoformat()
+
+        if self.use_file_mode:
+            with self._jobs_lock:
+                running = [job for job in self.jobs.values()
+                           if job['status'] == 'running' and job.get('seller_id', '') == seller_id]
+                for job in running:
+                    job.update(status='pending', next_run_at=now, updated_at=now)
+                if running:
+                    self._save_file_data('jobs')
+                requeued = len(running)
+        else:
+            conn = self.db_pool.get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    """
+                    UPDATE delivery_jobs SET status = 'pending', next_run_at = ?, updated_at = ?
+                    WHERE seller_id = ? AND status = 'running'
+                    """,
+                    (now, now, seller_id)
+                )
+                requeued = cursor.rowcount
+                conn.commit()
+            except Exception as e:
+                logger.error(f"恢复中断的发货任务失败: {e}")
+                conn.rollback()
+                return 0
+
+        if requeued:
+            logger.warning(f"{requeued} 个上次中断的发货任务已重新入队")
+        return requeued
+
+    def get_delivery_job(self, job_id: int) -> Optional[Dict]:
+        """获取单个发货任务"""
+        jobs = self.get_delivery_jobs(job_id=job_id)
+        return jobs[0] if jobs else None
+
+    def get_delivery_jobs(self, status: str = None, limit: int = 100, job_id: int = None) -> List[Dict]:
+        """
+        获取发货任务（按创建时间倒序）
+
+        Args:
+            status: 任务状态过滤（pending/running/done/dead）
+            limit: 返回数量限制
+            job_id: 只获取指定任务
+        """
+        if self.use_file_mode:
+            with self._jobs_lock:
+                jobs = [dict(job) for job in self.jobs.values()
+                        if (status is None or job['status'] == status)
+                        and (job_id is None or job['id'] == job_id)]
+            jobs.sort(key=lambda j: j['id'], reverse=True)
+            return jobs[:limit]
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        query = """
+            SELECT id, event_id, item_id, buyer_id, chat_id, status, attempts,
+                   next_run_at, last_error, created_at, updated_at
+            FROM delivery_jobs
+            WHERE 1=1
+        """
+        params = []
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        if job_id is not None:
+            query += " AND id = ?"
+            params.append(job_id)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+
+        try:
+            cursor.execute(query, params)
+            return [
+                {
+                    'id': row[0], 'event_id': row[1], 'item_id': row[2], 'buyer_id': row[3],
+                    'chat_id': row[4], 'status': row[5], 'attempts': row[6], 'next_run_at': row[7],
+                    'last_error': row[8], 'created_at': row[9], 'updated_at': row[10]
+                }
+                for row in cursor.fetchall()
+            ]
+        except Exception as e:
+            logger.error(f"获取发货任务失败: {e}")
+            return []
+
+    def _update_delivery_job(self, job_id: int, status: str, error: str = None,
+                             next_run_at: str = None) -> bool:
+        """更新running任务的状态"""
+        now = datetime.now().isoformat()
+
+        if self.use_file_mode:
+            with self._jobs_lock:
+                job = self.jobs.get(job_id)
+                if not job or job['status'] != 'running':
+                    return False
+                if status == 'done':
+                    del self.jobs[job_id]
+                else:
+                    job.update(status=status, updated_at=now)
+                    if error is not None:
+                        job['last_error'] = error
+                    if next_run_at is not None:
+                        job['next_run_at'] = next_run_at
+                self._save_file_data('jobs')
+                return True
+
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """
+                UPDATE delivery_jobs
+                SET status = ?, last_error = COALESCE(?, last_error),
+                    next_run_at = COALESCE(?, next_run_at), updated_at = ?
+                WHERE id = ? AND status = 'running'
+                """,
+                (status, error, next_run_at, now, job_id)
+            )
+            updated = cursor.rowcount == 1
+            conn.commit()
+            return updated
+        except Exception as e:
+            logger.error(f"更新发货任务失败: {e}")
+            conn.rollback()
+            return False
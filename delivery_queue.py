@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+发货任务队列
+订单事件先写入持久化的发货任务表，由工作协程在聊天处理之外完成发货
+"""
+
+import os
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+
+from loguru import logger
+
+
+class DeliveryJobQueue:
+    """
+    发货任务队列
+
+    - 入队只写一条任务记录，消息处理不等待发货完成，大促时聊天回复延迟不受影响
+    - 工作协程取出到期任务执行，失败后按指数退避重试，重试次数用完转入死信（dead）
+    - 连接断开期间不取任务，重连后立即继续，发送失败的任务不会直接记为发货失败
+    - 任务保存在发货数据库中，进程重启后未完成的任务继续执行
+    """
+
+    # 空闲时检查超时running任务的间隔（秒）
+    STALE_CHECK_INTERVAL = 60
+
+    def __init__(self, store, handler: Callable[[Dict], Awaitable[None]], owner: str = '',
+                 is_ready: Callable[[], bool] = None, workers: int = None,
+                 max_attempts: int = None, retry_base: float = None, retry_max: float = None,
+                 poll_interval: float = None):
+        """
+        Args:
+            store: 任务存储（DeliveryManager）
+            handler: 执行单个任务的协程函数，抛出异常表示需要重试
+            owner: 卖家账号ID，只处理该账号的任务
+            is_ready: 返回当前能否发货（如WebSocket已连接），默认始终可以
+            workers: 工作协程数，默认读取DELIVERY_WORKERS
+            max_attempts: 最大尝试次数，默认读取DELIVERY_MAX_ATTEMPTS
+            retry_base: 首次重试的等待时间（秒），默认读取DELIVERY_RETRY_BASE
+            retry_max: 重试等待时间上限（秒），默认读取DELIVERY_RETRY_MAX
+            poll_interval: 没有任务时检查到期任务的间隔（秒），默认读取DELIVERY_POLL_INTERVAL
+        """
+        self.store = store
+        self.handler = handler
+        self.owner = owner
+        self.is_ready = is_ready or (lambda: True)
+        self.workers = workers or int(os.getenv("DELIVERY_WORKERS", "2"))
+        self.max_attempts = max_attempts or int(os.getenv("DELIVERY_MAX_ATTEMPTS", "5"))
+        self.retry_base = retry_base or float(os.getenv("DELIVERY_RETRY_BASE", "5"))
+        self.retry_max = retry_max or float(os.getenv("DELIVERY_RETRY_MAX", "300"))
+        self.poll_interval = poll_interval or float(os.getenv("DELIVERY_POLL_INTERVAL", "5"))
+
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._next_stale_check = 0.0
+
+    def start(self):
+        """
+        启动工作协程（重复调用无效）
+
+        本账号遗留的running任务是上次退出或崩溃时中断的，先放回队列，工作协程再开始取任务
+        """
+        if self._tasks:
+            return
+        recovery = asyncio.ensure_future(asyncio.to_thread(self.store.requeue_running_delivery_jobs, self.owner))
+        self._next_stale_check = time.monotonic() + self.STALE_CHECK_INTERVAL
+        self._tasks = [asyncio.create_task(self._worker(index, recovery)) for index in range(self.workers)]
+        logger.info(f"发货任务队列已启动: {self.workers} 个工作协程")
+
+    def wake(self):
+        """唤醒空闲的工作协程（新任务入队或连接恢复时调用）"""
+        self._wakeup.set()
+
+    async def enqueue(self, item_id: str, buyer_id: str, chat_id: str, event_id: str = None) -> Optional[int]:
+        """
+        发货任务入队
+
+        Returns:
+            int: 任务ID，同一订单事件已有任务时返回None
+        """
+        job_id = await asyncio.to_thread(
+            self.store.enqueue_delivery_job, item_id, buyer_id, chat_id, event_id, self.owner
+        )
+        if job_id is not None:
+            logger.info(f"发货任务已入队: #{job_id} 商品{item_id}, 买家{buyer_id}")
+            self.wake()
+        return job_id
+
+    def retry_delay(self, attempts: int) -> float:
+        """第attempts次尝试失败后的等待时间"""
+        return min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+
+    async def close(self):
+        """停止工作协程，执行中的任务在下次start时重新入队"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, index: int, recovery: asyncio.Future):
+        await recovery
+        while True:
+            self._wakeup.clear()
+            job = None
+            if self.is_ready():
+                job = await asyncio.to_thread(self.store.acquire_delivery_job, self.owner)
+
+            if job is None:
+                if time.monotonic() >= self._next_stale_check:
+                    # 崩溃遗留的任务和库存预留超时后回收：重启发生在超时之前时，
+                    # 初始化时的检查不会回收，由这里补上
+                    self._next_stale_check = time.monotonic() + self.STALE_CHECK_INTERVAL
+                    await asyncio.to_thread(self.store.release_stale_delivery_jobs)
+                    await asyncio.to_thread(self.store.release_expired_reservations)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run(job)
+
+    async def _run(self, job: Dict):
+        try:
+            await self.handler(job)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            if job['attempts'] >= self.max_attempts:
+                logger.error(f"发货任务 #{job['id']} 第{job['attempts']}次失败，转入死信: {error}")
+                await asyncio.to_thread(self.store.dead_letter_delivery_job, job['id'], error)
+            else:
+                delay = self.retry_delay(job['attempts'])
+                logger.warning(f"发货任务 #{job['id']} 第{job['attempts']}次失败，{delay:.0f}秒后重试: {error}")
+                await asyncio.to_thread(self.store.retry_delivery_job, job['id'], error, delay)
+            return
+
+        await asyncio.to_thread(self.store.complete_delivery_job, job['id'])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+消息帧Base64解码基准测试
+
+对比旧版逐字符清理 + 循环补齐padding与当前快速路径在不同帧大小下的耗时
+"""
+
+import sys
+import os
+import base64
+import random
+import timeit
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.xianyu_utils import _b64decode_frame
+
+
+def legacy_b64decode(data: str) -> bytes:
+    """旧版实现：逐字符过滤后循环补齐padding"""
+    cleaned_data = ''.join(c for c in data if c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
+    while len(cleaned_data) % 4 != 0:
+        cleaned_data += '='
+    return base64.b64decode(cleaned_data)
+
+
+def make_frame(size: int) -> str:
+    """生成指定原始字节数的base64帧（去掉padding，与推送数据一致）"""
+    rng = random.Random(size)
+    raw = bytes(rng.randrange(256) for _ in range(size))
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+def main():
+    print("=" * 60)
+    print("消息帧Base64解码基准测试（单位：微秒/帧）")
+    print("=" * 60)
+    print(f"{'帧大小':>10} {'旧版':>10} {'快速路径':>10} {'含非法字符':>10} {'加速比':>8}")
+
+    for size in (256, 1024, 4096, 16384):
+        frame = make_frame(size)
+        dirty = frame[:len(frame) // 2] + "\n" + frame[len(frame) // 2:]
+        assert _b64decode_frame(frame) == legacy_b64decode(frame)
+        assert _b64decode_frame(dirty) == legacy_b64decode(dirty)
+
+        number = max(20000 // (size // 256), 200)
+        results = []
+        for func, data in ((legacy_b64decode, frame), (_b64decode_frame, frame), (_b64decode_frame, dirty)):
+            best = min(timeit.repeat(lambda: func(data), number=number, repeat=5))
+            results.append(best / number * 1e6)
+
+        legacy, fast, fallback = results
+        print(f"{size:>10} {legacy:>10.1f} {fast:>10.1f} {fallback:>10.1f} {legacy / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
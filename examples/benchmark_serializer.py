@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WebSocket帧JSON序列化基准测试
+
+对比标准库json与orjson在收发典型帧时的吞吐量（帧/秒）
+"""
+
+import sys
+import os
+import base64
+import timeit
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import serializer
+
+
+def make_frames():
+    """构造与main.py中结构一致的帧"""
+    text = serializer.dumps({"contentType": 1, "text": {"text": "您好，这款还有货，今天下单明天就能发出～"}})
+    send_msg = {
+        "lwp": "/r/MessageSend/sendByReceiverScope",
+        "headers": {"mid": "1381718000000000 0"},
+        "body": [
+            {
+                "uuid": "-17180000000001",
+                "cid": "53843938102@goofish",
+                "conversationType": 1,
+                "content": {
+                    "contentType": 101,
+                    "custom": {"type": 1, "data": base64.b64encode(text.encode('utf-8')).decode('utf-8')}
+                },
+                "redPointPolicy": 0,
+                "extension": {"extJson": "{}"},
+                "ctx": {"appVersion": "1.0", "platform": "web"},
+                "mtags": {},
+                "msgReadStatusSetting": 1
+            },
+            {"actualReceivers": ["2200000000@goofish", "1234567890@goofish"]}
+        ]
+    }
+    ack = {"code": 200, "headers": {"mid": "4821718000000000 0", "sid": "abcdef0123456789",
+                                    "app-key": "444e9908a51d1cb236a27862abc769c9", "ua": "Mozilla/5.0", "dt": "j"}}
+    heartbeat = {"lwp": "/!", "headers": {"mid": "9121718000000000 0"}}
+    sync_push = {
+        "lwp": "/s/para",
+        "headers": {"mid": "4821718000000000 0", "sid": "abcdef0123456789", "app-key": "444e9908a51d1cb236a27862abc769c9"},
+        "body": {"syncPushPackage": {"data": [{
+            "bizType": 40,
+            "data": base64.b64encode(os.urandom(600)).decode('ascii').rstrip('='),
+            "objectType": 40000,
+            "streamId": "1718000000000",
+            "syncId": "1718000000000"
+        }]}}
+    }
+    return {"send_msg": send_msg, "ack": ack, "heartbeat": heartbeat}, serializer.dumps(sync_push)
+
+
+def frames_per_second(func, arg, number):
+    best = min(timeit.repeat(lambda: func(arg), number=number, repeat=5))
+    return number / best
+
+
+def main():
+    backends = [("json", serializer._stdlib_dumps, serializer._stdlib_loads)]
+    if serializer.ORJSON_AVAILABLE:
+        backends.append(("orjson", serializer._orjson_dumps, serializer._orjson_loads))
+    else:
+        print("orjson未安装，只测试标准库json（pip install orjson）")
+
+    outbound, inbound = make_frames()
+    number = 20000
+
+    print("=" * 60)
+    print("WebSocket帧JSON序列化基准测试（单位：帧/秒）")
+    print("=" * 60)
+    header = f"{'帧类型':<16}" + "".join(f"{name:>14}" for name, _, _ in backends)
+    print(header)
+
+    rows = [(f"dumps {name}", frame, 0) for name, frame in outbound.items()]
+    rows.append(("loads sync_push", inbound, 1))
+    for label, arg, index in rows:
+        results = []
+        for _, dumps, loads in backends:
+            func = (dumps, loads)[index]
+            results.append(frames_per_second(func, arg, number))
+        line = f"{label:<16}" + "".join(f"{value:>14,.0f}" for value in results)
+        if len(results) == 2:
+            line += f"{results[1] / results[0]:>8.1f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+商品信息缓存
+在items表前增加内存LRU缓存，商品信息按TTL过期并在后台刷新
+"""
+
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from loguru import logger
+
+
+class ItemInfoCache:
+    """
+    商品信息缓存
+
+    读取顺序：内存LRU → items表 → 闲鱼接口。
+    - 过期（超过ttl秒）的商品信息照常返回，同时在后台刷新，价格变化能被及时发现
+    - 同一商品的并发获取合并为一次接口调用（single-flight）
+    - 获取失败的商品在negative_ttl秒内直接返回None，避免反复请求接口
+    """
+
+    def __init__(self, store, fetcher: Callable[[str], Awaitable[Optional[Dict]]],
+                 capacity: int = None, ttl: float = None, negative_ttl: float = None):
+        """
+        Args:
+            store: 持久化存储（ChatContextManager），提供get_item_record/save_item_info
+            fetcher: 从接口获取商品信息的协程函数，失败返回None
+            capacity: 内存缓存的商品数，默认读取ITEM_CACHE_SIZE
+            ttl: 商品信息有效期（秒），默认读取ITEM_CACHE_TTL
+            negative_ttl: 获取失败结果的缓存时间（秒），默认读取ITEM_NEGATIVE_TTL
+        """
+        self.store = store
+        self.fetcher = fetcher
+        self.capacity = capacity or int(os.getenv("ITEM_CACHE_SIZE", "2000"))
+        self.ttl = ttl or float(os.getenv("ITEM_CACHE_TTL", "3600"))
+        self.negative_ttl = negative_ttl or float(os.getenv("ITEM_NEGATIVE_TTL", "60"))
+
+        self._entries = OrderedDict()  # item_id -> (商品信息, 获取时间)
+        self._failures = {}            # item_id -> 失败缓存的过期时间
+        self._inflight = {}            # item_id -> 正在进行的获取任务
+
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+    async def get(self, item_id: str) -> Optional[Dict]:
+        """
+        获取商品信息
+
+        Returns:
+            dict: 商品信息，获取失败返回None
+        """
+        now = time.time()
+        entry = self._entries.get(item_id)
+        if entry is None:
+            entry = self._load_from_store(item_id)
+
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(item_id)
+            item_info, fetched_at = entry
+            if now - fetched_at >= self.ttl and item_id not in self._inflight:
+                # 过期：先返回旧数据，后台刷新
+                logger.debug(f"商品信息已过期，后台刷新: {item_id}")
+                self._start_fetch(item_id)
+            return item_info
+
+        self.misses += 1
+        expires = self._failures.get(item_id)
+        if expires is not None:
+            if now < expires:
+                return None
+            del self._failures[item_id]
+
+        task = self._inflight.get(item_id) or self._start_fetch(item_id)
+        # shield：某个等待者被取消时不影响其他等待者和缓存写入
+        return await asyncio.shield(task)
+
+    async def warm(self, item_id: str) -> Optional[Dict]:
+        """预热：商品信息缺失或过期时等待获取完成（而不是在后台刷新）"""
+        entry = self._entries.get(item_id) or self._load_from_store(item_id)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        task = self._inflight.get(item_id) or self._start_fetch(item_id)
+        return await asyncio.shield(task)
+
+    def put(self, item_id: str, item_info: Dict, persist: bool = True):
+        """写入商品信息（预热等批量获取的场景）"""
+        if persist:
+            self.store.save_item_info(item_id, item_info)
+        self._remember(item_id, item_info, time.time())
+        self._failures.pop(item_id, None)
+
+    def invalidate(self, item_id: str = None):
+        """清除内存缓存，下次读取时从items表重新加载"""
+        if item_id is None:
+            self._entries.clear()
+            self._failures.clear()
+        else:
+            self._entries.pop(item_id, None)
+            self._failures.pop(item_id, None)
+
+    def get_stats(self):
+        """获取缓存统计"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'fetches': self.fetches,
+            'negative': len(self._failures),
+            'inflight': len(self._inflight)
+        }
+
+    def _load_from_store(self, item_id: str):
+        item_info, updated = self.store.get_item_record(item_id)
+        if not item_info:
+            return None
+        # 没有更新时间的旧记录视为已过期
+        fetched_at = updated.timestamp() if updated else 0.0
+        return self._remember(item_id, item_info, fetched_at)
+
+    def _remember(self, item_id: str, item_info: Dict, fetched_at: float):
+        entry = (item_info, fetched_at)
+        self._entries[item_id] = entry
+        self._entries.move_to_end(item_id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        return entry
+
+    def _start_fetch(self, item_id: str) -> asyncio.Task:
+        task = asyncio.create_task(self._fetch(item_id))
+        self._inflight[item_id] = task
+        return task
+
+    async def _fetch(self, item_id: str) -> Optional[Dict]:
+        self.fetches += 1
+        try:
+            logger.info(f"从API获取商品信息: {item_id}")
+            item_info = await self.fetcher(item_id)
+        except Exception as e:
+            logger.error(f"获取商品信息出错: {item_id}, {e}")
+            item_info = None
+        finally:
+            self._inflight.pop(item_id, None)
+
+        if item_info:
+            self.put(item_id, item_info)
+            return item_info
+
+        stale = self._entries.get(item_id)
+        if stale is not None:
+            # 后台刷新失败，保留旧数据，negative_ttl秒后再试
+            self._remember(item_id, stale[0], time.time() - self.ttl + self.negative_ttl)
+            return stale[0]
+
+        self._failures[item_id] = time.time() + self.negative_ttl
+        return None
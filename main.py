@@ -1,34 +1,69 @@
 # -*- coding: utf-8 -*-
 import base64
-import json
 import asyncio
+import hashlib
 import time
 import os
 import websockets
 from loguru import logger
 from dotenv import load_dotenv
-from XianyuApis import XianyuApis
+from XianyuApis import XianyuApis, AsyncXianyuApis
 import sys
+from urllib.parse import parse_qs, urlparse
 
 
-from utils.xianyu_utils import generate_mid, generate_uuid, trans_cookies, generate_device_id, decrypt
+from utils import serializer
+from utils.xianyu_utils import generate_mid, generate_uuid, trans_cookies, generate_device_id, decrypt_to_obj
 from XianyuAgent import XianyuReplyBot
 from context_manager import ChatContextManager
 from delivery_manager import DeliveryManager
 from user_agent_pool import get_ua_pool
+from chat_dispatcher import ChatDispatcher
+from item_cache import ItemInfoCache
+from delivery_queue import DeliveryJobQueue
 
 
 class XianyuLive:
-    def __init__(self, cookies_str):
-        self.xianyu = XianyuApis()
+    def __init__(self, cookies_str, bot=None, context_manager=None, delivery_manager=None, persist_env_cookies=True):
+        """
+        Args:
+            cookies_str: 账号Cookie字符串
+            bot: 回复机器人，未传入时自行创建
+            context_manager: 会话存储，多账号运行时传入共享实例
+            delivery_manager: 发货管理器，多账号运行时传入共享实例
+            persist_env_cookies: Cookie更新后是否写回.env文件
+        """
+        self.xianyu = XianyuApis(persist_env_cookies=persist_env_cookies)
         self.base_url = 'wss://wss-goofish.dingtalk.com/'
         self.cookies_str = cookies_str
         self.cookies = trans_cookies(cookies_str)
         self.xianyu.session.cookies.update(self.cookies)
+        # 事件循环中使用的异步接口（连接池复用，重试不阻塞事件循环）
+        self.xianyu_async = AsyncXianyuApis(self.xianyu)
         self.myid = self.cookies['unb']
         self.device_id = generate_device_id(self.myid)
-        self.context_manager = ChatContextManager()
-        self.delivery_manager = DeliveryManager()
+        self.context_manager = context_manager or ChatContextManager()
+        self.delivery_manager = delivery_manager or DeliveryManager()
+        # 商品信息缓存：内存LRU + items表，过期后台刷新，并发获取合并
+        self.item_cache = ItemInfoCache(self.context_manager, self.fetch_item_info)
+        # 回复机器人（未传入时自行创建）
+        self.bot = bot or self.create_bot()
+        if self.bot is not None and self.bot.context_builder.store is None:
+            # 早期对话摘要与会话历史保存在一起
+            self.bot.context_builder.store = self.context_manager
+        # 会话分发器：同一会话内有序，不同会话并发，读循环不被回复生成阻塞
+        self.dispatcher = ChatDispatcher()
+        # 发货任务队列：只在连接可用时取任务，断线期间的任务在重连后继续发送
+        self.delivery_queue = DeliveryJobQueue(
+            self.delivery_manager, self.run_delivery_job, owner=self.myid,
+            is_ready=lambda: self.ws is not None
+        )
+        
+        # 帧处理函数：按classify_frame的结果分发，心跳等响应帧在dispatch_frame中直接处理
+        self.frame_handlers = {
+            "sync": self.handle_message,
+        }
+        self.order_reminders = {'等待买家付款', '交易关闭', '等待卖家发货'}
 
         # User-Agent 池
         self.ua_pool = get_ua_pool()
@@ -61,6 +96,22 @@ class XianyuLive:
         
         # 人工接管关键词，从环境变量读取
         self.toggle_keywords = os.getenv("TOGGLE_KEYWORDS", "。")
+        
+        # 启动预热：提前加载已发布商品的信息和提示词，首条回复不再等待接口和磁盘
+        self.prewarm_on_startup = os.getenv("PREWARM_ON_STARTUP", "false").lower() == "true"
+        self.prewarm_task = None
+
+    def create_bot(self):
+        """创建回复机器人（分片模式的接入进程不生成回复，覆盖为返回None）"""
+        return XianyuReplyBot(context_manager=self.context_manager)
+
+    async def fetch_item_info(self, item_id):
+        """从API获取商品信息，失败返回None"""
+        api_result = await self.xianyu_async.get_item_info(item_id)
+        if 'data' in api_result and 'itemDO' in api_result['data']:
+            return api_result['data']['itemDO']
+        logger.warning(f"获取商品信息失败: {api_result}")
+        return None
 
     async def refresh_token(self):
         """刷新token"""
@@ -68,7 +119,7 @@ class XianyuLive:
             logger.info("开始刷新token...")
             
             # 获取新token（如果Cookie失效，get_token会直接退出程序）
-            token_result = self.xianyu.get_token(self.device_id)
+            token_result = await self.xianyu_async.get_token(self.device_id)
             if 'data' in token_result and 'accessToken' in token_result['data']:
                 new_token = token_result['data']['accessToken']
                 self.current_token = new_token
@@ -93,7 +144,15 @@ class XianyuLive:
                 if current_time - self.last_token_refresh_time >= self.token_refresh_interval:
                     logger.info("Token即将过期，准备刷新...")
                     
-                    new_token = await self.refresh_token()
+                    try:
+                        new_token = await self.refresh_token()
+                    except SystemExit:
+                        # Cookie已失效：不在后台任务中退出，关闭连接后由主循环重新初始化时处理
+                        self.current_token = None
+                        self.connection_restart_flag = True
+                        if self.ws:
+                            await self.ws.close()
+                        break
                     if new_token:
                         logger.info("Token刷新成功，准备重新建立连接...")
                         # 设置连接重启标志
@@ -121,7 +180,7 @@ class XianyuLive:
                 "text": text
             }
         }
-        text_base64 = str(base64.b64encode(json.dumps(text).encode('utf-8')), 'utf-8')
+        text_base64 = str(base64.b64encode(serializer.dumps(text).encode('utf-8')), 'utf-8')
         msg = {
             "lwp": "/r/MessageSend/sendByReceiverScope",
             "headers": {
@@ -158,7 +217,7 @@ class XianyuLive:
                 }
             ]
         }
-        await ws.send(json.dumps(msg))
+        await ws.send(serializer.dumps(msg))
 
     async def init(self, ws):
         # 如果没有token或者token过期，获取新token
@@ -184,13 +243,13 @@ class XianyuLive:
                 "mid": generate_mid()
             }
         }
-        await ws.send(json.dumps(msg))
+        await ws.send(serializer.dumps(msg))
         # 等待一段时间，确保连接注册完成
         await asyncio.sleep(1)
         msg = {"lwp": "/r/SyncStatus/ackDiff", "headers": {"mid": "5701741704675979 0"}, "body": [
             {"pipeline": "sync", "tooLong2Tag": "PNM,1", "channel": "sync", "topic": "sync", "highPts": 0,
              "pts": int(time.time() * 1000) * 1000, "seq": 0, "timestamp": int(time.time() * 1000)}]}
-        await ws.send(json.dumps(msg))
+        await ws.send(serializer.dumps(msg))
         logger.info('连接注册完成')
 
     def is_chat_message(self, message):
@@ -207,18 +266,71 @@ class XianyuLive:
         except Exception:
             return False
 
-    def is_sync_package(self, message_data):
-        """判断是否为同步包消息"""
-        try:
-            return (
-                isinstance(message_data, dict)
-                and "body" in message_data
-                and "syncPushPackage" in message_data["body"]
-                and "data" in message_data["body"]["syncPushPackage"]
-                and len(message_data["body"]["syncPushPackage"]["data"]) > 0
-            )
-        except Exception:
-            return False
+    def classify_frame(self, message_data):
+        """
+        按帧结构分类，每帧只判断一次
+        
+        Returns:
+            str: response（对本端请求的响应，含心跳）/ sync（同步包）/ push（其他推送）/ unknown
+        """
+        if not isinstance(message_data, dict):
+            return "unknown"
+        if "code" in message_data:
+            return "response"
+        body = message_data.get("body")
+        if isinstance(body, dict):
+            package = body.get("syncPushPackage")
+            if isinstance(package, dict) and package.get("data"):
+                return "sync"
+        return "push"
+
+    def classify_sync_message(self, message, skip_order=False):
+        """
+        对解密后的同步消息分类
+        
+        Returns:
+            str: order（订单状态）/ typing（正在输入）/ chat（聊天消息）/ other
+        """
+        if not isinstance(message, dict):
+            return "other"
+        status = message.get("3")
+        if not skip_order and isinstance(status, dict) and status.get("redReminder") in self.order_reminders:
+            return "order"
+        if self.is_typing_status(message):
+            return "typing"
+        if self.is_chat_message(message):
+            return "chat"
+        return "other"
+
+    async def send_ack(self, websocket, message_data):
+        """为带mid的推送帧发送ACK（每帧一次）"""
+        headers = message_data.get("headers")
+        if not isinstance(headers, dict) or "mid" not in headers:
+            return
+        ack = {
+            "code": 200,
+            "headers": {
+                "mid": headers["mid"],
+                "sid": headers.get("sid", "")
+            }
+        }
+        # 复制其他可能的header字段
+        for key in ("app-key", "ua", "dt"):
+            if key in headers:
+                ack["headers"][key] = headers[key]
+        await websocket.send(serializer.dumps(ack))
+
+    async def dispatch_frame(self, message_data, websocket):
+        """分类帧、发送ACK，并交给对应的处理函数"""
+        kind = self.classify_frame(message_data)
+        if kind == "response":
+            await self.handle_heartbeat_response(message_data)
+            return
+        
+        await self.send_ack(websocket, message_data)
+        handler = self.frame_handlers.get(kind)
+        if handler:
+            await handler(message_data, websocket)
 
     def is_typing_status(self, message):
         """判断是否为用户正在输入状态消息"""
@@ -290,32 +402,8 @@ class XianyuLive:
             return "manual"
 
     async def handle_message(self, message_data, websocket):
-        """处理所有类型的消息"""
+        """处理同步包消息（ACK已由dispatch_frame发送）"""
         try:
-
-            try:
-                message = message_data
-                ack = {
-                    "code": 200,
-                    "headers": {
-                        "mid": message["headers"]["mid"] if "mid" in message["headers"] else generate_mid(),
-                        "sid": message["headers"]["sid"] if "sid" in message["headers"] else '',
-                    }
-                }
-                if 'app-key' in message["headers"]:
-                    ack["headers"]["app-key"] = message["headers"]["app-key"]
-                if 'ua' in message["headers"]:
-                    ack["headers"]["ua"] = message["headers"]["ua"]
-                if 'dt' in message["headers"]:
-                    ack["headers"]["dt"] = message["headers"]["dt"]
-                await websocket.send(json.dumps(ack))
-            except Exception as e:
-                pass
-
-            # 如果不是同步包消息，直接返回
-            if not self.is_sync_package(message_data):
-                return
-
             # 获取并解密数据
             sync_data = message_data["body"]["syncPushPackage"]["data"][0]
             
@@ -329,60 +417,27 @@ class XianyuLive:
                 data = sync_data["data"]
                 try:
                     data = base64.b64decode(data).decode("utf-8")
-                    data = json.loads(data)
+                    data = serializer.loads(data)
                     # logger.info(f"无需解密 message: {data}")
                     return
                 except Exception as e:
                     # logger.info(f'加密数据: {data}')
-                    decrypted_data = decrypt(data)
-                    message = json.loads(decrypted_data)
+                    message = decrypt_to_obj(data)
             except Exception as e:
                 logger.error(f"消息解密失败: {e}")
                 return
 
-            try:
-                # 判断是否为订单消息
-                if message['3']['redReminder'] == '等待买家付款':
-                    user_id = message['1'].split('@')[0]
-                    user_url = f'https://www.goofish.com/personal?userId={user_id}'
-                    logger.info(f'等待买家 {user_url} 付款')
-                    return
-                elif message['3']['redReminder'] == '交易关闭':
-                    user_id = message['1'].split('@')[0]
-                    user_url = f'https://www.goofish.com/personal?userId={user_id}'
-                    logger.info(f'买家 {user_url} 交易关闭')
-                    return
-                elif message['3']['redReminder'] == '等待卖家发货':
-                    # 买家已付款，等待卖家发货 - 触发自动发货
-                    user_id = message['1'].split('@')[0]
-                    user_url = f'https://www.goofish.com/personal?userId={user_id}'
-                    chat_id = message['1']['2'].split('@')[0] if '2' in message['1'] else None
-
-                    # 尝试获取商品ID
-                    item_id = None
-                    if '10' in message['1'] and 'reminderUrl' in message['1']['10']:
-                        url_info = message['1']['10']['reminderUrl']
-                        if "itemId=" in url_info:
-                            item_id = url_info.split("itemId=")[1].split("&")[0]
-
-                    logger.info(f'💰 交易成功 {user_url} 等待卖家发货 - 商品ID: {item_id}')
-
-                    # 自动发货处理
-                    if item_id and chat_id:
-                        await self.handle_auto_delivery(websocket, chat_id, user_id, item_id)
-                    else:
-                        logger.warning(f"无法自动发货：缺少必要信息 (item_id={item_id}, chat_id={chat_id})")
-
+            kind = self.classify_sync_message(message)
+            if kind == "order":
+                if await self.handle_order_message(message, websocket):
                     return
+                # 订单消息解析失败时，按普通消息重新判断
+                kind = self.classify_sync_message(message, skip_order=True)
 
-            except:
-                pass
-
-            # 判断消息类型
-            if self.is_typing_status(message):
+            if kind == "typing":
                 logger.debug("用户正在输入")
                 return
-            elif not self.is_chat_message(message):
+            elif kind != "chat":
                 logger.debug("其他非聊天消息")
                 logger.debug(f"原始消息: {message}")
                 return
@@ -407,6 +462,94 @@ class XianyuLive:
                 logger.warning("无法获取商品ID")
                 return
 
+            event = {
+                'chat_id': chat_id,
+                'item_id': item_id,
+                'send_user_id': send_user_id,
+                'send_user_name': send_user_name,
+                'send_message': send_message,
+                'is_system': self.is_system_message(message)
+            }
+            # 放入会话队列，由分发器按会话顺序处理
+            self.dispatcher.submit(chat_id, self.handle_chat_message, websocket, event)
+            
+        except Exception as e:
+            logger.error(f"处理消息时发生错误: {str(e)}")
+            logger.debug(f"原始消息: {message_data}")
+
+    async def handle_order_message(self, message, websocket):
+        """
+        处理订单状态消息
+        
+        Returns:
+            bool: 是否已处理
+        """
+        try:
+            reminder = message['3']['redReminder']
+            if reminder == '等待买家付款':
+                user_id = message['1'].split('@')[0]
+                user_url = f'https://www.goofish.com/personal?userId={user_id}'
+                logger.info(f'等待买家 {user_url} 付款')
+                return True
+            elif reminder == '交易关闭':
+                user_id = message['1'].split('@')[0]
+                user_url = f'https://www.goofish.com/personal?userId={user_id}'
+                logger.info(f'买家 {user_url} 交易关闭')
+                return True
+            elif reminder == '等待卖家发货':
+                # 买家已付款，等待卖家发货 - 触发自动发货
+                user_id = message['1'].split('@')[0]
+                user_url = f'https://www.goofish.com/personal?userId={user_id}'
+                chat_id = message['1']['2'].split('@')[0] if '2' in message['1'] else None
+
+                # 尝试获取商品ID
+                item_id = None
+                if '10' in message['1'] and 'reminderUrl' in message['1']['10']:
+                    url_info = message['1']['10']['reminderUrl']
+                    if "itemId=" in url_info:
+                        item_id = url_info.split("itemId=")[1].split("&")[0]
+
+                logger.info(f'💰 交易成功 {user_url} 等待卖家发货 - 商品ID: {item_id}')
+
+                # 自动发货：写入发货任务队列，重复推送的事件按事件ID去重
+                if item_id and chat_id:
+                    event_id = self.order_event_id(message, user_id, chat_id, item_id)
+                    await self.enqueue_delivery(chat_id, user_id, item_id, event_id)
+                else:
+                    logger.warning(f"无法自动发货：缺少必要信息 (item_id={item_id}, chat_id={chat_id})")
+
+                return True
+        except Exception:
+            pass
+        return False
+
+    def order_event_id(self, message, buyer_id, chat_id, item_id):
+        """
+        订单事件的确定性ID，同一同步包被重复推送时得到相同的ID
+
+        优先使用提醒链接中的订单号，否则由买家、会话、商品和消息时间生成
+        """
+        body = message.get('1')
+        created = ''
+        if isinstance(body, dict):
+            url_info = (body.get('10') or {}).get('reminderUrl', '')
+            query = parse_qs(urlparse(url_info).query)
+            for key in ('orderId', 'bizOrderId'):
+                if query.get(key):
+                    return f"order:{query[key][0]}"
+            created = body.get('5', '')
+        raw = f"{buyer_id}|{chat_id}|{item_id}|{created}"
+        return "event:" + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    async def handle_chat_message(self, websocket, event):
+        """处理单条聊天消息（同一会话内按顺序调用）"""
+        chat_id = event['chat_id']
+        item_id = event['item_id']
+        send_user_id = event['send_user_id']
+        send_user_name = event['send_user_name']
+        send_message = event['send_message']
+
+        try:
             # 检查是否为卖家（自己）发送的控制命令
             if send_user_id == self.myid:
                 logger.debug("检测到卖家消息，检查是否为控制命令")
@@ -433,38 +576,30 @@ class XianyuLive:
             if self.is_manual_mode(chat_id):
                 logger.info(f"🔴 会话 {chat_id} 处于人工接管模式，跳过自动回复")
                 return
-            if self.is_system_message(message):
+            if event['is_system']:
                 logger.debug("系统消息，跳过处理")
                 return
-            # 从数据库中获取商品信息，如果不存在则从API获取并保存
-            item_info = self.context_manager.get_item_info(item_id)
+            # 获取商品信息（缓存未命中时从API获取并保存）
+            item_info = await self.item_cache.get(item_id)
             if not item_info:
-                logger.info(f"从API获取商品信息: {item_id}")
-                api_result = self.xianyu.get_item_info(item_id)
-                if 'data' in api_result and 'itemDO' in api_result['data']:
-                    item_info = api_result['data']['itemDO']
-                    # 保存商品信息到数据库
-                    self.context_manager.save_item_info(item_id, item_info)
-                else:
-                    logger.warning(f"获取商品信息失败: {api_result}")
-                    return
-            else:
-                logger.info(f"从数据库获取商品信息: {item_id}")
+                logger.warning(f"获取商品信息失败: {item_id}")
+                return
                 
             item_description = f"{item_info['desc']};当前商品售卖价格为:{str(item_info['soldPrice'])}"
             
             # 获取完整的对话上下文
             context = self.context_manager.get_context_by_chat(chat_id)
-            # 生成回复 (传入商品ID以使用个性化提示词)
-            bot_reply = bot.generate_reply(
+            # 生成回复 (传入商品ID以使用个性化提示词)，在线程池中执行避免阻塞心跳与其他会话
+            bot_reply, intent = await self.bot.generate_reply_async(
                 send_message,
                 item_description,
                 context=context,
-                item_id=item_id
+                item_id=item_id,
+                chat_id=chat_id
             )
             
             # 检查是否为价格意图，如果是则增加议价次数
-            if bot.last_intent == "price":
+            if intent == "price":
                 self.context_manager.increment_bargain_count_by_chat(chat_id)
                 bargain_count = self.context_manager.get_bargain_count_by_chat(chat_id)
                 logger.info(f"用户 {send_user_name} 对商品 {item_id} 的议价次数: {bargain_count}")
@@ -476,96 +611,133 @@ class XianyuLive:
             await self.send_msg(websocket, chat_id, send_user_id, bot_reply)
             
         except Exception as e:
-            logger.error(f"处理消息时发生错误: {str(e)}")
-            logger.debug(f"原始消息: {message_data}")
-
-    async def handle_auto_delivery(self, websocket, chat_id, buyer_id, item_id):
+            logger.error(f"处理聊天消息时发生错误: {str(e)}")
+            logger.debug(f"消息事件: {event}")
+
+    async def enqueue_delivery(self, chat_id, buyer_id, item_id, event_id):
+        """订单事件去重后写入发货任务队列，由发货工作协程在聊天处理之外完成发货"""
+        delivery_config = await asyncio.to_thread(self.delivery_manager.get_delivery_config, item_id)
+        if not delivery_config:
+            logger.info(f"商品{item_id}未配置自动发货，跳过")
+            return
+        if not delivery_config.get('is_enabled', False):
+            logger.info(f"商品{item_id}的自动发货已禁用，跳过")
+            return
+
+        # 占用订单事件并写入任务在同一事务中完成，重复推送的订单事件不再入队
+        job_id = await asyncio.to_thread(
+            self.delivery_manager.claim_and_enqueue_delivery, event_id, item_id, buyer_id, chat_id, self.myid
+        )
+        if job_id is None:
+            logger.info(f"订单事件{event_id}已处理，跳过重复发货")
+            return
+
+        logger.info(f"发货任务已入队: #{job_id} 商品{item_id}, 买家{buyer_id}")
+        self.delivery_queue.wake()
+
+    async def run_delivery_job(self, job):
+        """发货任务队列的处理函数：通过当前连接发货"""
+        await self.handle_auto_delivery(self.ws, job['chat_id'], job['buyer_id'], job['item_id'], job['event_id'])
+
+    async def handle_auto_delivery(self, websocket, chat_id, buyer_id, item_id, event_id=None):
         """
         处理自动发货
 
+        库存不足、配置已禁用等结果直接记录；发送失败时归还预留的库存和卡密并抛出异常，
+        由发货任务队列稍后重试
+
         Args:
             websocket: WebSocket连接
             chat_id: 会话ID
             buyer_id: 买家ID
             item_id: 商品ID
+            event_id: 订单事件ID，写入发货记录
         """
+        if websocket is None:
+            raise ConnectionError("WebSocket未连接")
+
+        manager = self.delivery_manager
+        reservation_id = None
+        card_key = None
         try:
             logger.info(f"📦 开始处理自动发货: 商品{item_id}, 买家{buyer_id}")
 
-            # 1. 获取发货配置
-            delivery_config = self.delivery_manager.get_delivery_config(item_id)
-
-            if not delivery_config:
-                logger.info(f"商品{item_id}未配置自动发货，跳过")
+            # 1. 获取发货配置（入队后可能被修改）
+            delivery_config = await asyncio.to_thread(manager.get_delivery_config, item_id)
+
+            if not delivery_config or not delivery_config.get('is_enabled', False):
+                logger.info(f"商品{item_id}未配置或已禁用自动发货，跳过")
+                if event_id:
+                    await asyncio.to_thread(manager.record_delivery, {
+                        'item_id': item_id,
+                        'buyer_id': buyer_id,
+                        'chat_id': chat_id,
+                        'status': 'failed',
+                        'error_message': '自动发货未配置或已禁用',
+                        'event_id': event_id
+                    })
                 return
 
-            if not delivery_config.get('is_enabled', False):
-                logger.info(f"商品{item_id}的自动发货已禁用，跳过")
-                return
+            # 2. 预留库存（条件扣减，并发订单不会超卖）
+            if delivery_config.get('delivery_type') == 'cardkey' \
+                    and await asyncio.to_thread(manager.has_card_keys, item_id):
+                # 卡密商品在同一事务中预留库存并分配一个未使用的卡密
+                card_key = await asyncio.to_thread(manager.reserve_card_key, item_id, buyer_id, chat_id)
+                if card_key is not None:
+                    reservation_id = card_key['reservation_id']
+                    delivery_config = dict(delivery_config, delivery_content=card_key['code'])
+            else:
+                reservation_id = await asyncio.to_thread(manager.reserve_stock, item_id, 1, buyer_id, chat_id)
 
-            # 2. 检查库存
-            if not self.delivery_manager.check_stock(item_id):
+            if reservation_id is None:
                 logger.warning(f"❌ 商品{item_id}库存不足，无法自动发货")
                 # 发送库存不足提醒
                 await self.send_msg(websocket, chat_id, buyer_id, "抱歉，该商品暂时缺货，请联系卖家处理。")
                 # 记录失败
-                self.delivery_manager.record_delivery({
+                await asyncio.to_thread(manager.record_delivery, {
                     'item_id': item_id,
                     'buyer_id': buyer_id,
                     'chat_id': chat_id,
                     'delivery_type': delivery_config.get('delivery_type', 'unknown'),
                     'delivery_content': '',
                     'status': 'failed',
-                    'error_message': '库存不足'
+                    'error_message': '库存不足',
+                    'event_id': event_id
                 })
                 return
 
             # 3. 获取商品信息（用于消息模板替换）
-            item_info = self.context_manager.get_item_info(item_id)
-            if not item_info:
-                logger.info(f"从API获取商品信息: {item_id}")
-                api_result = self.xianyu.get_item_info(item_id)
-                if 'data' in api_result and 'itemDO' in api_result['data']:
-                    item_info = api_result['data']['itemDO']
-                    self.context_manager.save_item_info(item_id, item_info)
+            item_info = await self.item_cache.get(item_id)
 
             # 4. 构建发货消息
-            delivery_message = self.delivery_manager.build_delivery_message(delivery_config, item_info)
+            delivery_message = manager.build_delivery_message(delivery_config, item_info)
 
             # 5. 发送发货消息
             logger.info(f"📤 发送发货消息给买家{buyer_id}")
             await self.send_msg(websocket, chat_id, buyer_id, delivery_message)
 
-            # 6. 记录发货成功
-            self.delivery_manager.record_delivery({
+            # 6. 确认库存预留并记录发货成功
+            await asyncio.to_thread(manager.commit_reservation, reservation_id)
+            reservation_id = None
+            await asyncio.to_thread(manager.record_delivery, {
                 'item_id': item_id,
                 'buyer_id': buyer_id,
                 'chat_id': chat_id,
                 'delivery_type': delivery_config.get('delivery_type', 'unknown'),
                 'delivery_content': delivery_config.get('delivery_content', ''),
-                'status': 'success'
+                'status': 'success',
+                'card_key_id': card_key['id'] if card_key else None,
+                'event_id': event_id
             })
 
-            # 7. 减少库存
-            self.delivery_manager.decrease_stock(item_id, 1)
-
             logger.info(f"✅ 自动发货成功: 商品{item_id}, 买家{buyer_id}")
 
         except Exception as e:
             logger.error(f"自动发货失败: {e}")
-            # 记录失败
-            try:
-                self.delivery_manager.record_delivery({
-                    'item_id': item_id,
-                    'buyer_id': buyer_id,
-                    'chat_id': chat_id,
-                    'delivery_type': 'unknown',
-                    'delivery_content': '',
-                    'status': 'failed',
-                    'error_message': str(e)
-                })
-            except:
-                pass
+            # 归还预留的库存和卡密，由发货任务队列重试
+            if reservation_id is not None:
+                await asyncio.to_thread(manager.release_reservation, reservation_id)
+            raise
 
     async def send_heartbeat(self, ws):
         """发送心跳包并等待响应"""
@@ -577,7 +749,7 @@ class XianyuLive:
                     "mid": heartbeat_mid
                 }
             }
-            await ws.send(json.dumps(heartbeat_msg))
+            await ws.send(serializer.dumps(heartbeat_msg))
             self.last_heartbeat_time = time.time()
             logger.debug("心跳包已发送")
             return heartbeat_mid
@@ -622,103 +794,179 @@ class XianyuLive:
             logger.error(f"处理心跳响应出错: {e}")
         return False
 
+    async def list_item_ids(self, max_items, page_size=50):
+        """分页获取已发布商品的ID"""
+        item_ids = []
+        page = 1
+        while len(item_ids) < max_items:
+            result = await self.xianyu_async.get_user_items(page, page_size)
+            if 'error' in result or not result.get('data'):
+                logger.warning(f"获取商品列表失败: {result.get('error', result)}")
+                break
+
+            # 解析嵌套的data结构
+            actual_data = result['data'].get('data', result['data'])
+            items = (
+                actual_data.get('cardList') or
+                actual_data.get('itemList') or
+                actual_data.get('items') or
+                actual_data.get('list') or
+                []
+            )
+            for item in items:
+                card_data = item.get('cardData', item)
+                item_id = card_data.get('id') or card_data.get('itemId') or card_data.get('item_id')
+                if item_id:
+                    item_ids.append(str(item_id))
+
+            if len(items) < page_size:
+                break
+            page += 1
+        return item_ids[:max_items]
+
+    async def prewarm(self):
+        """
+        启动预热
+        
+        分页获取已发布商品，限速并发地填充商品信息缓存，并提前构建各商品的提示词和Agent
+        """
+        max_items = int(os.getenv("PREWARM_MAX_ITEMS", "200"))
+        concurrency = int(os.getenv("PREWARM_CONCURRENCY", "2"))
+        interval = float(os.getenv("PREWARM_INTERVAL", "0.5"))
+        started = time.time()
+
+        try:
+            item_ids = await self.list_item_ids(max_items)
+        except Exception as e:
+            logger.error(f"预热获取商品列表出错: {e}")
+            return
+        logger.info(f"开始预热 {len(item_ids)} 个商品")
+
+        semaphore = asyncio.Semaphore(concurrency)
+        fetches_before = self.item_cache.fetches
+
+        async def warm(item_id):
+            async with semaphore:
+                try:
+                    fetches = self.item_cache.fetches
+                    item_info = await self.item_cache.warm(item_id)
+                    if self.bot is not None:
+                        # 读取商品提示词文件并构建Agent
+                        await asyncio.to_thread(self.bot.agent_registry.get, item_id)
+                    if self.item_cache.fetches != fetches:
+                        # 调用了商品接口，限速
+                        await asyncio.sleep(interval)
+                    return item_info is not None
+                except Exception as e:
+                    logger.warning(f"预热商品 {item_id} 出错: {e}")
+                    return False
+
+        results = await asyncio.gather(*(warm(item_id) for item_id in item_ids))
+        logger.info(
+            f"预热完成: {sum(results)}/{len(item_ids)} 个商品，"
+            f"调用商品接口 {self.item_cache.fetches - fetches_before} 次，耗时 {time.time() - started:.1f} 秒"
+        )
+
     async def main(self):
-        while True:
-            try:
-                # 重置连接重启标志
-                self.connection_restart_flag = False
+        if self.prewarm_on_startup and self.prewarm_task is None:
+            # 与建立连接并行进行，不推迟消息接收
+            self.prewarm_task = asyncio.create_task(self.prewarm())
+        self.delivery_queue.start()
+
+        try:
+            while True:
+                try:
+                    # 重置连接重启标志
+                    self.connection_restart_flag = False
                 
-                headers = {
-                    "Cookie": self.cookies_str,
-                    "Host": "wss-goofish.dingtalk.com",
-                    "Connection": "Upgrade",
-                    "Pragma": "no-cache",
-                    "Cache-Control": "no-cache",
-                    "User-Agent": self.ua_pool.get_current_http_ua(),
-                    "Origin": "https://www.goofish.com",
-                    "Accept-Encoding": "gzip, deflate, br, zstd",
-                    "Accept-Language": "zh-CN,zh;q=0.9",
-                }
+                    headers = {
+                        "Cookie": self.cookies_str,
+                        "Host": "wss-goofish.dingtalk.com",
+                        "Connection": "Upgrade",
+                        "Pragma": "no-cache",
+                        "Cache-Control": "no-cache",
+                        "User-Agent": self.ua_pool.get_current_http_ua(),
+                        "Origin": "https://www.goofish.com",
+                        "Accept-Encoding": "gzip, deflate, br, zstd",
+                        "Accept-Language": "zh-CN,zh;q=0.9",
+                    }
 
-                async with websockets.connect(self.base_url, extra_headers=headers) as websocket:
-                    self.ws = websocket
-                    await self.init(websocket)
+                    async with websockets.connect(self.base_url, extra_headers=headers) as websocket:
+                        await self.init(websocket)
+                        self.ws = websocket
+                        # 连接可用，继续发送断线期间积压的发货任务
+                        self.delivery_queue.wake()
                     
-                    # 初始化心跳时间
-                    self.last_heartbeat_time = time.time()
-                    self.last_heartbeat_response = time.time()
+                        # 初始化心跳时间
+                        self.last_heartbeat_time = time.time()
+                        self.last_heartbeat_response = time.time()
                     
-                    # 启动心跳任务
-                    self.heartbeat_task = asyncio.create_task(self.heartbeat_loop(websocket))
+                        # 启动心跳任务
+                        self.heartbeat_task = asyncio.create_task(self.heartbeat_loop(websocket))
                     
-                    # 启动token刷新任务
-                    self.token_refresh_task = asyncio.create_task(self.token_refresh_loop())
+                        # 启动token刷新任务
+                        self.token_refresh_task = asyncio.create_task(self.token_refresh_loop())
                     
-                    async for message in websocket:
-                        try:
-                            # 检查是否需要重启连接
-                            if self.connection_restart_flag:
-                                logger.info("检测到连接重启标志，准备重新建立连接...")
-                                break
+                        async for message in websocket:
+                            try:
+                                # 检查是否需要重启连接
+                                if self.connection_restart_flag:
+                                    logger.info("检测到连接重启标志，准备重新建立连接...")
+                                    break
                                 
-                            message_data = json.loads(message)
-                            
-                            # 处理心跳响应
-                            if await self.handle_heartbeat_response(message_data):
-                                continue
-                            
-                            # 发送通用ACK响应
-                            if "headers" in message_data and "mid" in message_data["headers"]:
-                                ack = {
-                                    "code": 200,
-                                    "headers": {
-                                        "mid": message_data["headers"]["mid"],
-                                        "sid": message_data["headers"].get("sid", "")
-                                    }
-                                }
-                                # 复制其他可能的header字段
-                                for key in ["app-key", "ua", "dt"]:
-                                    if key in message_data["headers"]:
-                                        ack["headers"][key] = message_data["headers"][key]
-                                await websocket.send(json.dumps(ack))
+                                message_data = serializer.loads(message)
                             
-                            # 处理其他消息
-                            await self.handle_message(message_data, websocket)
+                                # 分类、ACK并分发（聊天消息只入队，读循环继续接收心跳和其他消息）
+                                await self.dispatch_frame(message_data, websocket)
                                 
-                        except json.JSONDecodeError:
-                            logger.error("消息解析失败")
-                        except Exception as e:
-                            logger.error(f"处理消息时发生错误: {str(e)}")
-                            logger.debug(f"原始消息: {message}")
-
-            except websockets.exceptions.ConnectionClosed:
-                logger.warning("WebSocket连接已关闭")
+                            except serializer.JSONDecodeError:
+                                logger.error("消息解析失败")
+                            except Exception as e:
+                                logger.error(f"处理消息时发生错误: {str(e)}")
+                                logger.debug(f"原始消息: {message}")
+
+                except websockets.exceptions.ConnectionClosed:
+                    logger.warning("WebSocket连接已关闭")
                 
-            except Exception as e:
-                logger.error(f"连接发生错误: {e}")
+                except Exception as e:
+                    logger.error(f"连接发生错误: {e}")
                 
-            finally:
-                # 清理任务
-                if self.heartbeat_task:
-                    self.heartbeat_task.cancel()
-                    try:
-                        await self.heartbeat_task
-                    except asyncio.CancelledError:
-                        pass
+                finally:
+                    # 连接已断开，发货任务等待重连
+                    self.ws = None
+
+                    # 清理任务
+                    if self.heartbeat_task:
+                        self.heartbeat_task.cancel()
+                        try:
+                            await self.heartbeat_task
+                        except asyncio.CancelledError:
+                            pass
                         
-                if self.token_refresh_task:
-                    self.token_refresh_task.cancel()
-                    try:
-                        await self.token_refresh_task
-                    except asyncio.CancelledError:
-                        pass
+                    if self.token_refresh_task:
+                        self.token_refresh_task.cancel()
+                        try:
+                            await self.token_refresh_task
+                        except asyncio.CancelledError:
+                            pass
                 
-                # 如果是主动重启，立即重连；否则等待5秒
-                if self.connection_restart_flag:
-                    logger.info("主动重启连接，立即重连...")
-                else:
-                    logger.info("等待5秒后重连...")
-                    await asyncio.sleep(5)
+                    # 如果是主动重启，立即重连；否则等待5秒
+                    if self.connection_restart_flag:
+                        logger.info("主动重启连接，立即重连...")
+                    else:
+                        logger.info("等待5秒后重连...")
+                        await asyncio.sleep(5)
+        finally:
+            # 进程退出或账号停止时停止预热和发货工作协程、关闭HTTP连接池，账号重启时不会遗留
+            if self.prewarm_task and not self.prewarm_task.done():
+                self.prewarm_task.cancel()
+                try:
+                    await self.prewarm_task
+                except asyncio.CancelledError:
+                    pass
+            self.prewarm_task = None
+            await self.delivery_queue.close()
+            await self.xianyu_async.aclose()
 
 
 if __name__ == '__main__':
@@ -735,8 +983,11 @@ if __name__ == '__main__':
     )
     logger.info(f"日志级别设置为: {log_level}")
     
+    # 按.env中的JSON_BACKEND选择序列化后端
+    logger.info(f"JSON序列化后端: {serializer.configure()}")
+    
     cookies_str = os.getenv("COOKIES_STR")
     bot = XianyuReplyBot()
-    xianyuLive = XianyuLive(cookies_str)
+    xianyuLive = XianyuLive(cookies_str, bot=bot)
     # 常驻进程
     asyncio.run(xianyuLive.main())
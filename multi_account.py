@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+多账号运行器
+在一个进程、一个事件循环中同时运行多个闲鱼账号
+
+各账号共享大模型客户端与线程池（XianyuReplyBot）、SQLite连接池与商品信息缓存
+（ChatContextManager）以及发货管理器；Token、心跳、WebSocket连接和人工接管状态
+由各自的XianyuLive实例独立维护。
+
+账号配置文件（ACCOUNTS_FILE，默认data/accounts.json）格式：
+    [
+        {"name": "店铺A", "cookies_str": "unb=...; _m_h5_tk=...; ..."},
+        {"name": "店铺B", "cookies_str": "...", "enabled": false}
+    ]
+"""
+
+import os
+import sys
+import json
+import asyncio
+from typing import Dict, List
+
+from loguru import logger
+from dotenv import load_dotenv
+
+from main import XianyuLive
+from XianyuAgent import XianyuReplyBot
+from context_manager import ChatContextManager
+from delivery_manager import DeliveryManager
+from utils import serializer
+from utils.xianyu_utils import trans_cookies
+
+
+def load_accounts(path: str) -> List[Dict]:
+    """
+    读取账号配置，跳过未启用或Cookie缺少unb的账号
+
+    Returns:
+        list: [{'name': 账号名称, 'cookies_str': Cookie字符串}, ...]
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+
+    accounts = []
+    names = set()
+    for index, entry in enumerate(entries):
+        name = entry.get('name') or f"account-{index + 1}"
+        if not entry.get('enabled', True):
+            logger.info(f"账号 {name} 未启用，跳过")
+            continue
+        cookies_str = entry.get('cookies_str', '')
+        if 'unb' not in trans_cookies(cookies_str):
+            logger.warning(f"账号 {name} 的Cookie缺少unb字段，跳过")
+            continue
+        if name in names:
+            logger.warning(f"账号名称重复: {name}，跳过")
+            continue
+        names.add(name)
+        accounts.append({'name': name, 'cookies_str': cookies_str})
+    return accounts
+
+
+class MultiAccountSupervisor:
+    """
+    多账号监督器
+
+    每个账号运行在独立的协程中：Cookie失效（get_token退出程序）只停止该账号，
+    其他异常在restart_delay秒后重建该账号的连接，不影响其他账号。
+    """
+
+    def __init__(self, accounts: List[Dict], restart_delay: float = None):
+        """
+        Args:
+            accounts: load_accounts()的返回值
+            restart_delay: 账号异常退出后重启的等待时间（秒），默认读取ACCOUNT_RESTART_DELAY
+        """
+        self.accounts = accounts
+        self.restart_delay = restart_delay or float(os.getenv("ACCOUNT_RESTART_DELAY", "30"))
+
+        # 所有账号共享的资源
+        self.context_manager = ChatContextManager()
+        self.delivery_manager = DeliveryManager()
+        self.bot = XianyuReplyBot(context_manager=self.context_manager)
+
+        self.sessions: Dict[str, XianyuLive] = {}  # 账号名称 -> 运行中的XianyuLive
+
+    def _create_session(self, account: Dict) -> XianyuLive:
+        return XianyuLive(
+            account['cookies_str'],
+            bot=self.bot,
+            context_manager=self.context_manager,
+            delivery_manager=self.delivery_manager,
+            # 账号Cookie保存在账号配置中，不能写回.env
+            persist_env_cookies=False,
+        )
+
+    async def _run_account(self, account: Dict):
+        """运行单个账号直到Cookie失效"""
+        name = account['name']
+        with logger.contextualize(account=name):
+            while True:
+                try:
+                    session = self._create_session(account)
+                    self.sessions[name] = session
+                    logger.info(f"账号 {name} 启动 (unb={session.myid})")
+                    await session.main()
+                except SystemExit:
+                    logger.error(f"账号 {name} 的Cookie已失效，已停止该账号，请更新账号配置后重启")
+                    self.sessions.pop(name, None)
+                    return
+                except Exception as e:
+                    logger.error(f"账号 {name} 运行出错: {e}，{self.restart_delay:.0f}秒后重启")
+                    self.sessions.pop(name, None)
+                    await asyncio.sleep(self.restart_delay)
+
+    async def run(self):
+        """并发运行所有账号，全部停止后返回"""
+        if not self.accounts:
+            logger.error("没有可运行的账号")
+            return
+
+        logger.info(f"启动 {len(self.accounts)} 个账号: {', '.join(a['name'] for a in self.accounts)}")
+        await asyncio.gather(*(self._run_account(account) for account in self.accounts))
+        logger.error("所有账号均已停止")
+
+
+if __name__ == '__main__':
+    # 加载环境变量
+    load_dotenv()
+
+    # 配置日志级别，日志中带上账号名称
+    log_level = os.getenv("LOG_LEVEL", "DEBUG").upper()
+    logger.remove()  # 移除默认handler
+    logger.configure(extra={"account": "-"})
+    logger.add(
+        sys.stderr,
+        level=log_level,
+        format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <magenta>{extra[account]}</magenta> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+    )
+    logger.info(f"日志级别设置为: {log_level}")
+
+    # 按.env中的JSON_BACKEND选择序列化后端
+    logger.info(f"JSON序列化后端: {serializer.configure()}")
+
+    accounts_file = os.getenv("ACCOUNTS_FILE", "data/accounts.json")
+    if not os.path.exists(accounts_file):
+        logger.error(f"账号配置文件不存在: {accounts_file}")
+        sys.exit(1)
+
+    supervisor = MultiAccountSupervisor(load_accounts(accounts_file))
+    # 常驻进程
+    asyncio.run(supervisor.run())
@@ -6,6 +6,7 @@
 """
 import os
 import json
+import threading
 from pathlib import Path
 from loguru import logger
 
@@ -19,6 +20,11 @@ class ProductPromptManager:
         # 商品提示词缓存
         self.product_prompts = {}
         
+        # 商品提示词版本：提示词修改后递增，使用方据此判断缓存的Agent是否需要重建
+        self._versions = {}
+        self._file_mtimes = {}  # item_id -> 提示词文件修改时间，感知管理后台直接改文件
+        self._version_lock = threading.Lock()
+        
         # 默认提示词路径
         self.default_prompts = {
             'price': 'prompts/price_prompt_sales_optimized.txt',
@@ -68,6 +74,7 @@ class ProductPromptManager:
             
             # 缓存
             self.product_prompts[item_id] = prompts
+            self._bump_version(item_id)
             
             logger.info(f"为商品 {item_id}({title}) 创建个性化提示词")
             return True
@@ -76,6 +83,58 @@ class ProductPromptManager:
             logger.error(f"创建商品提示词失败 {item_id}: {e}")
             return False
     
+    def get_prompt_version(self, item_id):
+        """
+        获取商品提示词版本
+        
+        通过本管理器修改提示词，或提示词文件被外部修改（如管理后台）时版本号变化，
+        文件变化时同时丢弃该商品的提示词缓存。
+        
+        Args:
+            item_id: 商品ID
+            
+        Returns:
+            int: 版本号
+        """
+        mtimes = self._prompt_file_mtimes(item_id)
+        with self._version_lock:
+            if item_id in self._file_mtimes and self._file_mtimes[item_id] != mtimes:
+                self.product_prompts.pop(item_id, None)
+                self._versions[item_id] = self._versions.get(item_id, 0) + 1
+                logger.info(f"商品 {item_id} 的提示词文件已变化")
+            self._file_mtimes[item_id] = mtimes
+            return self._versions.get(item_id, 0)
+    
+    def invalidate(self, item_id=None):
+        """
+        使商品提示词缓存失效
+        
+        Args:
+            item_id: 商品ID，为None时清空所有商品
+        """
+        if item_id is None:
+            for cached_id in list(self.product_prompts) + list(self._versions):
+                self._bump_version(cached_id)
+            self.product_prompts.clear()
+        else:
+            self.product_prompts.pop(item_id, None)
+            self._bump_version(item_id)
+    
+    def _bump_version(self, item_id):
+        with self._version_lock:
+            self._versions[item_id] = self._versions.get(item_id, 0) + 1
+            self._file_mtimes[item_id] = self._prompt_file_mtimes(item_id)
+    
+    def _prompt_file_mtimes(self, item_id):
+        """商品各类型提示词文件的修改时间，文件不存在记为0"""
+        mtimes = []
+        for prompt_type in ['classify', 'price', 'tech', 'default']:
+            try:
+                mtimes.append((self.prompts_dir / f"{item_id}_{prompt_type}.txt").stat().st_mtime_ns)
+            except OSError:
+                mtimes.append(0)
+        return tuple(mtimes)
+    
     def get_product_prompt(self, item_id, prompt_type):
         """
         获取商品个性化提示词
@@ -87,9 +146,10 @@ class ProductPromptManager:
         Returns:
             str: 提示词内容
         """
-        # 先从缓存获取
-        if item_id in self.product_prompts:
-            return self.product_prompts[item_id].get(prompt_type, '')
+        # 先从缓存获取（缓存可能只加载了部分类型）
+        cached = self.product_prompts.get(item_id)
+        if cached and prompt_type in cached:
+            return cached[prompt_type]
         
         # 尝试从文件加载
         prompt_file = self.prompts_dir / f"{item_id}_{prompt_type}.txt"
@@ -271,8 +331,7 @@ class ProductPromptManager:
                 config_file.unlink()
             
             # 清除缓存
-            if item_id in self.product_prompts:
-                del self.product_prompts[item_id]
+            self.invalidate(item_id)
             
             logger.info(f"删除商品提示词: {item_id}")
             return True
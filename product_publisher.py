@@ -7,6 +7,7 @@ import base64
 from typing import Dict, List, Optional, Union
 from loguru import logger
 from utils.xianyu_utils import generate_sign
+from utils.sqlite_pool import get_sqlite_pool
 
 
 class XianyuProductPublisher:
@@ -15,13 +16,14 @@ class XianyuProductPublisher:
     def __init__(self, xianyu_apis, db_path: str = "data/product_templates.db"):
         self.xianyu_apis = xianyu_apis
         self.db_path = db_path
+        self.db_pool = get_sqlite_pool(db_path)
         self._init_db()
         
     def _init_db(self):
         """初始化数据库"""
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self.db_pool.get_connection()
         cursor = conn.cursor()
         
         # 创建商品模板表
@@ -59,13 +61,12 @@ class XianyuProductPublisher:
         ''')
         
         conn.commit()
-        conn.close()
         logger.info(f"商品发布数据库初始化完成: {self.db_path}")
     
     def save_template(self, template_name: str, product_data: Dict) -> bool:
         """保存商品模板"""
+        conn = self.db_pool.get_connection()
         try:
-            conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
             # 处理图片和标签数据
@@ -94,17 +95,17 @@ class XianyuProductPublisher:
             ))
             
             conn.commit()
-            conn.close()
             logger.info(f"商品模板保存成功: {template_name}")
             return True
         except Exception as e:
             logger.error(f"保存商品模板失败: {e}")
+            conn.rollback()
             return False
     
     def get_template(self, template_name: str) -> Optional[Dict]:
         """获取商品模板"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -112,7 +113,6 @@ class XianyuProductPublisher:
             ''', (template_name,))
             
             row = cursor.fetchone()
-            conn.close()
             
             if row:
                 return {
@@ -140,12 +140,11 @@ class XianyuProductPublisher:
     def list_templates(self) -> List[Dict]:
         """获取所有模板"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
             
             cursor.execute('SELECT * FROM product_templates ORDER BY updated_time DESC')
             rows = cursor.fetchall()
-            conn.close()
             
             templates = []
             for row in rows:
@@ -298,8 +297,8 @@ class XianyuProductPublisher:
     def _record_publish(self, template_id: int, item_id: Optional[str], 
                        status: str, error_message: Optional[str] = None):
         """记录发布结果"""
+        conn = self.db_pool.get_connection()
         try:
-            conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -308,14 +307,14 @@ class XianyuProductPublisher:
             ''', (template_id, item_id, status, error_message))
             
             conn.commit()
-            conn.close()
         except Exception as e:
             logger.error(f"记录发布结果失败: {e}")
+            conn.rollback()
     
     def get_publish_records(self, limit: int = 50) -> List[Dict]:
         """获取发布记录"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db_pool.get_connection()
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -327,7 +326,6 @@ class XianyuProductPublisher:
             ''', (limit,))
             
             rows = cursor.fetchall()
-            conn.close()
             
             records = []
             for row in rows:
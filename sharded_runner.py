@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+多进程分片运行器
+适用于消息量大的账号：接入进程只负责WebSocket连接、心跳、解密和消息分类，
+回复生成和持久化交给多个工作进程完成
+
+- 接入进程（ShardedIngress）：按 crc32(chat_id) % 工作进程数 把聊天事件投递到对应
+  工作进程的队列，同一会话始终落在同一个进程，会话内消息不会乱序；自动发货由接入进程的
+  发货任务队列直接完成
+- 工作进程：各自持有XianyuLive实例（不连接WebSocket），用ChatDispatcher按会话顺序
+  处理事件；要发送的帧通过出站队列交还接入进程，由接入进程写入当前连接
+- 各进程通过SQLite（WAL）共享会话历史、商品信息和发货数据，不支持文件存储模式
+"""
+
+import os
+import sys
+import zlib
+import queue
+import asyncio
+import multiprocessing
+from typing import List
+
+import websockets
+from loguru import logger
+from dotenv import load_dotenv
+
+from main import XianyuLive
+from utils import serializer
+
+# 队列读取的轮询间隔（秒），用于及时响应停止信号
+QUEUE_POLL_INTERVAL = 1.0
+# 等待WebSocket重连的检查间隔（秒）
+RECONNECT_POLL_INTERVAL = 0.2
+
+
+def shard_of(chat_id: str, shards: int) -> int:
+    """会话所属的分片（跨进程稳定，不受PYTHONHASHSEED影响）"""
+    return zlib.crc32(chat_id.encode('utf-8')) % shards
+
+
+class OutboundSocket:
+    """工作进程中代替WebSocket的对象：send()把帧放入出站队列，由接入进程发送"""
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    async def send(self, text: str):
+        self.outbox.put(text)
+
+
+def _setup_logger(prefix: str):
+    log_level = os.getenv("LOG_LEVEL", "DEBUG").upper()
+    logger.remove()  # 移除默认handler
+    logger.add(
+        sys.stderr,
+        level=log_level,
+        format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <magenta>" + prefix + "</magenta> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+    )
+
+
+def worker_main(index: int, cookies_str: str, inbox, outbox):
+    """工作进程入口"""
+    load_dotenv()
+    _setup_logger(f"worker-{index}")
+    serializer.configure()
+    asyncio.run(_worker_loop(index, cookies_str, inbox, outbox))
+
+
+async def _worker_loop(index: int, cookies_str: str, inbox, outbox):
+    live = XianyuLive(cookies_str, persist_env_cookies=False)
+    socket = OutboundSocket(outbox)
+    handlers = {
+        'chat': live.handle_chat_message,
+    }
+    logger.info(f"工作进程 {index} 已启动 (pid={os.getpid()})")
+
+    while True:
+        try:
+            task = await asyncio.to_thread(inbox.get, True, QUEUE_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if task is None:
+            break
+
+        kind, chat_id, args = task
+        handler = handlers.get(kind)
+        if handler is None:
+            logger.warning(f"未知的任务类型: {kind}")
+            continue
+        live.dispatcher.submit(chat_id, handler, socket, *args)
+
+    # 处理完已收到的任务再退出
+    await live.dispatcher.join()
+    await live.dispatcher.close()
+    logger.info(f"工作进程 {index} 已停止")
+
+
+class ShardRouter:
+    """
+    接入进程中代替ChatDispatcher的对象
+
+    接口与ChatDispatcher.submit一致，把任务按会话分片投递到工作进程，
+    WebSocket参数由工作进程的OutboundSocket代替
+    """
+
+    def __init__(self, inboxes: List, kinds: dict):
+        self.inboxes = inboxes
+        self.kinds = kinds  # 处理函数名称 -> 任务类型
+
+    def submit(self, chat_id, handler, websocket, *args):
+        kind = self.kinds[handler.__name__]
+        self.inboxes[shard_of(chat_id, len(self.inboxes))].put((kind, chat_id, args))
+
+    def get_stats(self):
+        stats = {'shards': len(self.inboxes)}
+        try:
+            stats['pending_tasks'] = sum(inbox.qsize() for inbox in self.inboxes)
+        except NotImplementedError:
+            # macOS上不支持Queue.qsize()
+            pass
+        return stats
+
+    async def close(self):
+        pass
+
+
+class ShardedIngress(XianyuLive):
+    """
+    接入进程
+
+    复用XianyuLive的连接、心跳、Token刷新和消息分类，只把分发器替换为ShardRouter，
+    并额外运行出站泵和工作进程监控
+    """
+
+    def __init__(self, cookies_str, workers: int = None):
+        super().__init__(cookies_str)
+        self.workers = workers or int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 2)))
+
+        ctx = multiprocessing.get_context("spawn")
+        self.mp_context = ctx
+        self.inboxes = [ctx.Queue() for _ in range(self.workers)]
+        self.outbox = ctx.Queue()
+        self.processes = [None] * self.workers
+
+        self.dispatcher = ShardRouter(self.inboxes, {
+            'handle_chat_message': 'chat',
+        })
+
+    def create_bot(self):
+        # 回复在工作进程中生成
+        return None
+
+    def _start_worker(self, index: int):
+        process = self.mp_context.Process(
+            target=worker_main,
+            args=(index, self.cookies_str, self.inboxes[index], self.outbox),
+            name=f"shard-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    async def outbound_pump(self):
+        """
+        把工作进程交回的帧写入当前WebSocket连接
+
+        连接断开期间保留当前帧（后续帧仍在出站队列中排队），重连后按原顺序继续发送
+        """
+        text = None
+        while True:
+            if text is None:
+                try:
+                    text = await asyncio.to_thread(self.outbox.get, True, QUEUE_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+
+            ws = self.ws
+            if ws is None:
+                await asyncio.sleep(RECONNECT_POLL_INTERVAL)
+                continue
+
+            try:
+                await ws.send(text)
+                text = None
+            except websockets.exceptions.ConnectionClosed:
+                logger.warning("WebSocket连接已断开，待重连后重新发送")
+                while self.ws is ws:
+                    await asyncio.sleep(RECONNECT_POLL_INTERVAL)
+            except Exception as e:
+                logger.error(f"发送工作进程的消息失败: {e}")
+                text = None
+
+    async def watch_workers(self, interval: float = 5.0):
+        """工作进程意外退出时重启，队列中未处理的任务由新进程继续处理"""
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error(f"工作进程 {index} 已退出 (exitcode={process.exitcode})，正在重启")
+                    self._start_worker(index)
+
+    async def run(self):
+        if self.context_manager.use_file_mode:
+            logger.error("分片模式需要SQLite存储，文件模式无法在多个进程间共享")
+            return
+
+        for index in range(self.workers):
+            self._start_worker(index)
+        logger.info(f"分片模式启动：{self.workers} 个工作进程")
+
+        pump = asyncio.create_task(self.outbound_pump())
+        watcher = asyncio.create_task(self.watch_workers())
+        try:
+            await self.main()
+        finally:
+            pump.cancel()
+            watcher.cancel()
+            for inbox in self.inboxes:
+                inbox.put(None)
+            for process in self.processes:
+                process.join(timeout=10)
+
+
+if __name__ == '__main__':
+    # 加载环境变量
+    load_dotenv()
+    _setup_logger("ingress")
+    logger.info(f"JSON序列化后端: {serializer.configure()}")
+
+    cookies_str = os.getenv("COOKIES_STR")
+    ingress = ShardedIngress(cookies_str)
+    # 常驻进程
+    asyncio.run(ingress.run())
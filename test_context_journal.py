@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""文件模式聊天存储测试：快照 + 追加写日志在合并中途崩溃后重新加载，消息不丢失也不重复"""
+
+import shutil
+
+from context_manager import ChatContextManager
+
+
+def _open(data_dir):
+    return ChatContextManager(db_path=str(data_dir), force_file_mode=True)
+
+
+def _compact(manager):
+    manager.journal.compact(manager._capture_snapshot, manager._write_snapshot)
+
+
+def _contents(manager, chat_id):
+    return [message['content'] for message in manager.chat_messages[chat_id]]
+
+
+def test_reload_replays_journal_after_snapshot(tmp_path):
+    manager = _open(tmp_path)
+    manager.add_message_by_chat('c1', 'u1', 'i1', 'user', 'm1')
+    _compact(manager)
+    manager.add_message_by_chat('c1', 'u1', 'i1', 'user', 'm2')
+    manager.increment_bargain_count_by_chat('c1')
+    manager.journal.close()
+
+    reloaded = _open(tmp_path)
+    assert _contents(reloaded, 'c1') == ['m1', 'm2']
+    assert reloaded.bargain_counts['c1'] == 1
+    reloaded.journal.close()
+
+
+def test_crash_between_snapshot_writes_does_not_duplicate_messages(tmp_path):
+    manager = _open(tmp_path)
+    manager.add_message_by_chat('c1', 'u1', 'i1', 'user', 'm1')
+    manager.increment_bargain_count_by_chat('c1')
+    _compact(manager)
+    old_bargain = tmp_path / 'bargain_counts.old'
+    shutil.copy(manager.bargain_file, old_bargain)
+
+    manager.add_message_by_chat('c1', 'u1', 'i1', 'user', 'm2')
+    manager.increment_bargain_count_by_chat('c1')
+    old_journal = tmp_path / 'chat_journal.old'
+    shutil.copy(manager.journal_file, old_journal)
+    _compact(manager)
+    manager.journal.close()
+
+    # 崩溃发生在消息快照写完、议价快照和日志截断之前
+    shutil.copy(old_bargain, manager.bargain_file)
+    shutil.copy(old_journal, manager.journal_file)
+
+    reloaded = _open(tmp_path)
+    assert _contents(reloaded, 'c1') == ['m1', 'm2']
+    assert reloaded.bargain_counts['c1'] == 2
+    reloaded.journal.close()
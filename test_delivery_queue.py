@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""发货任务队列测试：任务获取/重试/死信/中断恢复、订单事件去重、库存预留与卡密分配（数据库与文件两种模式）"""
+
+import asyncio
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from delivery_manager import DeliveryManager
+from delivery_queue import DeliveryJobQueue
+
+SELLER = 'seller-1'
+
+
+@pytest.fixture(params=['db', 'file'])
+def manager(request, tmp_path):
+    return DeliveryManager(db_path=str(tmp_path / 'delivery.db'), force_file_mode=request.param == 'file')
+
+
+def _reopen(manager):
+    """模拟进程重启：用同一存储重新创建管理器"""
+    return DeliveryManager(db_path=manager.db_path, force_file_mode=manager.use_file_mode)
+
+
+def _run_queue(queue, until, timeout=5.0):
+    """启动队列直到until()成立，然后关闭"""
+    async def main():
+        queue.start()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not until() and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        await queue.close()
+
+    asyncio.run(main())
+
+
+def _queue(manager, handler, **kwargs):
+    options = dict(owner=SELLER, workers=2, max_attempts=3, retry_base=0.01, retry_max=0.01, poll_interval=0.01)
+    options.update(kwargs)
+    return DeliveryJobQueue(manager, handler, **options)
+
+
+# ========== 任务获取与重试 ==========
+
+def test_acquire_is_scoped_to_seller_and_marks_running(manager):
+    first = manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER)
+    second = manager.enqueue_delivery_job('i2', 'b2', 'c2', 'order:2', SELLER)
+    manager.enqueue_delivery_job('i3', 'b3', 'c3', 'order:3', 'other-seller')
+
+    acquired = [manager.acquire_delivery_job(SELLER), manager.acquire_delivery_job(SELLER)]
+    assert sorted(job['id'] for job in acquired) == sorted([first, second])
+    assert all(job['status'] == 'running' and job['attempts'] == 1 for job in acquired)
+    assert manager.acquire_delivery_job(SELLER) is None
+    assert manager.get_delivery_job(first)['status'] == 'running'
+
+
+def test_enqueue_ignores_duplicate_event(manager):
+    assert manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER) is not None
+    assert manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER) is None
+    assert len(manager.get_delivery_jobs()) == 1
+
+
+def test_retry_waits_for_delay(manager):
+    job_id = manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER)
+    manager.acquire_delivery_job(SELLER)
+
+    assert manager.retry_delivery_job(job_id, '发送失败', delay=60)
+    job = manager.get_delivery_job(job_id)
+    assert job['status'] == 'pending' and job['last_error'] == '发送失败'
+    assert manager.acquire_delivery_job(SELLER) is None
+
+    due_id = manager.enqueue_delivery_job('i2', 'b2', 'c2', 'order:2', SELLER)
+    manager.acquire_delivery_job(SELLER)
+    manager.retry_delivery_job(due_id, '发送失败', delay=0)
+    job = manager.acquire_delivery_job(SELLER)
+    assert job['id'] == due_id and job['attempts'] == 2
+
+
+def test_queue_retries_then_succeeds(manager):
+    job_id = manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER)
+    calls = []
+
+    async def handler(job):
+        calls.append(job['attempts'])
+        if len(calls) < 2:
+            raise ConnectionError("WebSocket未连接")
+
+    _run_queue(_queue(manager, handler), until=lambda: manager.get_delivery_job(job_id) is None
+               or manager.get_delivery_job(job_id)['status'] == 'done')
+    assert calls == [1, 2]
+    job = manager.get_delivery_job(job_id)
+    assert job is None or job['status'] == 'done'
+
+
+def test_queue_dead_letters_after_max_attempts(manager):
+    job_id = manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER)
+    calls = []
+
+    async def handler(job):
+        calls.append(job['attempts'])
+        raise RuntimeError("发送失败")
+
+    _run_queue(_queue(manager, handler), until=lambda: manager.get_delivery_job(job_id)['status'] == 'dead')
+    assert calls == [1, 2, 3]
+    job = manager.get_delivery_job(job_id)
+    assert job['status'] == 'dead' and job['last_error'] == '发送失败'
+
+    # 死信同时记为发货失败，可以人工重新入队
+    record = manager.get_delivery_records(limit=1)[0]
+    assert record['status'] == 'failed' and record['event_id'] == 'order:1'
+    assert manager.requeue_delivery_job(job_id)
+    assert manager.acquire_delivery_job(SELLER)['attempts'] == 1
+
+
+def test_queue_does_not_acquire_while_disconnected(manager):
+    job_id = manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER)
+    calls = []
+
+    async def handler(job):
+        calls.append(job['id'])
+
+    ticks = []
+    _run_queue(_queue(manager, handler, is_ready=lambda: False), until=lambda: ticks.append(1) or len(ticks) > 20)
+    assert calls == []
+    assert manager.get_delivery_job(job_id)['status'] == 'pending'
+
+
+# ========== 中断恢复 ==========
+
+def test_start_requeues_jobs_interrupted_by_restart(manager):
+    job_id = manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER)
+    manager.acquire_delivery_job(SELLER)  # 发货过程中进程退出，任务停在running
+    other_id = manager.enqueue_delivery_job('i2', 'b2', 'c2', 'order:2', 'other-seller')
+    manager.acquire_delivery_job('other-seller')
+
+    restarted = _reopen(manager)
+    calls = []
+
+    async def handler(job):
+        calls.append(job['id'])
+
+    _run_queue(_queue(restarted, handler), until=lambda: calls == [job_id])
+    assert calls == [job_id]
+    # 其他账号的running任务不受影响
+    assert restarted.get_delivery_job(other_id)['status'] == 'running'
+
+
+def test_release_stale_jobs(manager):
+    job_id = manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', SELLER)
+    manager.acquire_delivery_job(SELLER)
+
+    assert manager.release_stale_delivery_jobs(max_age=3600) == 0
+    assert manager.release_stale_delivery_jobs(max_age=-1) == 1
+    assert manager.get_delivery_job(job_id)['status'] == 'pending'
+    assert manager.acquire_delivery_job(SELLER)['attempts'] == 2
+
+
+def test_idle_workers_release_stale_jobs(manager):
+    # 其他进程崩溃遗留的running任务，由空闲工作协程超时后放回队列
+    other_id = manager.enqueue_delivery_job('i1', 'b1', 'c1', 'order:1', 'other-seller')
+    manager.acquire_delivery_job('other-seller')
+    manager.reservation_timeout = -1
+
+    async def handler(job):
+        pass
+
+    queue = _queue(manager, handler)
+    queue.STALE_CHECK_INTERVAL = 0
+    _run_queue(queue, until=lambda: manager.get_delivery_job(other_id)['status'] == 'pending')
+    assert manager.get_delivery_job(other_id)['status'] == 'pending'
+
+
+def test_idle_workers_release_expired_reservations(tmp_path):
+    # 崩溃后在预留超时之前重启：初始化时不回收，由队列的定期检查回收
+    manager = DeliveryManager(db_path=str(tmp_path / 'delivery.db'))
+    manager.save_delivery_config('i1', {'delivery_type': 'text', 'delivery_content': 'x', 'stock_count': 1})
+    manager.reserve_stock('i1', 1, 'b1', 'c1')
+    restarted = _reopen(manager)
+    assert restarted.get_delivery_config('i1')['stock_count'] == 0
+    restarted.reservation_timeout = -1
+
+    async def handler(job):
+        pass
+
+    queue = _queue(restarted, handler)
+    queue.STALE_CHECK_INTERVAL = 0
+    _run_queue(queue, until=lambda: restarted.get_delivery_config('i1')['stock_count'] == 1)
+    assert restarted.get_delivery_config('i1')['stock_count'] == 1
+
+
+# ========== 订单事件去重 ==========
+
+def test_claim_and_enqueue_is_idempotent(manager):
+    job_id = manager.claim_and_enqueue_delivery('order:1', 'i1', 'b1', 'c1', SELLER)
+    assert job_id is not None
+    assert manager.get_delivery_job(job_id)['event_id'] == 'order:1'
+    assert manager.get_delivery_records(limit=1)[0]['status'] == 'processing'
+
+    # 重连后重复推送：内存缓存和持久化记录都会拒绝
+    assert manager.claim_and_enqueue_delivery('order:1', 'i1', 'b1', 'c1', SELLER) is None
+    assert manager.claim_order_event('order:1') is False
+    assert _reopen(manager).claim_and_enqueue_delivery('order:1', 'i1', 'b1', 'c1', SELLER) is None
+    assert len(manager.get_delivery_jobs()) == 1
+
+
+def test_completed_delivery_replaces_processing_record(manager):
+    manager.claim_and_enqueue_delivery('order:1', 'i1', 'b1', 'c1', SELLER)
+    manager.record_delivery({'item_id': 'i1', 'buyer_id': 'b1', 'chat_id': 'c1',
+                             'status': 'success', 'event_id': 'order:1'})
+
+    records = manager.get_delivery_records()
+    assert len(records) == 1 and records[0]['status'] == 'success'
+
+
+def test_records_are_ordered_by_delivery_time(manager):
+    # 占用的订单事件完成时发货时间更新，两种存储模式都按 (delivery_time, id) 倒序返回
+    manager.claim_and_enqueue_delivery('order:1', 'i1', 'b1', 'c1', SELLER)
+    manager.record_delivery({'item_id': 'i1', 'buyer_id': 'b2', 'status': 'success'})
+    manager.record_delivery({'item_id': 'i1', 'buyer_id': 'b1', 'status': 'success', 'event_id': 'order:1'})
+    manager.record_delivery({'item_id': 'i2', 'buyer_id': 'b3', 'status': 'failed'})
+
+    records = manager.get_delivery_records()
+    assert [r['buyer_id'] for r in records] == ['b3', 'b1', 'b2']
+    assert [r['buyer_id'] for r in manager.get_delivery_records(item_id='i1')] == ['b1', 'b2']
+
+    paged, cursor = [], None
+    while True:
+        page = manager.get_delivery_records_page(limit=1, cursor=cursor)
+        paged.extend(page['records'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert [r['id'] for r in paged] == [r['id'] for r in records]
+
+
+# ========== 库存预留与卡密 ==========
+
+def test_reservation_prevents_oversell(manager):
+    manager.save_delivery_config('i1', {'delivery_type': 'text', 'delivery_content': 'x', 'stock_count': 1})
+
+    reservation_id = manager.reserve_stock('i1', 1, 'b1', 'c1')
+    assert reservation_id is not None
+    assert manager.reserve_stock('i1', 1, 'b2', 'c2') is None
+
+    assert manager.release_reservation(reservation_id)
+    assert manager.get_delivery_config('i1')['stock_count'] == 1
+    assert not manager.release_reservation(reservation_id)
+
+    reservation_id = manager.reserve_stock('i1', 1, 'b2', 'c2')
+    assert manager.commit_reservation(reservation_id)
+    assert manager.get_delivery_config('i1')['stock_count'] == 0
+
+
+def test_card_keys_are_never_sent_twice(manager):
+    manager.save_delivery_config('i1', {'delivery_type': 'cardkey', 'stock_count': -1})
+    result = manager.import_card_keys('i1', [f'KEY-{i}' for i in range(200)] + [' '])
+    assert result == {'imported': 200, 'duplicates': 0}
+    assert manager.import_card_keys('i1', ['KEY-1']) == {'imported': 0, 'duplicates': 1}
+    assert manager.get_delivery_config('i1')['stock_count'] == 200
+
+    codes = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(25):
+            key = manager.reserve_card_key('i1', 'b1', 'c1')
+            manager.commit_reservation(key['reservation_id'])
+            with lock:
+                codes.append(key['code'])
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(codes) == len(set(codes)) == 200
+    assert manager.reserve_card_key('i1') is None
+    assert manager.get_card_key_stats('i1') == {
+        'item_id': 'i1', 'available': 0, 'allocated': 200, 'suspect': 0, 'total': 200
+    }
+    assert manager.get_delivery_config('i1')['stock_count'] == 0
+
+
+def test_released_reservation_returns_card_key(manager):
+    manager.save_delivery_config('i1', {'delivery_type': 'cardkey', 'stock_count': -1})
+    manager.import_card_keys('i1', ['KEY-1', 'KEY-2'])
+
+    key = manager.reserve_card_key('i1', 'b1', 'c1')
+    assert key['code'] == 'KEY-1'
+    assert manager.get_delivery_config('i1')['stock_count'] == 1
+
+    assert manager.release_reservation(key['reservation_id'])
+    assert manager.get_delivery_config('i1')['stock_count'] == 2
+    assert manager.get_card_key_stats('i1')['available'] == 2
+    assert manager.reserve_card_key('i1', 'b2', 'c2')['code'] == 'KEY-1'
+
+
+def test_card_key_without_keys_keeps_stock(manager):
+    manager.save_delivery_config('i1', {'delivery_type': 'cardkey', 'stock_count': 3})
+
+    assert manager.reserve_card_key('i1') is None
+    assert manager.get_delivery_config('i1')['stock_count'] == 3
+
+
+def test_expired_card_key_reservation_is_quarantined(tmp_path):
+    # 发送后、确认前进程崩溃：重启后超时清理不能把可能已发出的卡密再发给其他买家
+    manager = DeliveryManager(db_path=str(tmp_path / 'delivery.db'))
+    manager.save_delivery_config('i1', {'delivery_type': 'cardkey', 'stock_count': -1})
+    manager.import_card_keys('i1', ['KEY-1', 'KEY-2'])
+    key = manager.reserve_card_key('i1', 'b1', 'c1')
+
+    restarted = _reopen(manager)
+    assert restarted.release_expired_reservations(max_age=-1) == 1
+    assert restarted.get_card_key_stats('i1') == {
+        'item_id': 'i1', 'available': 1, 'allocated': 0, 'suspect': 1, 'total': 2
+    }
+    assert restarted.get_delivery_config('i1')['stock_count'] == 1
+    [suspect] = restarted.get_suspect_card_keys('i1')
+    assert suspect['id'] == key['id'] and suspect['buyer_id'] == 'b1'
+    assert restarted.reserve_card_key('i1', 'b2', 'c2')['code'] == 'KEY-2'
+    assert restarted.reserve_card_key('i1', 'b3', 'c3') is None
+
+    # 人工核对：确认未发出后放回卡密池
+    assert restarted.resolve_suspect_card_key(key['id'], sent=False)
+    assert not restarted.resolve_suspect_card_key(key['id'], sent=False)
+    assert restarted.get_delivery_config('i1')['stock_count'] == 1
+    assert restarted.reserve_card_key('i1', 'b3', 'c3')['code'] == 'KEY-1'
+
+
+def test_expired_stock_reservation_returns_stock(tmp_path):
+    manager = DeliveryManager(db_path=str(tmp_path / 'delivery.db'))
+    manager.save_delivery_config('i1', {'delivery_type': 'text', 'delivery_content': 'x', 'stock_count': 1})
+    manager.reserve_stock('i1', 1, 'b1', 'c1')
+
+    assert manager.release_expired_reservations(max_age=3600) == 0
+    assert manager.release_expired_reservations(max_age=-1) == 1
+    assert manager.get_delivery_config('i1')['stock_count'] == 1
+
+
+def test_file_mode_card_keys_survive_restart(tmp_path):
+    manager = DeliveryManager(db_path=str(tmp_path / 'delivery.db'), force_file_mode=True)
+    manager.save_delivery_config('i1', {'delivery_type': 'cardkey', 'stock_count': -1})
+    manager.import_card_keys('i1', ['KEY-1', 'KEY-2'])
+    key = manager.reserve_card_key('i1', 'b1', 'c1')
+    manager.commit_reservation(key['reservation_id'])
+
+    assert not any(name.endswith('.tmp') for name in os.listdir(manager.data_dir))
+    restarted = _reopen(manager)
+    assert restarted.get_card_key_stats('i1') == {
+        'item_id': 'i1', 'available': 1, 'allocated': 1, 'suspect': 0, 'total': 2
+    }
+    assert restarted.reserve_card_key('i1')['code'] == 'KEY-2'
+
+
+# ========== 发货统计 ==========
+
+def test_stats_exclude_processing_events(manager):
+    manager.claim_and_enqueue_delivery('order:1', 'i1', 'b1', 'c1', SELLER)
+    manager.claim_and_enqueue_delivery('order:2', 'i1', 'b2', 'c2', SELLER)
+    stats = manager.get_delivery_stats()
+    assert stats['total_deliveries'] == 0 and stats['today_deliveries'] == 0
+    assert manager.get_daily_delivery_stats(days=1) == []
+
+    manager.record_delivery({'item_id': 'i1', 'buyer_id': 'b1', 'status': 'success', 'event_id': 'order:1'})
+    manager.record_delivery({'item_id': 'i1', 'buyer_id': 'b3', 'status': 'failed'})
+    stats = manager.get_delivery_stats()
+    assert stats['total_deliveries'] == 2 and stats['success_deliveries'] == 1
+    assert stats['today_deliveries'] == 2 and stats['success_rate'] == 50.0
+    [today] = manager.get_daily_delivery_stats(days=1)
+    assert (today['success'], today['failed'], today['total']) == (1, 1, 2)
+
+
+def test_file_mode_reclaim_moves_daily_count(tmp_path):
+    manager = DeliveryManager(db_path=str(tmp_path / 'delivery.db'), force_file_mode=True)
+    manager.claim_order_event('order:1', 'i1', 'b1', 'c1')
+    record = manager.event_records['order:1']
+    manager._count_record_file_mode(record, -1)
+    record['delivery_time'] = (datetime.now() - timedelta(days=1)).isoformat()
+    manager._count_record_file_mode(record, 1)
+    manager._save_file_data('records')
+
+    # 上次处理中断，超时后重新占用：统计随记录移到今天
+    restarted = _reopen(manager)
+    restarted.reservation_timeout = 60
+    assert restarted.claim_order_event('order:1', 'i1', 'b1', 'c1')
+    today = datetime.now().strftime('%Y-%m-%d')
+    assert {key: count for key, count in restarted.stats_daily.items() if count} == {(today, 'processing'): 1}
+
+    restarted.record_delivery({'item_id': 'i1', 'buyer_id': 'b1', 'status': 'success', 'event_id': 'order:1'})
+    assert {key: count for key, count in restarted.stats_daily.items() if count} == {(today, 'success'): 1}
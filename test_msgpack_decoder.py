@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MessagePack解码器一致性测试：快速解码器/C扩展的输出必须与参考实现完全一致"""
+
+import base64
+import json
+import random
+import struct
+
+from utils import xianyu_utils
+from utils.xianyu_utils import MessagePackDecoder, decode_msgpack, decrypt_to_obj, _unpack_fast
+
+
+def _pack(obj, wide=False):
+    """测试用的简易MessagePack编码器，wide=True时使用更宽的长度格式"""
+    if obj is None:
+        return b'\xc0'
+    if obj is True:
+        return b'\xc3'
+    if obj is False:
+        return b'\xc2'
+    if isinstance(obj, int):
+        if 0 <= obj <= 0x7f and not wide:
+            return bytes([obj])
+        if -32 <= obj < 0 and not wide:
+            return struct.pack('>b', obj)
+        if obj >= 0:
+            for code, fmt, limit in ((0xcc, '>B', 0xff), (0xcd, '>H', 0xffff),
+                                     (0xce, '>I', 0xffffffff), (0xcf, '>Q', 0xffffffffffffffff)):
+                if obj <= limit:
+                    return bytes([code]) + struct.pack(fmt, obj)
+        for code, fmt, limit in ((0xd0, '>b', 0x7f), (0xd1, '>h', 0x7fff),
+                                 (0xd2, '>i', 0x7fffffff), (0xd3, '>q', 0x7fffffffffffffff)):
+            if -limit - 1 <= obj <= limit:
+                return bytes([code]) + struct.pack(fmt, obj)
+    if isinstance(obj, float):
+        return b'\xcb' + struct.pack('>d', obj)
+    if isinstance(obj, str):
+        raw = obj.encode('utf-8')
+        if len(raw) <= 31 and not wide:
+            return bytes([0xa0 | len(raw)]) + raw
+        if len(raw) <= 0xff and not wide:
+            return b'\xd9' + bytes([len(raw)]) + raw
+        if len(raw) <= 0xffff:
+            return b'\xda' + struct.pack('>H', len(raw)) + raw
+        return b'\xdb' + struct.pack('>I', len(raw)) + raw
+    if isinstance(obj, bytes):
+        if len(obj) <= 0xff and not wide:
+            return b'\xc4' + bytes([len(obj)]) + obj
+        return b'\xc5' + struct.pack('>H', len(obj)) + obj
+    if isinstance(obj, list):
+        head = bytes([0x90 | len(obj)]) if len(obj) <= 15 and not wide else b'\xdc' + struct.pack('>H', len(obj))
+        return head + b''.join(_pack(item, wide) for item in obj)
+    if isinstance(obj, dict):
+        head = bytes([0x80 | len(obj)]) if len(obj) <= 15 and not wide else b'\xde' + struct.pack('>H', len(obj))
+        return head + b''.join(_pack(k, wide) + _pack(v, wide) for k, v in obj.items())
+    raise TypeError(type(obj))
+
+
+# 模拟闲鱼同步包的消息结构
+SAMPLE_MESSAGE = {
+    "1": {
+        "1": {"1": "1234567890@goofish", "2": 1},
+        "2": "53843938102@goofish",
+        "3": {"1": 101, "2": "欢迎光临", "3": None},
+        "5": 1718000000000,
+        "6": {"3": {"4": 1, "5": '{"text":{"text":"你好，还在吗？"}}'}},
+        "10": {
+            "reminderContent": "你好，还在吗？",
+            "reminderTitle": "买家昵称",
+            "reminderUrl": "fleamarket://message_chat?itemId=712345678901&peerUserId=2200000000",
+            "senderUserId": "2200000000",
+            "_platform": "android",
+            "bizTag": '{"sourceId":"S:1","messageId":"3a1b2c"}',
+        },
+    },
+    "3": {"needPush": True, "isTop": False, "score": 3.5, "delta": -7},
+}
+
+CORPUS = [
+    _pack(SAMPLE_MESSAGE),
+    _pack(SAMPLE_MESSAGE, wide=True),
+    _pack([0, 127, -1, -32, 128, 255, 256, 65535, 65536, 2 ** 32, 2 ** 64 - 1]),
+    _pack([-33, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1, -2 ** 63]),
+    _pack([0.0, -1.5, 3.141592653589793, 1e300]),
+    b'\xca' + struct.pack('>f', 1.1),                   # float32
+    _pack(["", "a" * 31, "b" * 32, "c" * 300, "中文" * 50]),
+    _pack([b"", b"\x00\xff\x10", b"x" * 300]),
+    _pack({1: "int key", b"k": "bytes key", None: "nil key", True: "bool key"}),
+    _pack({"nested": [[[{"deep": [1, [2, [3]]]}]]]}),
+    _pack(list(range(20))),
+    _pack({str(i): i for i in range(20)}),
+    b'\xc6' + struct.pack('>I', 3) + b'abc',             # bin 32
+    b'\xdb' + struct.pack('>I', 2) + b'ok',              # str 32
+    b'\xdd' + struct.pack('>I', 2) + b'\x01\x02',        # array 32
+    b'\xdf' + struct.pack('>I', 1) + b'\xa1k\x01',       # map 32
+    _pack("first") + _pack("trailing"),                  # 尾部多余数据被忽略
+    b'',                                                 # 空数据
+    b'\xa5abc',                                          # 字符串被截断
+    b'\xcd\x01',                                         # 数值被截断
+    b'\x93\x01\x02',                                     # 数组元素不足
+    b'\xc1',                                             # 未使用的格式字节
+    b'\xd4\x01\x02',                                     # fixext 1
+    b'\xd6\xff\x00\x00\x00\x01',                         # 时间戳扩展类型(-1)
+    b'\xc7\x01\x05\x00',                                 # ext 8
+    b'\xa2\xff\xfe',                                     # 非法UTF-8
+    b'\x81\x91\x01\x02',                                 # 不可哈希的map键
+]
+
+
+# 字典键和二进制值的JSON转换
+JSON_CORPUS = CORPUS + [
+    _pack({1.5: "float", -0.0: "neg zero", float('inf'): "inf", float('nan'): "nan"}),
+    _pack({1: "int first", "1": "str later", True: "bool", "true": "dup"}),
+    _pack({"bin": b"\xe4\xbd\xa0\xe5\xa5\xbd", "raw": b"\x80\x81", "list": [b"ok", b"\xfe"]}),
+    _pack(b"top level bin"),
+    _pack({b"bytes key": 1}),                            # 键无法转为JSON
+    _pack({"outer": {b"k": [1, 2]}}),
+    _pack({b"k": 1})[:-1],                               # 键无法转换且数据被截断
+    b'\xc4\x03\xff\xfe\xfd',                            # 非UTF-8二进制
+]
+
+
+def _reference_decrypt(data: str) -> str:
+    """旧版decrypt：参考解码 + 自定义序列化"""
+    try:
+        cleaned_data = ''.join(c for c in data if c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
+        while len(cleaned_data) % 4 != 0:
+            cleaned_data += '='
+        try:
+            decoded_bytes = base64.b64decode(cleaned_data)
+        except Exception as e:
+            return json.dumps({"error": f"Base64 decode failed: {str(e)}", "raw_data": data})
+        try:
+            result = MessagePackDecoder(decoded_bytes).decode()
+
+            def json_serializer(obj):
+                if isinstance(obj, bytes):
+                    try:
+                        return obj.decode('utf-8')
+                    except:
+                        return base64.b64encode(obj).decode('utf-8')
+                return str(obj)
+
+            return json.dumps(result, ensure_ascii=False, default=json_serializer)
+        except Exception as e:
+            try:
+                return json.dumps({"text": decoded_bytes.decode('utf-8')})
+            except:
+                return json.dumps({"hex": decoded_bytes.hex(), "error": f"Decode failed: {str(e)}"})
+    except Exception as e:
+        return json.dumps({"error": f"Decrypt failed: {str(e)}", "raw_data": data})
+
+
+def _assert_same(data):
+    expected = MessagePackDecoder(data).decode()
+    actual = decode_msgpack(data)
+    # repr比较可以区分True/1以及NaN
+    assert repr(actual) == repr(expected), data
+
+
+def test_corpus_parity():
+    for data in CORPUS:
+        _assert_same(data)
+
+
+def test_pure_python_engine_parity(monkeypatch):
+    monkeypatch.setattr(xianyu_utils, 'MSGPACK_AVAILABLE', False)
+    for data in CORPUS:
+        _assert_same(data)
+
+
+def test_mutated_frames_parity(monkeypatch):
+    """对真实结构的帧做随机截断和字节替换"""
+    rng = random.Random(20240601)
+    base = CORPUS[0]
+    for engine_available in (xianyu_utils.MSGPACK_AVAILABLE, False):
+        monkeypatch.setattr(xianyu_utils, 'MSGPACK_AVAILABLE', engine_available)
+        for _ in range(2000):
+            data = bytearray(base[:rng.randint(0, len(base))])
+            for _ in range(rng.randint(0, 3)):
+                if data:
+                    data[rng.randrange(len(data))] = rng.randrange(256)
+            _assert_same(bytes(data))
+
+
+def test_decrypt_to_obj_matches_json_round_trip(monkeypatch):
+    for engine_available in (xianyu_utils.MSGPACK_AVAILABLE, False):
+        monkeypatch.setattr(xianyu_utils, 'MSGPACK_AVAILABLE', engine_available)
+        for data in JSON_CORPUS:
+            encoded = base64.b64encode(data).decode('ascii')
+            expected = json.loads(_reference_decrypt(encoded))
+            assert repr(decrypt_to_obj(encoded)) == repr(expected), data
+            assert json.loads(xianyu_utils.decrypt(encoded)) == json.loads(json.dumps(expected))
+
+
+def test_fast_decoder_returns_bytes_for_bin():
+    assert _unpack_fast(b'\xc4\x02ab') == b'ab'
+    assert type(_unpack_fast(b'\xc4\x02ab')) is bytes
+
+
+if __name__ == "__main__":
+    import timeit
+
+    frame = CORPUS[0]
+    rounds = 2000
+    engine = "msgpack C扩展" if xianyu_utils.MSGPACK_AVAILABLE else "纯Python快速解码"
+    for name, func in (("参考实现", lambda: MessagePackDecoder(frame).decode()),
+                       ("纯Python快速解码", lambda: _unpack_fast(frame)),
+                       (f"decode_msgpack({engine})", lambda: decode_msgpack(frame))):
+        best = min(timeit.repeat(func, number=rounds, repeat=10))
+        print(f"{name}: {best / rounds * 1e6:.1f} us/帧")
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""JSON序列化后端一致性测试：orjson后端的输出必须与标准库json一致"""
+
+import json
+
+import pytest
+
+from utils import serializer
+
+SAMPLES = [
+    {"lwp": "/r/MessageSend/sendByReceiverScope", "headers": {"mid": "1381718000000000 0"}, "body": [1, None, True]},
+    {"text": "您好，这款还有货～", "price": 12.5, "nested": [{"a": []}, {}]},
+    {"nan": float('nan'), "inf": float('inf'), "ninf": [float('-inf')], "none": None},
+    {1: "非字符串键", "big": 2 ** 70},
+]
+
+
+@pytest.mark.skipif(not serializer.ORJSON_AVAILABLE, reason="orjson未安装")
+@pytest.mark.parametrize("obj", SAMPLES)
+def test_orjson_dumps_matches_stdlib(obj):
+    assert serializer._orjson_dumps(obj) == serializer._stdlib_dumps(obj)
+
+
+def test_non_finite_floats_use_stdlib_literals():
+    text = serializer.dumps({"value": float('nan'), "limit": float('inf')})
+    assert text == '{"value":NaN,"limit":Infinity}'
+    assert serializer.loads(text)["limit"] == float('inf')
+
+
+def test_loads_error_matches_stdlib():
+    with pytest.raises(json.JSONDecodeError):
+        serializer.loads("{broken")
@@ -0,0 +1,150 @@
+import os
+import json
+import threading
+from typing import Any, Callable, Dict, Iterator
+
+from loguru import logger
+
+# 快照文件中记录已合并日志序号的保留字段
+SNAPSHOT_SEQ_KEY = "__journal_seq__"
+
+
+def atomic_write_json(path: str, data: Any, indent: int = 2):
+    """原子写入JSON文件：先写临时文件并fsync，再替换目标文件"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class AppendOnlyJournal:
+    """
+    追加写日志（JSONL）
+
+    每次写入只追加一行记录，写入成本与历史数据量无关。后台线程定期把内存状态
+    合并成快照（原子替换），并截掉快照已覆盖的日志。每条记录带递增序号，快照中
+    保存已合并的序号，启动回放时跳过已合并的记录，保证任何时刻崩溃都不会重复回放。
+    """
+
+    def __init__(self, path: str, compact_threshold: int = 1000, compact_interval: float = 60.0):
+        """
+        Args:
+            path: 日志文件路径
+            compact_threshold: 累计多少条新记录后触发合并
+            compact_interval: 后台检查合并的间隔（秒）
+        """
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.compact_interval = compact_interval
+
+        # 调用方修改内存状态和追加日志时应持有该锁，保证快照与日志位置一致
+        self.lock = threading.RLock()
+        self.seq = 0
+        self.pending = 0  # 上次合并后新增的记录数
+        # 串行化合并：捕获状态、写快照、截断日志必须作为整体执行，
+        # 否则较慢的一次合并会用旧快照覆盖新快照，并按已失效的偏移截断日志
+        self._compact_lock = threading.Lock()
+
+        self._file = None
+        self._stop_event = threading.Event()
+        self._compactor = None
+
+    def replay(self, since_seq: int = 0) -> Iterator[Dict]:
+        """回放日志中序号大于since_seq的记录，并打开日志用于追加"""
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时可能留下不完整的最后一行
+                        logger.warning(f"跳过损坏的日志记录: {self.path}")
+                        continue
+                    self.seq = max(self.seq, record.get('seq', 0))
+                    if record.get('seq', 0) > since_seq:
+                        records.append(record)
+
+        self.seq = max(self.seq, since_seq)
+        self.pending = len(records)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        return iter(records)
+
+    def append(self, record: Dict):
+        """追加一条记录"""
+        with self.lock:
+            self.seq += 1
+            record['seq'] = self.seq
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+            self.pending += 1
+
+    def compact(self, capture: Callable[[], Any], write_snapshot: Callable[[Any, int], None]):
+        """
+        合并日志
+
+        Args:
+            capture: 在锁内调用，返回当前内存状态的拷贝
+            write_snapshot: 在self.lock外调用（不阻塞追加），参数为(状态拷贝, 快照覆盖到的序号)，负责原子写入快照
+        """
+        with self._compact_lock:
+            with self.lock:
+                if self.pending == 0 or self._file is None:
+                    return
+                state = capture()
+                snapshot_seq = self.seq
+                offset = self._file.tell()
+
+            write_snapshot(state, snapshot_seq)
+
+            with self.lock:
+                # 只保留快照之后追加的记录
+                self._file.close()
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    f.seek(offset)
+                    tail = f.read()
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self._file = open(self.path, 'a', encoding='utf-8')
+                self.pending = tail.count('\n')
+
+        logger.debug(f"日志合并完成: {self.path} (序号 {snapshot_seq})")
+
+    def start_background_compaction(self, capture: Callable[[], Any], write_snapshot: Callable[[Any, int], None]):
+        """启动后台合并线程"""
+        def run():
+            while not self._stop_event.wait(self.compact_interval):
+                if self.pending >= self.compact_threshold:
+                    try:
+                        self.compact(capture, write_snapshot)
+                    except Exception as e:
+                        logger.error(f"日志合并失败: {e}")
+
+        self._compactor = threading.Thread(target=run, name="journal-compactor", daemon=True)
+        self._compactor.start()
+
+    def close(self, capture: Callable[[], Any] = None, write_snapshot: Callable[[Any, int], None] = None):
+        """停止后台合并，可选地做最后一次合并，然后关闭日志文件"""
+        self._stop_event.set()
+        # 等待进行中的后台合并结束，再做最后一次合并
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        if capture and write_snapshot:
+            try:
+                self.compact(capture, write_snapshot)
+            except Exception as e:
+                logger.error(f"日志合并失败: {e}")
+        with self.lock:
+            if self._file:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,90 @@
+import os
+import json
+from typing import Any, Union
+
+# 可选的orjson加速，未安装时使用标准库json
+try:
+    import orjson as _orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    _orjson = None
+    ORJSON_AVAILABLE = False
+
+
+def _stdlib_dumps(obj: Any) -> str:
+    """标准库序列化：紧凑格式，非ASCII字符原样输出"""
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def _stdlib_loads(data: Union[str, bytes, bytearray]) -> Any:
+    return json.loads(data)
+
+
+def _has_non_finite(obj: Any) -> bool:
+    """是否包含NaN/±Infinity（orjson会把它们输出为null，标准库输出NaN/Infinity）"""
+    if isinstance(obj, float):
+        return obj != obj or obj in (float('inf'), float('-inf'))
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    return False
+
+
+def _orjson_dumps(obj: Any) -> str:
+    """
+    orjson序列化，遇到orjson不支持的数据（如非字符串的字典键、超过64位的整数）时回退到标准库
+
+    orjson把NaN/±Infinity静默输出为null，输出中出现null时检查一次，包含这些值则交给标准库，
+    保证输出与json.dumps一致
+    """
+    try:
+        text = _orjson.dumps(obj).decode('utf-8')
+    except TypeError:
+        return _stdlib_dumps(obj)
+    if 'null' in text and _has_non_finite(obj):
+        return _stdlib_dumps(obj)
+    return text
+
+
+def _orjson_loads(data: Union[str, bytes, bytearray]) -> Any:
+    """orjson反序列化，解析失败时交给标准库，保证可接受的输入和报错与json.loads一致"""
+    try:
+        return _orjson.loads(data)
+    except ValueError:
+        return json.loads(data)
+
+
+def _select_backend(backend: str = None) -> str:
+    """选择序列化后端（auto/orjson/json），默认读取JSON_BACKEND；orjson未安装时使用标准库"""
+    backend = (backend or os.getenv("JSON_BACKEND", "auto")).lower()
+    if backend == "json" or not ORJSON_AVAILABLE:
+        return "json"
+    return "orjson"
+
+
+def configure(backend: str = None) -> str:
+    """
+    重新选择序列化后端，用于加载.env之后按配置切换
+
+    调用方应通过模块属性使用（serializer.dumps / serializer.loads），切换后立即生效
+
+    Returns:
+        str: 实际使用的后端名称
+    """
+    global BACKEND, dumps, loads
+    BACKEND = _select_backend(backend)
+    if BACKEND == "orjson":
+        dumps, loads = _orjson_dumps, _orjson_loads
+    else:
+        dumps, loads = _stdlib_dumps, _stdlib_loads
+    return BACKEND
+
+
+# 当前使用的后端，dumps返回紧凑的JSON字符串，loads接受str或bytes
+BACKEND = None
+dumps = loads = None
+configure()
+
+# 解析失败时抛出的异常（orjson的异常是它的子类）
+JSONDecodeError = json.JSONDecodeError
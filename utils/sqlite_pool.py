@@ -0,0 +1,95 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+
+class SQLiteConnectionPool:
+    """
+    SQLite长连接池
+
+    每个线程复用一条长连接（线程亲和），避免每次操作都重新打开数据库文件。
+    连接统一开启WAL日志和synchronous=NORMAL，并使用较大的预编译语句缓存，
+    相同SQL在同一连接上重复执行时无需重新解析。
+    """
+
+    def __init__(self, db_path: str, cached_statements: int = 256, busy_timeout: float = 5.0):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+
+        self._lock = threading.Lock()
+        self._connections: Dict[int, sqlite3.Connection] = {}  # 线程ID -> 连接
+
+    def _connect(self) -> sqlite3.Connection:
+        """创建并配置一条新连接"""
+        # 连接只在创建它的线程中使用，关闭check_same_thread是为了能在其他线程回收已退出线程的连接
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            cached_statements=self.cached_statements,
+            check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def get_connection(self) -> sqlite3.Connection:
+        """获取当前线程的长连接，不存在则创建"""
+        ident = threading.get_ident()
+        conn = self._connections.get(ident)
+        if conn is None:
+            conn = self._connect()
+            with self._lock:
+                self._prune_dead_threads()
+                self._connections[ident] = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """在当前线程连接上执行事务，成功提交，异常回滚"""
+        conn = self.get_connection()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _prune_dead_threads(self):
+        """关闭已退出线程遗留的连接"""
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in [i for i in self._connections if i not in alive]:
+            try:
+                self._connections.pop(ident).close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        """关闭池中所有连接"""
+        with self._lock:
+            for conn in self._connections.values():
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._connections.clear()
+
+
+_pools: Dict[str, SQLiteConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_sqlite_pool(db_path: str) -> SQLiteConnectionPool:
+    """获取数据库文件对应的全局连接池，同一文件在进程内共享一个池"""
+    key = os.path.abspath(db_path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = SQLiteConnectionPool(db_path)
+                _pools[key] = pool
+    return pool
@@ -0,0 +1,115 @@
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from loguru import logger
+
+
+class MessageWriteBuffer:
+    """
+    消息写缓冲（write-behind）
+
+    消息插入先进入内存队列，由后台线程每隔flush_interval毫秒或积累batch_size条后
+    在一个事务中批量写入，并对涉及的会话执行历史裁剪。尚未落库的消息按会话保存在
+    内存覆盖层中，读取同一会话时可以看到这些待写入的消息。
+    """
+
+    INSERT_SQL = "INSERT INTO messages (user_id, item_id, role, content, timestamp, chat_id) VALUES (?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, db_pool, trim_history: Callable, flush_interval_ms: int = 200, batch_size: int = 100):
+        """
+        Args:
+            db_pool: SQLite连接池
+            trim_history: 裁剪回调 trim_history(cursor, {chat_id: 新增条数})，在批量写入的同一事务中执行
+            flush_interval_ms: 最长刷新间隔（毫秒）
+            batch_size: 积累多少条后立即刷新
+        """
+        self.db_pool = db_pool
+        self.trim_history = trim_history
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+
+        self._pending: List[Tuple] = []
+        self._overlay: Dict[str, List[Dict]] = defaultdict(list)  # chat_id -> 待写入消息
+        self._lock = threading.Lock()          # 保护待写队列和覆盖层
+        self._flush_lock = threading.Lock()    # 同一时间只有一个刷新
+        self._visibility_lock = threading.Lock()  # 提交与移出覆盖层的原子性，读取时同样持有
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, chat_id, user_id, item_id, role, content, timestamp):
+        """加入一条待写入消息"""
+        with self._lock:
+            self._pending.append((user_id, item_id, role, content, timestamp, chat_id))
+            self._overlay[chat_id].append({"role": role, "content": content})
+            should_flush = len(self._pending) >= self.batch_size
+        if should_flush:
+            self._wakeup.set()
+
+    def read(self, chat_id, db_read: Callable[[], List[Dict]]) -> List[Dict]:
+        """读取会话：数据库中已落库的消息 + 覆盖层中待写入的消息"""
+        with self._visibility_lock:
+            rows = db_read()
+            with self._lock:
+                pending = list(self._overlay.get(chat_id, ()))
+        return rows + pending
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"消息批量写入失败: {e}")
+
+    def flush(self):
+        """把当前待写入的消息批量写入数据库"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = []
+            if not batch:
+                return
+
+            chat_counts = defaultdict(int)
+            for row in batch:
+                chat_counts[row[5]] += 1
+
+            conn = self.db_pool.get_connection()
+            with self._visibility_lock:
+                try:
+                    cursor = conn.cursor()
+                    cursor.executemany(self.INSERT_SQL, batch)
+                    self.trim_history(cursor, chat_counts)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    # 写入失败，放回队列等待下次重试
+                    with self._lock:
+                        self._pending = batch + self._pending
+                    raise
+
+                # 已落库的消息从覆盖层移除
+                with self._lock:
+                    self._drop_from_overlay(chat_counts.items())
+
+    def _drop_from_overlay(self, chat_counts: Iterable[Tuple[str, int]]):
+        for chat_id, count in chat_counts:
+            remaining = self._overlay[chat_id][count:]
+            if remaining:
+                self._overlay[chat_id] = remaining
+            else:
+                del self._overlay[chat_id]
+
+    def close(self):
+        """停止后台线程，写入剩余消息并执行WAL检查点，确保数据落盘"""
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+        conn = self.db_pool.get_connection()
+        conn.execute("PRAGMA wal_checkpoint(FULL)")
@@ -1,10 +1,20 @@
-import json
+import re
 import time
 import hashlib
 import base64
 import struct
 from typing import Any, Dict, List
 
+from utils import serializer
+
+# 可选的MessagePack C扩展，未安装时使用纯Python快速解码器
+try:
+    import msgpack as _msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    _msgpack = None
+    MSGPACK_AVAILABLE = False
+
 
 def trans_cookies(cookies_str: str) -> Dict[str, str]:
     """解析cookie字符串为字典"""
@@ -70,7 +80,7 @@ def generate_sign(t: str, token: str, data: str) -> str:
 
 
 class MessagePackDecoder:
-    """MessagePack解码器的纯Python实现"""
+    """MessagePack解码器的纯Python实现（参考实现，解码请使用decode_msgpack）"""
     
     def __init__(self, data: bytes):
         self.data = data
@@ -284,52 +294,289 @@ class MessagePackDecoder:
             return base64.b64encode(self.data).decode('utf-8')
 
 
-def decrypt(data: str) -> str:
-    """解密函数的Python实现"""
+# 预编译的定长数值格式，直接在原始缓冲区上按偏移读取
+_UINT16 = struct.Struct('>H').unpack_from
+_UINT32 = struct.Struct('>I').unpack_from
+_UINT64 = struct.Struct('>Q').unpack_from
+_INT8 = struct.Struct('>b').unpack_from
+_INT16 = struct.Struct('>h').unpack_from
+_INT32 = struct.Struct('>i').unpack_from
+_INT64 = struct.Struct('>q').unpack_from
+_FLOAT32 = struct.Struct('>f').unpack_from
+_FLOAT64 = struct.Struct('>d').unpack_from
+
+# 定长数值类型：格式字节 -> (读取函数, 字节数)
+_FIXED_WIDTH = {
+    0xca: (_FLOAT32, 4),
+    0xcb: (_FLOAT64, 8),
+    0xcd: (_UINT16, 2),
+    0xce: (_UINT32, 4),
+    0xcf: (_UINT64, 8),
+    0xd0: (_INT8, 1),
+    0xd1: (_INT16, 2),
+    0xd2: (_INT32, 4),
+    0xd3: (_INT64, 8),
+}
+
+
+class _JSONKeyError(TypeError):
+    """字典键无法转换为JSON键（与json.dumps的报错一致）"""
+
+
+def _json_key(key) -> str:
+    """按json.dumps的规则把字典键转换为字符串"""
+    if type(key) is str:
+        return key
+    if isinstance(key, float):
+        if key != key:
+            return 'NaN'
+        if key in (float('inf'), float('-inf')):
+            return 'Infinity' if key > 0 else '-Infinity'
+        return float.__repr__(key)
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, int):
+        return int.__repr__(key)
+    raise _JSONKeyError(f"keys must be str, int, float, bool or None, not {type(key).__name__}")
+
+
+def _bin_to_json(value: bytes) -> str:
+    """二进制值转为字符串：优先UTF-8解码，失败时base64编码"""
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return base64.b64encode(value).decode('utf-8')
+
+
+def _json_pairs(pairs):
+    return {
+        _json_key(key): (_bin_to_json(value) if type(value) is bytes else value)
+        for key, value in pairs
+    }
+
+
+def _json_list(items):
+    return [_bin_to_json(item) if type(item) is bytes else item for item in items]
+
+
+def _unpack_fast(data: bytes, json_compatible: bool = False) -> Any:
+    """
+    纯Python快速解码：单循环 + 显式栈，定长数值直接按偏移从缓冲区读取，没有逐值的方法调用
+
+    结果与MessagePackDecoder.decode_value完全一致，数据不完整或格式错误时抛出异常。
+    json_compatible=True时在解码过程中直接把二进制值转为字符串、字典键转为JSON键。
+    """
+    length = len(data)
+    pos = 0
+    # 未填满的容器：[容器, 剩余元素数, 是否为map, 待写入的键, 是否已读到键]
+    stack = []
+
+    while True:
+        if pos >= length:
+            raise ValueError("Unexpected end of data")
+        byte = data[pos]
+        pos += 1
+        size = -1   # >=0 表示读到字符串/二进制的长度
+        container = None
+
+        # 按出现频率排列：fixstr、positive fixint、fixmap、fixarray
+        if 0xa0 <= byte <= 0xbf:
+            size = byte & 0x1f
+            is_str = True
+        elif byte <= 0x7f:
+            value = byte
+        elif byte <= 0x8f:
+            container, count, is_map = {}, byte & 0x0f, True
+        elif byte <= 0x9f:
+            container, count, is_map = [], byte & 0x0f, False
+        elif byte >= 0xe0:
+            value = byte - 256
+        elif byte in _FIXED_WIDTH:
+            unpack, width = _FIXED_WIDTH[byte]
+            value = unpack(data, pos)[0]
+            pos += width
+        elif byte == 0xc0:
+            value = None
+        elif byte == 0xc2:
+            value = False
+        elif byte == 0xc3:
+            value = True
+        elif byte == 0xcc:
+            if pos >= length:
+                raise ValueError("Unexpected end of data")
+            value = data[pos]
+            pos += 1
+        elif byte == 0xd9 or byte == 0xc4:
+            if pos >= length:
+                raise ValueError("Unexpected end of data")
+            size = data[pos]
+            pos += 1
+            is_str = byte == 0xd9
+        elif byte == 0xda or byte == 0xc5:
+            size = _UINT16(data, pos)[0]
+            pos += 2
+            is_str = byte == 0xda
+        elif byte == 0xdb or byte == 0xc6:
+            size = _UINT32(data, pos)[0]
+            pos += 4
+            is_str = byte == 0xdb
+        elif byte == 0xdc or byte == 0xde:
+            container, count, is_map = ({} if byte == 0xde else []), _UINT16(data, pos)[0], byte == 0xde
+            pos += 2
+        elif byte == 0xdd or byte == 0xdf:
+            container, count, is_map = ({} if byte == 0xdf else []), _UINT32(data, pos)[0], byte == 0xdf
+            pos += 4
+        else:
+            raise ValueError(f"Unknown format byte: 0x{byte:02x}")
+
+        if size >= 0:
+            end = pos + size
+            if end > length:
+                raise ValueError("Unexpected end of data")
+            if is_str:
+                value = data[pos:end].decode('utf-8')
+            elif json_compatible:
+                if stack and stack[-1][2] and not stack[-1][4]:
+                    raise _JSONKeyError("keys must be str, int, float, bool or None, not bytes")
+                value = _bin_to_json(data[pos:end])
+            else:
+                value = data[pos:end]
+            pos = end
+        elif container is not None:
+            if count:
+                stack.append([container, count, is_map, None, False])
+                continue
+            value = container
+
+        # 把读到的值放入所在的容器，容器填满后作为值继续向上放入
+        while True:
+            if not stack:
+                return value
+            frame = stack[-1]
+            if frame[2]:
+                if not frame[4]:
+                    frame[3] = _json_key(value) if json_compatible else value
+                    frame[4] = True
+                    break
+                frame[0][frame[3]] = value
+                frame[4] = False
+            else:
+                frame[0].append(value)
+            frame[1] -= 1
+            if frame[1]:
+                break
+            stack.pop()
+            value = frame[0]
+
+
+def _reject_ext(code, data):
+    """扩展类型与纯Python实现保持一致：视为不支持的格式"""
+    raise ValueError(f"Unsupported ext type: {code}")
+
+
+def _unpack_c(data: bytes, json_compatible: bool = False) -> Any:
+    """使用msgpack C扩展解码，只取第一个值（与纯Python实现一致，忽略尾部数据）"""
+    options = {}
+    if json_compatible:
+        options = {'object_pairs_hook': _json_pairs, 'list_hook': _json_list}
+    try:
+        result = _msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_reject_ext, **options)
+    except _msgpack.ExtraData as e:
+        result = e.unpacked
+    if json_compatible and type(result) is bytes:
+        result = _bin_to_json(result)
+    return result
+
+
+def _unpack(data: bytes, json_compatible: bool = False) -> Any:
+    # msgpack总是把-1号扩展类型（时间戳）解码为对象，含0xff字节的数据交给纯Python实现，
+    # 保证扩展类型一律按解码失败处理（UTF-8文本中不会出现0xff，绝大多数帧仍走C扩展）
+    if MSGPACK_AVAILABLE and b'\xff' not in data:
+        return _unpack_c(data, json_compatible)
+    return _unpack_fast(data, json_compatible)
+
+
+def decode_msgpack(data: bytes, json_compatible: bool = False) -> Any:
+    """
+    解码MessagePack数据
+
+    与MessagePackDecoder(data).decode()输出完全一致（解码失败时返回原始数据的base64编码），
+    安装了msgpack时使用C扩展，否则使用纯Python快速解码器。
+
+    Args:
+        data: MessagePack字节串
+        json_compatible: 结果是否转换为JSON兼容结构（二进制值转字符串、字典键转字符串），
+            与json.loads(json.dumps(结果))一致；存在无法转换的字典键时抛出TypeError
+
+    Returns:
+        Any: 解码结果
+    """
+    try:
+        return _unpack(data, json_compatible)
+    except _JSONKeyError:
+        # 只有数据本身能完整解码时才是键无法转换，否则与参考实现一样按解码失败处理
+        try:
+            _unpack(data)
+        except Exception:
+            return base64.b64encode(data).decode('utf-8')
+        raise
+    except Exception:
+        return base64.b64encode(data).decode('utf-8')
+
+
+# 非base64字符（只在快速路径校验失败时用于清理）
+_NON_BASE64_RE = re.compile(r'[^A-Za-z0-9+/=]+')
+
+
+def _b64decode_frame(data: str) -> bytes:
+    """
+    Base64解码消息帧
+
+    绝大多数帧本身就是合法的base64，先补齐padding后严格校验解码；
+    校验失败（含非法字符）时才清理非base64字符再解码，结果与逐字符清理一致。
+    """
+    try:
+        return base64.b64decode(data + '=' * (-len(data) % 4), validate=True)
+    except ValueError:
+        cleaned_data = _NON_BASE64_RE.sub('', data)
+        return base64.b64decode(cleaned_data + '=' * (-len(cleaned_data) % 4))
+
+
+def decrypt_to_obj(data: str) -> Any:
+    """
+    解密消息，直接返回Python对象
+
+    结果与json.loads(decrypt(data))一致：二进制值按UTF-8解码（失败时base64编码），
+    字典键按JSON规则转为字符串，省去序列化再解析的过程。
+    """
     try:
         # 1. Base64解码
-        # 清理非base64字符
-        cleaned_data = ''.join(c for c in data if c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
-        
-        # 添加padding如果需要
-        while len(cleaned_data) % 4 != 0:
-            cleaned_data += '='
-        
         try:
-            decoded_bytes = base64.b64decode(cleaned_data)
+            decoded_bytes = _b64decode_frame(data)
         except Exception as e:
             # 如果base64解码失败，尝试其他方法
-            return json.dumps({"error": f"Base64 decode failed: {str(e)}", "raw_data": data})
+            return {"error": f"Base64 decode failed: {str(e)}", "raw_data": data}
         
-        # 2. 尝试MessagePack解码
+        # 2. MessagePack解码，直接得到JSON兼容的结构
         try:
-            decoder = MessagePackDecoder(decoded_bytes)
-            result = decoder.decode()
-            
-            # 3. 转换为JSON字符串
-            def json_serializer(obj):
-                """自定义JSON序列化器"""
-                if isinstance(obj, bytes):
-                    try:
-                        return obj.decode('utf-8')
-                    except:
-                        return base64.b64encode(obj).decode('utf-8')
-                elif hasattr(obj, '__dict__'):
-                    return obj.__dict__
-                else:
-                    return str(obj)
-            
-            return json.dumps(result, ensure_ascii=False, default=json_serializer)
+            return decode_msgpack(decoded_bytes, json_compatible=True)
             
         except Exception as e:
-            # 如果MessagePack解码失败，尝试直接解析为字符串
+            # 如果MessagePack结果无法转换，尝试直接解析为字符串
             try:
-                text_result = decoded_bytes.decode('utf-8')
-                return json.dumps({"text": text_result})
-            except:
+                return {"text": decoded_bytes.decode('utf-8')}
+            except Exception:
                 # 最后的备选方案：返回十六进制表示
-                hex_result = decoded_bytes.hex()
-                return json.dumps({"hex": hex_result, "error": f"Decode failed: {str(e)}"})
+                return {"hex": decoded_bytes.hex(), "error": f"Decode failed: {str(e)}"}
                 
     except Exception as e:
-        return json.dumps({"error": f"Decrypt failed: {str(e)}", "raw_data": data})
+        return {"error": f"Decrypt failed: {str(e)}", "raw_data": data}
+
+
+def decrypt(data: str) -> str:
+    """解密函数的Python实现，返回JSON字符串（兼容旧接口，新代码请使用decrypt_to_obj）"""
+    return serializer.dumps(decrypt_to_obj(data))
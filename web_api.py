@@ -119,6 +119,14 @@ class XianyuWebAPI:
         self.app.route('/api/delivery/configs/<item_id>', methods=['DELETE'])(self.delete_delivery_config)
         self.app.route('/api/delivery/records', methods=['GET'])(self.get_delivery_records)
         self.app.route('/api/delivery/stats', methods=['GET'])(self.get_delivery_stats)
+        self.app.route('/api/delivery/stats/daily', methods=['GET'])(self.get_daily_delivery_stats)
+        self.app.route('/api/delivery/cardkeys/suspect', methods=['GET'])(self.get_suspect_card_keys)
+        self.app.route('/api/delivery/cardkeys/suspect/<int:card_key_id>', methods=['POST'])(self.resolve_suspect_card_key)
+        self.app.route('/api/delivery/cardkeys/<item_id>', methods=['GET'])(self.get_card_key_stats)
+        self.app.route('/api/delivery/cardkeys/<item_id>', methods=['POST'])(self.import_card_keys)
+        self.app.route('/api/delivery/low-stock', methods=['GET'])(self.get_low_stock_items)
+        self.app.route('/api/delivery/jobs', methods=['GET'])(self.get_delivery_jobs)
+        self.app.route('/api/delivery/jobs/<int:job_id>/retry', methods=['POST'])(self.retry_delivery_job)
         
         # 统计分析接口
         self.app.route('/api/analytics/overview', methods=['GET'])(self.get_analytics_overview)
@@ -781,7 +789,8 @@ class XianyuWebAPI:
                     'message': '发货类型不能为空'
                 }), 400
 
-            if not data.get('delivery_content'):
+            # 卡密商品的发货内容可以由卡密池提供
+            if not data.get('delivery_content') and data.get('delivery_type') != 'cardkey':
                 return jsonify({
                     'status': 'error',
                     'message': '发货内容不能为空'
@@ -834,21 +843,30 @@ class XianyuWebAPI:
             }), 500
 
     def get_delivery_records(self):
-        """获取发货记录"""
+        """获取发货记录（翻页时传入上一页返回的next_cursor）"""
         try:
             item_id = request.args.get('item_id')
             buyer_id = request.args.get('buyer_id')
             limit = request.args.get('limit', 100, type=int)
+            cursor = request.args.get('cursor')
 
-            records = self.delivery_manager.get_delivery_records(
-                item_id=item_id,
-                buyer_id=buyer_id,
-                limit=limit
-            )
+            try:
+                page = self.delivery_manager.get_delivery_records_page(
+                    item_id=item_id,
+                    buyer_id=buyer_id,
+                    limit=limit,
+                    cursor=cursor
+                )
+            except ValueError as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 400
 
             return jsonify({
                 'status': 'success',
-                'data': records
+                'data': page['records'],
+                'next_cursor': page['next_cursor']
             })
 
         except Exception as e:
@@ -873,6 +891,167 @@ class XianyuWebAPI:
                 'message': str(e)
             }), 500
 
+    def get_daily_delivery_stats(self):
+        """获取最近每天的发货数量"""
+        try:
+            days = request.args.get('days', 30, type=int)
+            stats = self.delivery_manager.get_daily_delivery_stats(days=days)
+
+            return jsonify({
+                'status': 'success',
+                'data': stats
+            })
+
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
+    def import_card_keys(self, item_id):
+        """批量导入卡密：codes为卡密列表，或text为每行一个卡密的文本"""
+        try:
+            data = request.get_json() or {}
+            codes = data.get('codes')
+            if codes is None:
+                codes = (data.get('text') or '').splitlines()
+
+            if not isinstance(codes, list) or not codes:
+                return jsonify({
+                    'status': 'error',
+                    'message': '卡密不能为空'
+                }), 400
+
+            result = self.delivery_manager.import_card_keys(item_id, codes)
+
+            return jsonify({
+                'status': 'success',
+                'message': f"成功导入 {result['imported']} 个卡密，跳过重复 {result['duplicates']} 个",
+                'data': result
+            })
+
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
+    def get_card_key_stats(self, item_id):
+        """获取商品卡密库存"""
+        try:
+            stats = self.delivery_manager.get_card_key_stats(item_id)
+
+            return jsonify({
+                'status': 'success',
+                'data': stats
+            })
+
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
+    def get_suspect_card_keys(self):
+        """获取待核对的卡密（预留超时、可能已发出），可按item_id筛选"""
+        try:
+            keys = self.delivery_manager.get_suspect_card_keys(request.args.get('item_id'))
+
+            return jsonify({
+                'status': 'success',
+                'data': keys
+            })
+
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
+    def resolve_suspect_card_key(self, card_key_id):
+        """核对待核对的卡密：sent为true表示已发给买家，否则放回卡密池"""
+        try:
+            data = request.get_json() or {}
+            if not isinstance(data.get('sent'), bool):
+                return jsonify({
+                    'status': 'error',
+                    'message': 'sent必须为true或false'
+                }), 400
+
+            if not self.delivery_manager.resolve_suspect_card_key(card_key_id, data['sent']):
+                return jsonify({
+                    'status': 'error',
+                    'message': '卡密不存在或不是待核对状态'
+                }), 404
+
+            return jsonify({
+                'status': 'success',
+                'message': '卡密已标记为已发出' if data['sent'] else '卡密已放回卡密池'
+            })
+
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
+    def get_low_stock_items(self):
+        """获取低库存商品"""
+        try:
+            items = self.delivery_manager.get_low_stock_items()
+
+            return jsonify({
+                'status': 'success',
+                'data': items
+            })
+
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
+    def get_delivery_jobs(self):
+        """获取发货任务（status=dead查看死信任务）"""
+        try:
+            status = request.args.get('status')
+            limit = request.args.get('limit', 100, type=int)
+
+            jobs = self.delivery_manager.get_delivery_jobs(status=status, limit=limit)
+
+            return jsonify({
+                'status': 'success',
+                'data': jobs
+            })
+
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
+    def retry_delivery_job(self, job_id):
+        """把死信任务重新放回发货队列"""
+        try:
+            success = self.delivery_manager.requeue_delivery_job(job_id)
+
+            if success:
+                return jsonify({
+                    'status': 'success',
+                    'message': '发货任务已重新入队'
+                })
+            else:
+                return jsonify({
+                    'status': 'error',
+                    'message': '发货任务不存在或不是死信状态'
+                }), 404
+
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
+
     # ========== 日志接口 ==========
 
     def get_logs(self):